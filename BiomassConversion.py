@@ -1,5 +1,7 @@
 import numpy as np
 
+import raster_io
+
 
 class BiomassConversion(object):
 
@@ -8,6 +10,9 @@ class BiomassConversion(object):
         self.description = ("This function converts biomass from  "
                             "biomass/ha to biomass/px.")
 
+        # Output buffer reused for all blocks of the same shape
+        self.output = None
+
     def getParameterInfo(self):
         return [
             {
@@ -22,9 +27,10 @@ class BiomassConversion(object):
                 'name': 'area',
                 'dataType': 'raster',
                 'value': None,
-                'required': True,
+                'required': False,
                 'displayName': "Area Raster",
-                'description': "A single-band raster where pixel values represent pixel area in m2."
+                'description': "A single-band raster where pixel values represent pixel area in m2. "
+                               "If not set, pixel area is computed from the grid (WGS84 coordinates only)."
             },
         ]
 
@@ -45,13 +51,30 @@ class BiomassConversion(object):
     def updatePixels(self, tlc, size, props, **pixelBlocks):
 
         # Get raster layers
-        biomass = np.array(pixelBlocks['biomass_pixels'], dtype='f4', copy=False)
-        area = np.array(pixelBlocks['area_pixels'], dtype='f4', copy=False)
+        biomass = np.asarray(pixelBlocks['biomass_pixels'])
+        area = None
+        if pixelBlocks.get('area_pixels', None) is not None:
+            area = np.asarray(pixelBlocks['area_pixels'])
+        else:
+            # Pixel area only depends on latitude, compute one value per row and broadcast it over all columns
+            # Scale factor from m2 to ha is folded into the row areas
+            cell_width, cell_height = props['cellSize'][:2]
+            hectares = raster_io.row_areas(tlc[1], cell_width, cell_height, biomass.shape[-2]) / 10000
+            hectares = hectares.astype(props['pixelType'])[:, np.newaxis]
+
+        # (Re)allocate output if block shape changed
+        if self.output is None or self.output.shape != biomass.shape or self.output.dtype != props['pixelType']:
+            self.output = np.empty(biomass.shape, dtype=props['pixelType'])
 
-        # Convert biomass/ha to biomass/px
-        outBlock = biomass * area/10000
+        # Convert biomass/ha to biomass/px: biomass * area / 10000, computed in place in output precision
+        if area is None:
+            np.multiply(biomass, hectares, out=self.output, dtype=self.output.dtype)
+        else:
+            # Area raster is in m2, scaling it would need a full size temporary
+            np.multiply(biomass, area, out=self.output, dtype=self.output.dtype)
+            np.multiply(self.output, 1.0 / 10000, out=self.output)
 
-        pixelBlocks['output_pixels'] = outBlock.astype(props['pixelType'], copy=False)
+        pixelBlocks['output_pixels'] = self.output
         return pixelBlocks
 
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import arcpy
 import util
@@ -28,13 +29,15 @@ class BiomassLoss(object):
             parameterType="Required",
             direction="Input")
 
-        # Tree cover density threshold. Input value must be an integer between 10 and 100
+        # Tree cover density thresholds. Input values must be integers between 10 and 100
+        # All thresholds are computed in one run
         tcd_threshold = arcpy.Parameter(
-            displayName="Tree cover density threshold (exclude values <=)",
+            displayName="Tree cover density thresholds (exclude values <=)",
             name="tcd_threshold",
             datatype="GPLong",
             parameterType="Required",
-            direction="Input")
+            direction="Input",
+            multiValue=True)
 
         tcd_threshold.value = "30"
         tcd_threshold.filter.type = "Range"
@@ -94,19 +97,34 @@ class BiomassLoss(object):
 
         #temp_merge.value = "in_memory/merge_table"
 
-        # Maximum number of temporary features
-        max_temp = arcpy.Parameter(
-            displayName="Maximum number of temporary features",
-            name="max_temp",
+        # Engine used to calculate zonal statistics
+        backend = arcpy.Parameter(
+            displayName="Zonal statistics backend",
+            name="backend",
+            datatype="GPString",
+            parameterType="Required",
+            direction="Input",
+            category="Advanced")
+
+        backend.filter.type = "ValueList"
+        backend.filter.list = ["arcpy", "numpy", "numpy_labelled"]
+        backend.value = "arcpy"
+
+        # Number of worker processes used by the numpy backends
+        workers = arcpy.Parameter(
+            displayName="Number of parallel processes",
+            name="workers",
             datatype="GPLong",
             parameterType="Required",
             direction="Input",
             category="Advanced")
 
-        max_temp.value = "100"
+        workers.value = "1"
+        workers.filter.type = "Range"
+        workers.filter.list = [1, multiprocessing.cpu_count()]
 
 
-        parameters = [in_features, tcd_threshold, mosaic_workspace, out_table, pivot, unit, temp_merge, max_temp]
+        parameters = [in_features, tcd_threshold, mosaic_workspace, out_table, pivot, unit, temp_merge, backend, workers]
 
         return parameters
 
@@ -174,15 +192,17 @@ class BiomassLoss(object):
         arcpy.env.overwriteOutput = True
 
         in_features = parameters[0].valueAsText
-        tcd_threshold = int(parameters[1].valueAsText)
+        tcd_thresholds = [int(value) for value in parameters[1].valueAsText.split(";")]
         mosaic_workspace = parameters[2].valueAsText
         out_table = parameters[3].valueAsText
         pivot = bool(parameters[4].value)
         unit = parameters[5].valueAsText
         if not parameters[6].valueAsText:
-            merge_table = "in_memory/merge_table"
+            # Results are kept in memory, no merge table needed
+            merge_table = None
         else:
             merge_table = parameters[6].valueAsText
-        max_temp = int(parameters[7].valueAsText)
+        backend = parameters[7].valueAsText
+        workers = int(parameters[8].valueAsText)
 
-        analysis.biomass_loss(in_features, tcd_threshold, mosaic_workspace, out_table, pivot, unit, merge_table, max_temp, messages)
+        analysis.biomass_loss(in_features, tcd_thresholds, mosaic_workspace, out_table, pivot, unit, merge_table, backend, workers, messages)
@@ -8,6 +8,12 @@ class LossYearMask(object):
         self.description = ("This function mask lossyear based on  "
                             "tree cover density threshold.")
         self.tcd_threshold = 30
+        self.tcd_thresholds = []
+
+        # Buffers reused for all blocks of the same shape
+        self.mask = None
+        self.output = None
+        self.shifted = None
 
     def getParameterInfo(self):
         return [
@@ -35,6 +41,15 @@ class LossYearMask(object):
                 'displayName': "TCD Threshold",
                 'description': "An integer representing the TCD threshold."
             },
+            {
+                'name': 'tcd_thresholds',
+                'dataType': 'string',
+                'value': "",
+                'required': False,
+                'displayName': "TCD Thresholds",
+                'description': "Comma separated list of TCD thresholds. "
+                               "If set, output has one band per threshold and TCD Threshold is ignored."
+            },
         ]
 
     def getConfiguration(self, **scalars):
@@ -47,8 +62,10 @@ class LossYearMask(object):
     def updateRasterInfo(self, **kwargs):
 
         self.tcd_threshold = int(kwargs.get('tcd_threshold', None))
+        thresholds = str(kwargs.get('tcd_thresholds', None) or "")
+        self.tcd_thresholds = [int(float(t)) for t in thresholds.replace(";", ",").split(",") if t.strip()]
 
-        kwargs['output_info']['bandCount'] = 1      # output is a single band raster
+        kwargs['output_info']['bandCount'] = max(len(self.tcd_thresholds), 1)     # one band per threshold
         kwargs['output_info']['statistics'] = ()    # we know nothing about the stats of the outgoing raster.
         kwargs['output_info']['histogram'] = ()     # we know nothing about the histogram of the outgoing raster.
         kwargs['output_info']['pixelType'] = 'i2'
@@ -56,16 +73,54 @@ class LossYearMask(object):
 
     def updatePixels(self, tlc, size, props, **pixelBlocks):
 
-        #Get raster layers
-        lossyear = np.array(pixelBlocks['lossyear_pixels'], dtype='i1', copy=False)
-        tcd = np.array(pixelBlocks['tcd_pixels'], dtype='i1', copy=False)
+        #Get raster layers. TCD is compared as is (uint8 0-100), no cast needed
+        lossyear = np.asarray(pixelBlocks['lossyear_pixels'])
+        tcd = np.asarray(pixelBlocks['tcd_pixels'])
+
+        if self.tcd_thresholds:
+            pixelBlocks['output_pixels'] = self.mask_bands(lossyear, tcd, props['pixelType'])
+            return pixelBlocks
+
+        #(Re)allocate buffers if block shape changed
+        if self.output is None or self.output.shape != lossyear.shape:
+            self.mask = np.empty(lossyear.shape, dtype=bool)
+            self.output = np.empty(lossyear.shape, dtype=props['pixelType'])
 
-        #Convert all values of lossyear outside threshold to -1
-        np.place(lossyear, tcd<=self.tcd_threshold, [-1])
+        np.greater(tcd, self.tcd_threshold, out=self.mask)
 
-        outBlock = lossyear
-        pixelBlocks['output_pixels'] = outBlock.astype(props['pixelType'], copy=False)
+        #Lossyear within threshold, all other values -1: (lossyear + 1) * (tcd > threshold) - 1
+        #Plain arithmetic on full arrays is much faster than masked assignments
+        np.add(lossyear, 1, out=self.output, dtype=self.output.dtype)
+        np.multiply(self.output, self.mask, out=self.output)
+        np.subtract(self.output, 1, out=self.output)
+
+        pixelBlocks['output_pixels'] = self.output
         return pixelBlocks
 
+    def mask_bands(self, lossyear, tcd, pixel_type):
+        """
+        Mask lossyear with all thresholds, one output band per threshold.
+        Input blocks are read once for all bands
+        """
+        shape = lossyear.shape[-2:]
+        lossyear = lossyear.reshape(shape)
+        tcd = tcd.reshape(shape)
+
+        #(Re)allocate buffers if block shape or number of thresholds changed
+        bands = (len(self.tcd_thresholds),) + shape
+        if self.output is None or self.output.shape != bands:
+            self.mask = np.empty(shape, dtype=bool)
+            self.shifted = np.empty(shape, dtype=pixel_type)
+            self.output = np.empty(bands, dtype=pixel_type)
+
+        #Same as single band: (lossyear + 1) * (tcd > threshold) - 1, lossyear + 1 is shared by all bands
+        np.add(lossyear, 1, out=self.shifted, dtype=self.shifted.dtype)
+        for band, threshold in zip(self.output, self.tcd_thresholds):
+            np.greater(tcd, threshold, out=self.mask)
+            np.multiply(self.shifted, self.mask, out=band)
+            np.subtract(band, 1, out=band)
+
+        return self.output
+
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
         return keyMetadata
\ No newline at end of file
@@ -0,0 +1,195 @@
+import multiprocessing
+import os
+import arcpy
+import util
+import analysis
+
+class TreeCoverBiomassLoss(object):
+    '''
+    Tree cover and biomass loss tool
+    '''
+
+    def __init__(self):
+        self.label       = "Tree Cover and Biomass Loss"
+        self.description = "Calculate tree cover loss, biomass loss and emissions for a given feature class " + \
+                           "Define custom threshold for tree cover density"
+        self.canRunInBackground = False
+
+    def getParameterInfo(self):
+        '''
+        Define parameter definitions
+        :return:
+        '''
+
+        # Input Features parameter
+        in_features = arcpy.Parameter(
+            displayName="Input Features",
+            name="in_features",
+            datatype="GPFeatureLayer",
+            parameterType="Required",
+            direction="Input")
+
+        # Tree cover density thresholds. Input values must be integers between 10 and 100
+        # All thresholds are computed in one run
+        tcd_threshold = arcpy.Parameter(
+            displayName="Tree cover density thresholds (exclude values <=)",
+            name="tcd_threshold",
+            datatype="GPLong",
+            parameterType="Required",
+            direction="Input",
+            multiValue=True)
+
+        tcd_threshold.value = "30"
+        tcd_threshold.filter.type = "Range"
+        tcd_threshold.filter.list = [10, 100]
+
+        # Workspace containing mosaic datasets
+        mosaic_workspace = arcpy.Parameter(
+            displayName="Mosaic Workspace",
+            name="mosaic_workspace",
+            datatype="DEWorkspace",
+            parameterType="Required",
+            direction="Input")
+
+        mosaic_workspace.filter.list = ['Local Database']
+
+
+
+        # Derived Output Features parameter
+        out_table = arcpy.Parameter(
+            displayName="Output table",
+            name="out_table",
+            datatype="DETable",
+            parameterType="Required",
+            direction="Output")
+
+        # Make output table a pivot table
+        pivot = arcpy.Parameter(
+            displayName="Make output a pivot table",
+            name="pivot",
+            datatype="GPBoolean",
+            parameterType="Required",
+            direction="Input")
+        pivot.value = True
+
+        # Location of temporary merge table
+        temp_merge = arcpy.Parameter(
+            displayName="Temporay output table",
+            name="temp_merge",
+            datatype="DETable",
+            parameterType="Optional",
+            direction="Output",
+            category="Advanced")
+
+        #temp_merge.value = "in_memory/merge_table"
+
+        # Engine used to calculate zonal statistics
+        backend = arcpy.Parameter(
+            displayName="Zonal statistics backend",
+            name="backend",
+            datatype="GPString",
+            parameterType="Required",
+            direction="Input",
+            category="Advanced")
+
+        backend.filter.type = "ValueList"
+        backend.filter.list = ["arcpy", "numpy", "numpy_labelled"]
+        backend.value = "arcpy"
+
+        # Number of worker processes used by the numpy backends
+        workers = arcpy.Parameter(
+            displayName="Number of parallel processes",
+            name="workers",
+            datatype="GPLong",
+            parameterType="Required",
+            direction="Input",
+            category="Advanced")
+
+        workers.value = "1"
+        workers.filter.type = "Range"
+        workers.filter.list = [1, multiprocessing.cpu_count()]
+
+
+        parameters = [in_features, tcd_threshold, mosaic_workspace, out_table, pivot, temp_merge, backend, workers]
+
+        return parameters
+
+    def isLicensed(self):
+        '''
+        Allow the tool to execute, only if the ArcGIS Spatial Analyst extension
+        is available.
+        :return:
+        '''
+
+        try:
+            if arcpy.CheckExtension("Spatial") != "Available":
+                raise Exception("Spatial Analyst extension not available")
+        except Exception("Spatial Analyst extension not available"):
+             return False  # tool cannot be executed
+
+        return True  # tool can be executed
+
+    def updateParameters(self, parameters): #optional
+        return
+
+    def updateMessages(self, parameters):
+        '''
+        Check if workspace is geodatabase and
+        if loss, area and tcd mosaic datasets are in GDB
+        :param parameters:
+        :return:
+        '''
+
+        if parameters[2].altered and parameters[2].valueAsText and \
+                not (parameters[2].hasBeenValidated and parameters[6].hasBeenValidated):
+            mosaic_workspace = parameters[2].valueAsText
+            if arcpy.Exists(mosaic_workspace):
+                if not util.is_file_gdb(mosaic_workspace):
+                    parameters[2].setErrorMessage("Workspace must be a geodatabase")
+                    return
+            else:
+                parameters[2].setErrorMessage("Workspace does not exist")
+                return
+
+            # Area mosaic is only read by the arcpy backend. Numpy backends compute pixel area
+            if parameters[6].valueAsText == "arcpy":
+                if not util.mosaic_datasets_exist([os.path.join(mosaic_workspace, "lossyear"),
+                                                   os.path.join(mosaic_workspace, "tcd"),
+                                                   os.path.join(mosaic_workspace, "biomass"),
+                                                   os.path.join(mosaic_workspace, "area")]):
+                    parameters[2].setErrorMessage("Geodatabase must contain loss, area, biomass and tcd mosaic datasets")
+            elif not util.mosaic_datasets_exist([os.path.join(mosaic_workspace, "lossyear"),
+                                                 os.path.join(mosaic_workspace, "tcd"),
+                                                 os.path.join(mosaic_workspace, "biomass")]):
+                parameters[2].setErrorMessage("Geodatabase must contain loss, biomass and tcd mosaic datasets")
+
+        return
+
+    def execute(self, parameters, messages):
+        '''
+        Run combined tree cover loss and biomass loss analysis
+        :param parameters:
+        :param messages:
+        :return:
+        '''
+
+        # Check out the Spatial Analyst extension
+        arcpy.CheckOutExtension("Spatial")
+
+        # Always overwrite output
+        arcpy.env.overwriteOutput = True
+
+        in_features = parameters[0].valueAsText
+        tcd_thresholds = [int(value) for value in parameters[1].valueAsText.split(";")]
+        mosaic_workspace = parameters[2].valueAsText
+        out_table = parameters[3].valueAsText
+        pivot = bool(parameters[4].value)
+        if not parameters[5].valueAsText:
+            # Results are kept in memory, no merge table needed
+            merge_table = None
+        else:
+            merge_table = parameters[5].valueAsText
+        backend = parameters[6].valueAsText
+        workers = int(parameters[7].valueAsText)
+
+        analysis.tc_biomass_loss(in_features, tcd_thresholds, mosaic_workspace, out_table, pivot, merge_table, backend, workers, messages)
@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 
 import arcpy
@@ -31,13 +32,15 @@ class TreeCoverLoss(object):
             parameterType="Required",
             direction="Input")
 
-        # Tree cover density threshold. Input value must be an integer between 10 and 100
+        # Tree cover density thresholds. Input values must be integers between 10 and 100
+        # All thresholds are computed in one run
         tcd_threshold = arcpy.Parameter(
-            displayName="Tree cover density threshold (exclude values <=)",
+            displayName="Tree cover density thresholds (exclude values <=)",
             name="tcd_threshold",
             datatype="GPLong",
             parameterType="Required",
-            direction="Input")
+            direction="Input",
+            multiValue=True)
 
         tcd_threshold.value = "30"
         tcd_threshold.filter.type = "Range"
@@ -83,18 +86,33 @@ class TreeCoverLoss(object):
 
         # temp_merge.value = "in_memory/merge_table"
 
-        # Maximum number of temporary features
-        max_temp = arcpy.Parameter(
-            displayName="Maximum number of temporary features",
-            name="max_temp",
+        # Engine used to calculate zonal statistics
+        backend = arcpy.Parameter(
+            displayName="Zonal statistics backend",
+            name="backend",
+            datatype="GPString",
+            parameterType="Required",
+            direction="Input",
+            category="Advanced")
+
+        backend.filter.type = "ValueList"
+        backend.filter.list = ["arcpy", "numpy", "numpy_labelled"]
+        backend.value = "arcpy"
+
+        # Number of worker processes used by the numpy backends
+        workers = arcpy.Parameter(
+            displayName="Number of parallel processes",
+            name="workers",
             datatype="GPLong",
             parameterType="Required",
             direction="Input",
             category="Advanced")
 
-        max_temp.value = "100"
+        workers.value = "1"
+        workers.filter.type = "Range"
+        workers.filter.list = [1, multiprocessing.cpu_count()]
 
-        parameters = [in_features, tcd_threshold, mosaic_workspace, out_table, pivot, temp_merge, max_temp]
+        parameters = [in_features, tcd_threshold, mosaic_workspace, out_table, pivot, temp_merge, backend, workers]
 
         return parameters
 
@@ -124,7 +142,8 @@ class TreeCoverLoss(object):
         :return:
         '''
 
-        if parameters[2].altered and parameters[2].valueAsText and not parameters[2].hasBeenValidated:
+        if parameters[2].altered and parameters[2].valueAsText and \
+                not (parameters[2].hasBeenValidated and parameters[6].hasBeenValidated):
             mosaic_workspace = parameters[2].valueAsText
             if arcpy.Exists(mosaic_workspace):
                 if not util.is_file_gdb(mosaic_workspace):
@@ -134,10 +153,15 @@ class TreeCoverLoss(object):
                 parameters[2].setErrorMessage("Workspace does not exist")
                 return
 
-            if not util.mosaic_datasets_exist([os.path.join(mosaic_workspace, "lossyear"),
-                                               os.path.join(mosaic_workspace, "tcd"),
-                                               os.path.join(mosaic_workspace, "area")]):
-                parameters[2].setErrorMessage("Geodatabase must contain loss, area and tcd mosaic datasets")
+            # Area mosaic is only read by the arcpy backend. Numpy backends compute pixel area
+            if parameters[6].valueAsText == "arcpy":
+                if not util.mosaic_datasets_exist([os.path.join(mosaic_workspace, "lossyear"),
+                                                   os.path.join(mosaic_workspace, "tcd"),
+                                                   os.path.join(mosaic_workspace, "area")]):
+                    parameters[2].setErrorMessage("Geodatabase must contain loss, area and tcd mosaic datasets")
+            elif not util.mosaic_datasets_exist([os.path.join(mosaic_workspace, "lossyear"),
+                                                 os.path.join(mosaic_workspace, "tcd")]):
+                parameters[2].setErrorMessage("Geodatabase must contain loss and tcd mosaic datasets")
         return
 
     def execute(self, parameters, messages):
@@ -155,14 +179,16 @@ class TreeCoverLoss(object):
         arcpy.env.overwriteOutput = True
 
         in_features = parameters[0].valueAsText
-        tcd_threshold = int(parameters[1].valueAsText)
+        tcd_thresholds = [int(value) for value in parameters[1].valueAsText.split(";")]
         mosaic_workspace = parameters[2].valueAsText
         out_table = parameters[3].valueAsText
         pivot = bool(parameters[4].value)
         if not parameters[5].valueAsText:
-            merge_table = "in_memory/merge_table"
+            # Results are kept in memory, no merge table needed
+            merge_table = None
         else:
             merge_table = parameters[5].valueAsText
-        max_temp = int(parameters[6].valueAsText)
+        backend = parameters[6].valueAsText
+        workers = int(parameters[7].valueAsText)
 
-        analysis.tc_loss(in_features, tcd_threshold, mosaic_workspace, out_table, pivot, merge_table, max_temp, messages)
+        analysis.tc_loss(in_features, tcd_thresholds, mosaic_workspace, out_table, pivot, merge_table, backend, workers, messages)
@@ -1,8 +1,38 @@
+import collections
 import math
+import multiprocessing
 import os
+import sys
+import time
 import arcpy
+import numpy as np
+import boundary
+import checkpoint
+import geometry
+import projection
 import raster_function
+import raster_io
+import tables
 import util
+import zonal
+
+# Maximum size in pixels of the processing tiles used by the numpy backends
+TILE_SIZE = 4096
+
+# Maximum memory in bytes used by the raster and working arrays of one tile
+MAX_TILE_BYTES = 512 * 1024 * 1024
+
+# Initial number of rows of the result array. Array grows as needed
+SINK_CAPACITY = 100000
+
+# Number of result rows written at once into the merge table
+SINK_BATCH_SIZE = 1000000
+
+# Number of retries for features which fail in ZonalStatisticsAsTable
+MAX_RETRIES = 3
+
+# Delay in seconds before first retry of a failed feature, doubled on every further retry
+RETRY_DELAY = 0.5
 
 
 def get_geometry(fc):
@@ -16,40 +46,372 @@ def get_geometry(fc):
         return row[0]
 
 
-def merge_results(temp_tables, merge_table, messages):
+def write_records(records, table):
     """
-    Append input temp_tables into merge table
-    :param temp_tables: list
-    :param merge_table: string
-    :param messages: object
+    Write rows of a structured array into a table. Table is created on first write,
+    later batches are written into an in_memory table and appended at once
+    :param records: numpy.ndarray
+    :param table: string
+    :return:
+    """
+    if not arcpy.Exists(table):
+        arcpy.da.NumPyArrayToTable(records, table)
+    else:
+        batch_table = "in_memory/batch"
+        if arcpy.Exists(batch_table):
+            arcpy.Delete_management(batch_table)
+        arcpy.da.NumPyArrayToTable(records, batch_table)
+        arcpy.Append_management(batch_table, table, "NO_TEST")
+        arcpy.Delete_management(batch_table)
+
+
+def create_table(records, table):
+    """
+    Write rows of a structured array into a new table. Existing table will be replaced
+    :param records: numpy.ndarray
+    :param table: string
     :return: string
     """
-    if len(temp_tables) > 0:
-        # Merge all results into one table
-        messages.AddMessage("Merge results")
-        if not arcpy.Exists(merge_table):
-            arcpy.CreateTable_management(os.path.dirname(merge_table), os.path.basename(merge_table), temp_tables[0])
-        arcpy.Append_management(temp_tables, merge_table)
-        for temp_table in temp_tables:
-            arcpy.Delete_management(temp_table)
-        return merge_table
+    if arcpy.Exists(table):
+        arcpy.Delete_management(table)
+    arcpy.da.NumPyArrayToTable(records, table)
+    return table
+
+
+def last_loss_year(lossyear_mosaic, results):
+    """
+    Last lossyear value, taken from the raster statistics of the lossyear mosaic
+    or from the results if the mosaic has no statistics
+    :param lossyear_mosaic: string
+    :param results: numpy.ndarray (FID, VALUE, SUM)
+    :return: integer
+    """
+    last_year = arcpy.Raster(lossyear_mosaic).maximum
+    if last_year is None:
+        last_year = 0
+    if len(results):
+        last_year = max(last_year, results['VALUE'].max())
+    return int(last_year)
+
+
+def result_sink(merge_table):
+    """
+    Create sink which collects (FID, VALUE, SUM) rows and writes them in batches into the merge table
+    Results are only kept in memory if no merge table is given
+    :param merge_table: string or None
+    :return: ResultSink
+    """
+    if merge_table is None:
+        return tables.ResultSink(zonal.RESULT_DTYPE, SINK_CAPACITY, SINK_BATCH_SIZE, None)
+    return tables.ResultSink(zonal.RESULT_DTYPE, SINK_CAPACITY, SINK_BATCH_SIZE,
+                             lambda records: write_records(records, merge_table))
 
+
+def geometry_parts(shape):
+    """
+    Return coordinates of all parts of a polygon. Every part is a list of its exterior and interior rings
+    Coordinates are read from the WKB of the polygon in bulk, not point by point
+    :param shape: arcpy.Polygon or WKB (bytearray)
+    :return: list of list of numpy.ndarray (n, 2)
+    """
+    if not isinstance(shape, (bytes, bytearray)):
+        shape = shape.WKB
+    return geometry.wkb_parts(bytes(shape), 0)[0]
+
+
+def geometry_rings(shape):
+    """
+    Return coordinates of all exterior and interior rings of a polygon
+    :param shape: arcpy.Polygon
+    :return: list of numpy.ndarray (n, 2)
+    """
+    return [ring for part in geometry_parts(shape) for ring in part]
+
+
+def spatial_reference_key(spatial_reference):
+    """
+    Identify a spatial reference by its WKID, or by its WKT if it has no WKID
+    :param spatial_reference: arcpy.SpatialReference
+    :return: integer or string
+    """
+    if spatial_reference.factoryCode:
+        return int(spatial_reference.factoryCode)
+    return spatial_reference.exportToString()
+
+
+def valid_features(features, tracker, messages):
+    """
+    Indices of features with valid geometry
+    :param features: list of (OID, list of parts)
+    :param tracker: FeatureTracker
+    :param messages: object
+    :return: list of integers
+    """
+    valid = list()
+    for i, (oid, parts) in enumerate(features):
+        # Check if geometry actually exists
+        if len(parts) == 0:
+            messages.AddMessage("Feature has no valid geometry - Skip (ID {})".format(oid))
+            tracker.skip(oid, tracker.NO_GEOMETRY)
+            continue
+        valid.append(i)
+    return valid
+
+
+def read_features(in_features, spatial_reference, with_geometries, tracker, messages):
+    """
+    Read all features with valid geometry into a GeometryStore in the given spatial reference.
+    GeoJSON, shapefiles and GeoPackages are read without arcpy if arcpy geometries are not needed.
+    Coordinates of all features are transformed at once (see projection.transformer).
+    Only coordinate systems without vectorized transformation are projected feature by feature with arcpy
+    :param in_features: string
+    :param spatial_reference: arcpy.SpatialReference
+    :param with_geometries: boolean, also return arcpy geometries
+    :param tracker: FeatureTracker
+    :param messages: object
+    :return: tuple (geometry.GeometryStore, list of arcpy.Polygon in source coordinates or None)
+    """
+    target = spatial_reference_key(spatial_reference)
+
+    if not with_geometries and geometry.can_read(in_features):
+        features, crs = geometry.read_file(in_features)
+        transform = projection.transformer(crs, target) if crs is not None else None
+        if transform is not None:
+            features = [features[i] for i in valid_features(features, tracker, messages)]
+            return geometry.GeometryStore.from_features(features, crs).transform(transform, target), None
+
+    crs = spatial_reference_key(arcpy.Describe(in_features).spatialReference)
+    transform = projection.transformer(crs, target)
+    if transform is None:
+        messages.AddMessage("Project features with arcpy")
+
+    # Geometry objects are only needed to project features or if they are returned, otherwise read WKB
+    shape_field = 'SHAPE@WKB' if transform is not None and not with_geometries else 'SHAPE@'
+
+    features = list()
+    geometries = list()
+    with arcpy.da.SearchCursor(in_features, ['OID@', shape_field]) as cursor:
+        for oid, shape in cursor:
+            parts = list()
+            if shape:
+                parts = geometry_parts(shape if transform is not None else shape.projectAs(spatial_reference))
+            features.append((oid, parts))
+            if with_geometries:
+                geometries.append(shape)
+
+    valid = valid_features(features, tracker, messages)
+    if transform is None:
+        # Already projected by arcpy
+        store = geometry.GeometryStore.from_features([features[i] for i in valid], target)
     else:
-        raise Exception("No features found in input Layer")
+        store = geometry.GeometryStore.from_features([features[i] for i in valid], crs).transform(transform, target)
+
+    if not with_geometries:
+        return store, None
+    return store, [geometries[i] for i in valid]
 
 
-def zonal_stats(mask_mosaic, value_mosaic, in_features, merge_table, max_temp, messages):
+def features_within_bounds(in_features, boundaries, spatial_reference, with_geometries, tracker, messages):
+    """
+    Read all features with valid geometry within bounds of all boundaries.
+    Bounding boxes of all features are first classified on a coarse grid of every boundary (see boundary.BoundaryIndex),
+    exact within tests only run for features close to the edge of a boundary
+    :param in_features: string
+    :param boundaries: list of arcpy.Polygon
+    :param spatial_reference: arcpy.SpatialReference of the boundaries
+    :param with_geometries: boolean, also return arcpy geometries
+    :param tracker: FeatureTracker
+    :param messages: object
+    :return: tuple (geometry.GeometryStore in coordinates of the boundaries,
+                    list of arcpy.Polygon in source coordinates or None)
+    """
+    store, geometries = read_features(in_features, spatial_reference, with_geometries, tracker, messages)
+
+    indexes = [boundary.BoundaryIndex(geometry_rings(boundary_geometry)) for boundary_geometry in boundaries]
+    states = boundary.classify(indexes, store.bounds)
+
+    within = np.zeros(len(store), dtype=bool)
+    for i, feature_states in enumerate(states):
+        # check if geometry of input feature is within bounds of mosaic datasets
+        within[i] = not (feature_states == boundary.OUTSIDE).any()
+        if within[i] and (feature_states == boundary.EDGE).any():
+            polygon = arcpy.Polygon(arcpy.AsShape(store.geojson(i)).getPart(), spatial_reference)
+            within[i] = all([polygon.within(boundary_geometry)
+                             for boundary_geometry, state in zip(boundaries, feature_states)
+                             if state == boundary.EDGE])
+        if not within[i]:
+            messages.AddMessage("Feature out of bounds - Skip (ID {})".format(store.fids[i]))
+            tracker.skip(int(store.fids[i]), tracker.OUT_OF_BOUNDS)
+
+    if geometries is not None:
+        geometries = [geometries[i] for i in np.flatnonzero(within)]
+    return store.subset(within), geometries
+
+
+def use_python_executable():
+    """
+    Worker processes must be started with the Python interpreter.
+    Inside ArcMap sys.executable points to ArcMap.exe
+    :return:
+    """
+    if os.name == "nt" and not os.path.basename(sys.executable).lower().startswith("python"):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe"))
+
+
+def open_mosaic(mosaic, messages):
+    """
+    Open mosaic dataset for reading with the numpy backends.
+    Mosaics with a footprint index (see util.create_mosaic_dataset) and without raster functions
+    are read directly from the source rasters which intersect a window
+    :param mosaic: string
+    :param messages: object
+    :return: reader
+    """
+    footprints = util.read_footprints(mosaic)
+    if footprints is not None and raster_function.applied_raster_function(mosaic) == "":
+        try:
+            return raster_io.FootprintReader(mosaic, footprints)
+        except Exception as e:
+            messages.AddMessage("Cannot read source rasters of {} ({}) - Read mosaic".format(mosaic, e))
+    return raster_io.open_raster(mosaic)
+
+
+def numpy_zonal_stats(mask_mosaic, value_mosaic, tcd_mosaic, thresholds, in_features, merge_table, labelled, workers,
+                      run_checkpoint, messages):
+    """
+    Calulate zonal stats for a mask mosaic and a value mosaic using a vector feature as mask.
+    Reads mosaics as NumPy arrays and sums values per class with numpy instead of using ZonalStatisticsAsTable
+    If labelled is set, all features are rasterized into one zone label raster per tile
+    and mosaics are read only once for all features.
+    If a TCD mosaic is given, all thresholds are computed in the same pass over the unmasked mask mosaic
+    and VALUE holds combined lossyear/TCD bucket codes (see zonal.split_thresholds)
+    If a list of value mosaics is given, all of them are summed in the same pass (see zonal.split_values)
+    :param mask_mosaic: string
+    :param value_mosaic: string or list of strings, raster_io.PIXEL_AREA computes pixel area instead of reading it
+    :param tcd_mosaic: string or None
+    :param thresholds: list of integers (sorted) or None
+    :param in_features: string
+    :param merge_table: string or None
+    :param labelled: boolean
+    :param workers: integer
+    :param run_checkpoint: Checkpoint
+    :param messages: object
+    :return: numpy.ndarray (FID, VALUE, SUM)
+    """
+
+    # Pixel area is computed, not read from a mosaic
+    value_mosaics = zonal.value_list(value_mosaic)
+    mosaics = [mosaic for mosaic in value_mosaics if mosaic != raster_io.PIXEL_AREA]
+
+    readers = list()
+    try:
+        mask_raster = open_mosaic(mask_mosaic, messages)
+        readers.append(mask_raster)
+        value_rasters = list()
+        for mosaic in value_mosaics:
+            if mosaic == raster_io.PIXEL_AREA:
+                value_rasters.append(mosaic)
+                continue
+            value_rasters.append(open_mosaic(mosaic, messages))
+            readers.append(value_rasters[-1])
+        tcd_raster = None
+        if tcd_mosaic is not None:
+            tcd_raster = open_mosaic(tcd_mosaic, messages)
+            readers.append(tcd_raster)
+
+        arcpy.MakeMosaicLayer_management(mask_mosaic, "mask_mosaic_layer")
+        mask_mosaic_boundary = get_geometry("mask_mosaic_layer/Boundary")
+
+        # Features must be within bounds of all value mosaics and of the TCD mosaic, same as with the arcpy backend
+        boundaries = [mask_mosaic_boundary]
+        for i, mosaic in enumerate(mosaics):
+            arcpy.MakeMosaicLayer_management(mosaic, "value_mosaic_layer_{}".format(i))
+            boundaries.append(get_geometry("value_mosaic_layer_{}/Boundary".format(i)))
+        if tcd_mosaic is not None:
+            arcpy.MakeMosaicLayer_management(tcd_mosaic, "tcd_mosaic_layer")
+            boundaries.append(get_geometry("tcd_mosaic_layer/Boundary"))
+
+        # Check if output table exist. If yes, delete to make sure that new table with correct schema will be created
+        if merge_table is not None and arcpy.Exists(merge_table):
+            arcpy.Delete_management(merge_table)
+
+        # Keep track of all processed features
+        tracker = util.FeatureTracker(int(arcpy.GetCount_management(in_features).getOutput(0)))
+
+        # Read all features within bounds of mosaic datasets
+        spatial_reference = arcpy.Describe(mask_mosaic).spatialReference
+        features = features_within_bounds(in_features, boundaries, spatial_reference, False, tracker, messages)[0]
+
+        if workers > 1:
+            use_python_executable()
+
+        # Results of previous run
+        previous = run_checkpoint.records()
+        if run_checkpoint.resumed:
+            messages.AddMessage("Resume from checkpoint {}".format(run_checkpoint.path))
+
+        if labelled:
+            results = zonal.labelled_zonal_stats(features, mask_raster, value_rasters, tcd_raster, thresholds,
+                                                 TILE_SIZE, MAX_TILE_BYTES, workers, run_checkpoint, messages)
+        else:
+            results = zonal.zonal_stats(features, mask_raster, value_rasters, tcd_raster, thresholds,
+                                        TILE_SIZE, MAX_TILE_BYTES, workers, run_checkpoint, messages)
+
+        # Add results of previous run
+        results = zonal.merge_records(np.concatenate([previous, results]))
+
+        # Features without any results do not cover any pixel with data
+        with_data = set(np.unique(results['FID']).tolist())
+        for fid in features.fids.tolist():
+            if fid in with_data:
+                tracker.processed(fid)
+            else:
+                tracker.skip(fid, tracker.EMPTY)
+
+        tracker.report(messages)
+
+        if len(results) == 0:
+            raise Exception("No features found in input Layer")
+
+        sink = result_sink(merge_table)
+        sink.append(results)
+        sink.flush()
+
+        return sink.records()
+
+    finally:
+        # Close readers also if run failed, worker processes open their own ones
+        for reader in readers:
+            reader.close()
+
+
+def zonal_stats(mask_mosaic, value_mosaic, tcd_mosaic, thresholds, in_features, merge_table, backend, workers,
+                run_checkpoint, messages):
     """
     Calulate zonal stats for a mask mosaic and a value mosaic using a vector feature as mask
+    If a TCD mosaic is given, mask mosaic values outside TCD threshold are set to -1 while reading.
+    Mosaic datasets are never modified. The arcpy backend supports only one threshold,
+    lists of value mosaics are only supported by the numpy backends
     :param mask_mosaic: string
-    :param value_mosaic: string
+    :param value_mosaic: string or list of strings
+    :param tcd_mosaic: string or None
+    :param thresholds: list of integers (sorted) or None
     :param in_features: string
-    :param temp_merge: string
-    :param max_temp: long
+    :param merge_table: string or None (results are not written into a table)
+    :param backend: string ("arcpy", "numpy" or "numpy_labelled")
+    :param workers: integer (only used by numpy backends)
+    :param run_checkpoint: Checkpoint
     :param messages: object
-    :return:
+    :return: numpy.ndarray (FID, VALUE, SUM)
     """
 
+    if backend in ("numpy", "numpy_labelled"):
+        return numpy_zonal_stats(mask_mosaic, value_mosaic, tcd_mosaic, thresholds, in_features, merge_table,
+                                 backend == "numpy_labelled", workers, run_checkpoint, messages)
+
+    if workers > 1:
+        messages.AddMessage("Parallel processing is only supported by the numpy backends - Use one process")
+
     # Make lossyear mosaic spatial reference the default output coordinate system
     desc = arcpy.Describe(mask_mosaic)
     arcpy.env.outputCoordinateSystem = desc.spatialReference
@@ -59,121 +421,116 @@ def zonal_stats(mask_mosaic, value_mosaic, in_features, merge_table, max_temp, m
 
     mask_mosaic_boundary = get_geometry("mask_mosaic_layer/Boundary")
     value_mosaic_boundary = get_geometry("value_mosaic_layer/Boundary")
+    boundaries = [mask_mosaic_boundary, value_mosaic_boundary]
+
+    if tcd_mosaic is not None:
+        if len(thresholds) != 1:
+            raise Exception("Arcpy backend supports only one TCD threshold per run")
+        arcpy.MakeMosaicLayer_management(tcd_mosaic, "tcd_mosaic_layer")
+        boundaries.append(get_geometry("tcd_mosaic_layer/Boundary"))
 
-    # Snap to lossyear mosaic
+    # Snap to lossyear mosaic, in memory mask uses lossyear resolution
     arcpy.env.snapRaster = mask_mosaic
+    arcpy.env.cellSize = mask_mosaic
 
     # Make feature layer from input features
     in_layer = arcpy.MakeFeatureLayer_management(in_features, "in_layer")
 
-    # Create list to register temp output tables
-    temp_tables = list()
-
     # Check if temporary output table exist. If yes, delete to make sure that new table with correct schema will be created
-    if arcpy.Exists(merge_table):
+    if merge_table is not None and arcpy.Exists(merge_table):
         arcpy.Delete_management(merge_table)
 
-    # Create lists to count if all features were processed
-    processed = list()
-
-    #Create counter for merged features
-    merged = 0
-
     # Count number of rows in input layer
     row_count = int(arcpy.GetCount_management(in_layer).getOutput(0))
 
-    # Calculate lossyear for input features
-    # Loop as long over features until all were processed
-    done = False
-    while not done:
-        # Create list to count all features
-        id = list()
-
-        with arcpy.da.SearchCursor(in_layer, ['OID@', 'Shape@']) as cursor:
-            for row in cursor:
-                id.append(row[0])
-                # If feature was not yet processed copy feature to temporary feature class
-                # Assign temporary feature class as mask in environment settings
-                # Must be feature class, Geometries are not accepted
-                if row[0] not in processed:
-                    # Check if geometry actually exists
-                    if row[1]:
-                        # check if geometry of input feature is within bounds of mosaic datasets
-                        geometry = row[1].projectAs("WGS 1984")
-                        if geometry.within(mask_mosaic_boundary) and geometry.within(value_mosaic_boundary):
-
-                            # Copy geometry to in memory feature class
-                            mask_layer = "in_memory/mask"
-                            arcpy.CopyFeatures_management(geometry, mask_layer)
-                            arcpy.env.mask = mask_layer
-                            desc = arcpy.Describe(mask_layer)
-                            arcpy.env.extent = desc.extent
-
-                            # Somehow every second features does not get properly copies. Don't know why
-                            # If mask is empty feature get skipped and will be processed in the next loop
-                            if not math.isnan(arcpy.env.extent.XMin):
-                                # Sum area values for every year in mask lossyear layers
-                                # Save results in temporary table and add feature ID as extra column
-                                messages.AddMessage("Process feature {} out of {} (ID {})".format(len(processed) + 1,
-                                                                                                  row_count, row[0]))
-                                temp_table = "in_memory/feature_{}".format(row[0])
-                                temp_tables.append(temp_table)
-
-                                arcpy.gp.ZonalStatisticsAsTable_sa(mask_mosaic, "VALUE", value_mosaic, temp_table, "DATA", "SUM")
-
-                                arcpy.AddField_management(temp_table, "FID", "LONG")
-                                arcpy.CalculateField_management (temp_table, "FID", row[0])
-
-                                # Make feature as processed
-                                processed.append(row[0])
-                        else:
-                            messages.AddMessage("Feature out of bounds - Skip (ID {})".format(row[0]))
-                            processed.append(row[0])
-                    else:
-                        messages.AddMessage("Feature has no valid geometry - Skip (ID {})".format(row[0]))
-                        processed.append(row[0])
-
-                    # once given threshold is reached, write all temporary results into one single table to prevent script from crashing
-                    # might be internal memory related issue? Normally, max number of feature classes is 2Bil
-
-                    if len(processed) == max_temp+merged and len(temp_tables) > 0:
-                        #messages.AddMessage("max_temp: {}, len(processed): {}, merged:{}".format(max_temp, len(processed), merged))
-                        merge_results(temp_tables, merge_table, messages)
-                        temp_tables = list()
-                        merged += max_temp
-
-        # Once all features are processed quite while loop
-        if id == sorted(processed):
-            done = True
-
-    if len(temp_tables) > 0:
-        merge_results(temp_tables, merge_table, messages)
-
-    if arcpy.Exists(merge_table):
-        return merge_table
-    else:
+    # Keep track of all processed features
+    tracker = util.FeatureTracker(row_count)
+
+    # Collect results in memory and write them in large batches into merge table
+    sink = result_sink(merge_table)
+
+    # Add results of previous run
+    if run_checkpoint.resumed:
+        messages.AddMessage("Resume from checkpoint {}".format(run_checkpoint.path))
+        sink.append(run_checkpoint.records())
+        for oid in run_checkpoint.features:
+            tracker.processed(oid)
+
+    # Read input layer once and queue all features within bounds of mosaic datasets
+    # Queue items are (OID, geometry, attempt, earliest time of next attempt)
+    queue = collections.deque()
+    # Geometries stay in their coordinate system, CopyFeatures projects them into the output coordinate system
+    features, geometries = features_within_bounds(in_layer, boundaries, desc.spatialReference, True, tracker,
+                                                  messages)
+    for oid, geometry in zip(features.fids.tolist(), geometries):
+        # Skip features which were completed in previous run
+        if oid not in tracker:
+            queue.append((oid, geometry, 0, 0))
+
+    # Calculate lossyear for queued features
+    # Failed features are queued again until they succeed or run out of retries
+    while queue:
+        oid, geometry, attempt, not_before = queue.popleft()
+
+        # Wait before retrying a failed feature, unless enough other features were processed in between
+        delay = not_before - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            # Copy geometry to temporary feature class and assign it as mask in environment settings
+            # Must be feature class, Geometries are not accepted
+            mask_layer = "in_memory/mask"
+            arcpy.CopyFeatures_management(geometry, mask_layer)
+            arcpy.env.mask = mask_layer
+            desc = arcpy.Describe(mask_layer)
+            arcpy.env.extent = desc.extent
+
+            # Somehow every second features does not get properly copies. Don't know why
+            # If mask is empty feature will be retried
+            if math.isnan(arcpy.env.extent.XMin):
+                raise Exception("Mask is empty")
+
+            # Sum area values for every year in mask lossyear layers
+            # Read results from temporary table into result array and add feature ID
+            messages.AddMessage("Process feature {} out of {} (ID {})".format(len(tracker) + 1, row_count, oid))
+            temp_table = "in_memory/feature"
+
+            # Mask lossyear within feature extent in memory. Set all values outside TCD threshold to -1
+            zone = mask_mosaic
+            if tcd_mosaic is not None:
+                zone = "in_memory/zone"
+                arcpy.gp.Con_sa(tcd_mosaic, mask_mosaic, zone, -1, "VALUE > {}".format(thresholds[0]))
+
+            arcpy.gp.ZonalStatisticsAsTable_sa(zone, "VALUE", value_mosaic, temp_table, "DATA", "SUM")
+
+            stats = arcpy.da.TableToNumPyArray(temp_table, ["VALUE", "SUM"])
+            arcpy.Delete_management(temp_table)
+            if tcd_mosaic is not None:
+                arcpy.Delete_management(zone)
+
+        except Exception as e:
+            if attempt < MAX_RETRIES:
+                messages.AddMessage("Feature failed ({}) - Retry later (ID {})".format(e, oid))
+                queue.append((oid, geometry, attempt + 1, time.time() + RETRY_DELAY * 2 ** attempt))
+            else:
+                messages.AddMessage("Feature failed ({}) - Skip (ID {})".format(e, oid))
+                tracker.skip(oid, tracker.FAILED)
+            continue
+
+        # Make feature as processed
+        records = zonal.to_records(oid, stats["VALUE"], stats["SUM"])
+        sink.append(records)
+        run_checkpoint.write(records, [oid])
+        tracker.processed(oid)
+
+    tracker.report(messages)
+
+    if len(sink) == 0:
         raise Exception("No features found in input Layer")
 
-
-def mask_lossyear(mosaic, tcd_mosaic, tcd_threshold, messages):
-    """
-    Apply TCD mask to lossyear mosaic
-    :param mosaic: string
-    :param tcd_mosaic: string
-    :param tcd_threshold: integer
-    :param messages: object
-    :return:
-    """
-
-    messages.AddMessage("Apply TCD mask to lossyear mosaic")
-
-    # Create raster function template file
-    mask_function = raster_function.mask_lossyear_mosaic(tcd_mosaic, tcd_threshold, messages)
-
-    # Load raster functions
-    raster_function.replace_raster_function(mosaic, mask_function, messages)
-
-    return
+    sink.flush()
+    return sink.records()
 
 
 def convert_biomass(mosaic, area_mosaic, messages):
@@ -196,10 +553,10 @@ def convert_biomass(mosaic, area_mosaic, messages):
     return
 
 
-def clean_up(mosaics, messages):
+def clean_up(messages):
     """
-    Delete all in_memort datasets and remove raster functions from listed mosaics
-    :param mosaics: list
+    Delete all in_memory datasets
+    :param messages: object
     :return:
     """
 
@@ -213,22 +570,143 @@ def clean_up(mosaics, messages):
     for dataset in datasets:
         arcpy.Delete_management(dataset)
 
-    # remove all datasets from listed mosaics
-    for mosaic in mosaics:
-        arcpy.EditRasterFunction_management(mosaic, "EDIT_MOSAIC_DATASET", "REMOVE")
     return
 
 
-def tc_loss(in_features, tcd_threshold, mosaic_workspace, out_table, pivot, merge_table, max_temp, messages):
+def source_key(mosaic):
+    """
+    Identify a raster source of a run by its catalog path and the raster function applied to it
+    :param mosaic: string, raster_io.PIXEL_AREA or None
+    :return: string
+    """
+    if mosaic is None or mosaic == raster_io.PIXEL_AREA:
+        return str(mosaic)
+    return "{}:{}".format(arcpy.Describe(mosaic).catalogPath, raster_function.applied_raster_function(mosaic))
+
+
+def open_checkpoint(in_features, tcd_threshold, lossyear_mosaic, tcd_mosaic, value_mosaic, backend):
+    """
+    Open checkpoint of a run. Runs with same input features, threshold, mosaics, backend and tiling share one checkpoint
+    Checkpoints are kept in the scratch folder until the run finished
+    :param in_features: string
+    :param tcd_threshold: integer or list of integers
+    :param lossyear_mosaic: string
+    :param tcd_mosaic: string
+    :param value_mosaic: string or list of strings
+    :param backend: string
+    :return: Checkpoint
+    """
+    desc = arcpy.Describe(in_features)
+    row_count = int(arcpy.GetCount_management(in_features).getOutput(0))
+
+    # Pixel area is computed from the lossyear grid, the lossyear source identifies it as well
+    sources = [source_key(mosaic) for mosaic in [lossyear_mosaic, tcd_mosaic] + zonal.value_list(value_mosaic)]
+
+    # Labelled backend records completed tiles instead of completed features, tiles depend on the tile size
+    key = checkpoint.checkpoint_key(desc.catalogPath, row_count, tcd_threshold, "|".join(sources), backend,
+                                    TILE_SIZE, MAX_TILE_BYTES)
+    path = os.path.join(arcpy.env.scratchFolder, "checkpoints", "{}.txt".format(key))
+
+    return checkpoint.Checkpoint(path, key)
+
+
+def area_source(lossyear_mosaic, area_mosaic, backend, messages):
+    """
+    Pixel area of the numpy backends is computed from the lossyear grid if lossyear mosaic is in WGS84 coordinates.
+    This saves reading the area mosaic. Arcpy backend always uses the area mosaic
+    :param lossyear_mosaic: string
+    :param area_mosaic: string
+    :param backend: string
+    :param messages: object
+    :return: string (area mosaic or raster_io.PIXEL_AREA)
+    """
+    if backend not in ("numpy", "numpy_labelled"):
+        return area_mosaic
+
+    spatial_reference = arcpy.Describe(lossyear_mosaic).spatialReference
+    if spatial_reference.type == "Geographic" and spatial_reference.GCS.datumName == "D_WGS_1984":
+        messages.AddMessage("Compute pixel area from lossyear grid")
+        return raster_io.PIXEL_AREA
+
+    if not arcpy.Exists(area_mosaic):
+        raise Exception("Area mosaic required if lossyear mosaic is not in WGS84 coordinates")
+    return area_mosaic
+
+
+def loss_stats(in_features, tcd_thresholds, lossyear_mosaic, tcd_mosaic, value_mosaics, merge_table, backend, workers,
+               messages):
+    """
+    Calculate zonal stats of value mosaics per lossyear for every TCD threshold.
+    The numpy backends compute all thresholds and value mosaics in a single pass over the lossyear and TCD mosaic.
+    The arcpy backend runs zonal statistics once per threshold and value mosaic.
+    Both mask the lossyear values while reading, mosaic datasets stay unchanged and concurrent runs can share them
+    :param in_features: string
+    :param tcd_thresholds: list of integers
+    :param lossyear_mosaic: string
+    :param tcd_mosaic: string
+    :param value_mosaics: list of strings
+    :param merge_table: string or None
+    :param backend: string
+    :param workers: integer
+    :param messages: object
+    :return: tuple (list of numpy.ndarray (FID, TCD, VALUE, SUM), one per value mosaic, list of Checkpoints)
+    """
+    thresholds = sorted(set(tcd_thresholds))
+
+    if backend in ("numpy", "numpy_labelled"):
+        # Resume previous run with same inputs if it did not finish
+        run_checkpoint = open_checkpoint(in_features, thresholds, lossyear_mosaic, tcd_mosaic, value_mosaics, backend)
+
+        # Calculating annual loss for every input feature and threshold
+        records = zonal_stats(lossyear_mosaic, value_mosaics, tcd_mosaic, thresholds, in_features, merge_table,
+                              backend, workers, run_checkpoint, messages)
+        results = [zonal.split_thresholds(split, thresholds)
+                   for split in zonal.split_values(records, len(value_mosaics))]
+        return results, [run_checkpoint]
+
+    # Previous versions of this tool applied the mask as raster function to the lossyear mosaic.
+    # The arcpy backend reads the mosaic through its raster functions, remove the mask if one is recorded.
+    # Mosaics without or with an unknown raster function are not edited
+    if raster_function.applied_raster_function(lossyear_mosaic):
+        raster_function.remove_raster_functions(lossyear_mosaic, messages)
+
+    results = [list() for value_mosaic in value_mosaics]
+    checkpoints = list()
+    for tcd_threshold in thresholds:
+        messages.AddMessage("TCD threshold {}".format(tcd_threshold))
+
+        for i, value_mosaic in enumerate(value_mosaics):
+            # Resume previous run with same inputs if it did not finish
+            run_checkpoint = open_checkpoint(in_features, tcd_threshold, lossyear_mosaic, tcd_mosaic, value_mosaic,
+                                             backend)
+            checkpoints.append(run_checkpoint)
+
+            # Keep a separate merge table per threshold and value mosaic
+            run_merge_table = merge_table
+            if merge_table is not None and len(thresholds) * len(value_mosaics) > 1:
+                # Suffix goes before the extension of .dbf or .csv tables
+                base, extension = os.path.splitext(merge_table)
+                run_merge_table = "{}_{}_{}{}".format(base, tcd_threshold, os.path.basename(value_mosaic), extension)
+
+            # Calculating annual loss for every input feature
+            records = zonal_stats(lossyear_mosaic, value_mosaic, tcd_mosaic, [tcd_threshold], in_features,
+                                  run_merge_table, backend, workers, run_checkpoint, messages)
+            results[i].append(zonal.add_threshold(records, tcd_threshold))
+
+    return [np.concatenate(value_results) for value_results in results], checkpoints
+
+
+def tc_loss(in_features, tcd_thresholds, mosaic_workspace, out_table, pivot, merge_table, backend, workers, messages):
     '''
     Calculate tree cover loss for input features
     :param in_features: string
-    :param tcd_threshold: integer
+    :param tcd_thresholds: list of integers
     :param mosaic_workspace: string
     :param out_table: string
     :param pivot: boolean
-    :param merge_table: string
-    :param max_temp: integer
+    :param merge_table: string or None
+    :param backend: string
+    :param workers: integer
     :param messages: object
     :return:
     '''
@@ -238,69 +716,46 @@ def tc_loss(in_features, tcd_threshold, mosaic_workspace, out_table, pivot, merg
     area_mosaic = os.path.join(mosaic_workspace, "area")
     tcd_mosaic = os.path.join(mosaic_workspace, "tcd")
 
-    # Mask loss year using the TCD threshold
-    mask_lossyear(lossyear_mosaic, tcd_mosaic, tcd_threshold, messages)
-
-    # Calculating annual loss for every input feature
-    zonal_stats_table = zonal_stats(lossyear_mosaic, area_mosaic, in_features, merge_table, max_temp, messages)
-
-    # If final output is a pivot table write format table into a temp file,
-    # IF not create directly output table
-    if pivot:
-        format_table = "in_memory/format_table"
-    else:
-        format_table = out_table
-
-    # Create final output table and define fields
-    arcpy.CreateTable_management (os.path.dirname(format_table), os.path.basename(format_table))
-    arcpy.AddField_management(format_table, "FID", "LONG")
-    arcpy.AddField_management(format_table, "YEAR", "TEXT")
-    arcpy.AddField_management(format_table, "TCD", "LONG")
-    arcpy.AddField_management(format_table, "LOSS_HA", "DOUBLE")
-
-    # Select relevant fields from merged table
-    cursor = arcpy.da.SearchCursor(zonal_stats_table, ["FID", "VALUE", "SUM"], sql_clause=(None, "ORDER BY FID DESC"))
-
-    # Create Insert cursor for output table
-    newrows = arcpy.InsertCursor(format_table)
+    # Area mosaic is optional for numpy backends
+    area = area_source(lossyear_mosaic, area_mosaic, backend, messages)
 
-    # Loop over all rows in merge table and write results into output table
-    for row in cursor:
-        newrow = newrows.newRow()
-        newrow.setValue("FID", row[0])
-        if row[1] == -1:
-            newrow.setValue("YEAR", "area outside threshold")
-        elif row[1] == 0:
-            newrow.setValue("YEAR", "no loss")
-        else:
-            newrow.setValue("YEAR", "Year {}".format(2000 + row[1]))
-        newrow.setValue("TCD", tcd_threshold)
-        newrow.setValue("LOSS_HA", row[2]/10000)
-        newrows.insertRow(newrow)
+    # Calculating annual loss for every input feature and threshold
+    (results,), checkpoints = loss_stats(in_features, tcd_thresholds, lossyear_mosaic, tcd_mosaic, [area],
+                                         merge_table, backend, workers, messages)
 
     if pivot:
         # Flatten table.
         # One line per feature, with seperate columns for each year
-        messages.AddMessage("Flatten table".format(out_table))
-        arcpy.PivotTable_management(format_table, "FID;TCD", "YEAR", "LOSS_HA", out_table)
+        messages.AddMessage("Flatten table")
+        last_year = last_loss_year(lossyear_mosaic, results)
+        create_table(tables.pivot_loss(results, last_year), out_table)
+    else:
+        # Create final output table with YEAR labels and loss in ha
+        create_table(tables.format_loss(results), out_table)
 
     # Delete all in_memory datasets
-    clean_up([lossyear_mosaic], messages)
+    clean_up(messages)
+
+    # Run finished, no need to resume
+    for run_checkpoint in checkpoints:
+        run_checkpoint.remove()
 
     return
 
 
-def biomass_loss(in_features, tcd_threshold, mosaic_workspace, out_table, pivot, unit, merge_table, max_temp, messages):
+def biomass_loss(in_features, tcd_thresholds, mosaic_workspace, out_table, pivot, unit, merge_table, backend, workers,
+                 messages):
     '''
     Calculate biomass loss for input features
     :param in_features: string
-    :param tcd_threshold: integer
+    :param tcd_thresholds: list of integers
     :param mosaic_workspace: string
     :param out_table: string
     :param pivot: boolean
     :param unit: string
-    :param merge_table: string
-    :param max_temp: integer
+    :param merge_table: string or None
+    :param backend: string
+    :param workers: integer
     :param messages: object
     :return:
     '''
@@ -319,59 +774,21 @@ def biomass_loss(in_features, tcd_threshold, mosaic_workspace, out_table, pivot,
     # Convert biomass per hectare to biomass per pixel
     # convert_biomass(biomass_mosaic, area_mosaic, messages)
 
-    # Mask loss year using the TCD threshold. set all values outside threshold to -1
-    mask_lossyear(lossyear_mosaic, tcd_mosaic, tcd_threshold, messages)
-
-    # Calculating annual loss for every input feature
-    zonal_stats_table = zonal_stats(lossyear_mosaic, biomass_mosaic, in_features, merge_table, max_temp, messages)
-
-    # If final output is a pivot table write format table into a temp file,
-    # IF not create directly output table
-    if pivot:
-        format_table = "in_memory/format_table"
-    else:
-        format_table = out_table
-    # Create final output table and define fields
-    arcpy.CreateTable_management (os.path.dirname(format_table), os.path.basename(format_table))
-    arcpy.AddField_management(format_table, "FID", "LONG")
-    arcpy.AddField_management(format_table, "YEAR", "TEXT")
-    arcpy.AddField_management(format_table, "TCD", "LONG")
-    arcpy.AddField_management(format_table, "BIOMASS_LOSS_MG", "DOUBLE")
-    arcpy.AddField_management(format_table, "EMISSIONS_MT_CO2", "DOUBLE")
-
-    # Select relevant fields from merged table
-    cursor = arcpy.da.SearchCursor(zonal_stats_table, ["FID", "VALUE", "SUM"], sql_clause=(None, "ORDER BY FID DESC"))
-
-    # Create Insert cursor for output table
-    newrows = arcpy.InsertCursor(format_table)
-
-    # Loop over all rows in merge table and write results into output table
-    for row in cursor:
-        newrow = newrows.newRow()
-        newrow.setValue("FID", row[0])
-        if row[1] == -1:
-            newrow.setValue("YEAR", "biomass outside threshold")
-        elif row[1] == 0:
-            newrow.setValue("YEAR", "no biomass loss")
-        else:
-            newrow.setValue("YEAR", "Year {}".format(2000 + row[1]))
-        newrow.setValue("TCD", tcd_threshold)
-        newrow.setValue("BIOMASS_LOSS_MG", row[2])
-        newrow.setValue("EMISSIONS_MT_CO2", row[2]*.5*3.67/1000000)
-        newrows.insertRow(newrow)
+    # Calculating annual loss for every input feature and threshold
+    (results,), checkpoints = loss_stats(in_features, tcd_thresholds, lossyear_mosaic, tcd_mosaic, [biomass_mosaic],
+                                         merge_table, backend, workers, messages)
 
     if pivot:
         # Flatten table.
         # One line per feature, with seperate columns for each year
-        messages.AddMessage("Flatten table".format(out_table))
-        if unit == "Mg biomass":
-            value_column = "BIOMASS_LOSS_MG"
-        else:
-            value_column = "EMISSIONS_MT_CO2"
-        arcpy.PivotTable_management(format_table, "FID;TCD", "YEAR", value_column, out_table)
+        messages.AddMessage("Flatten table")
+        last_year = last_loss_year(lossyear_mosaic, results)
+        create_table(tables.pivot_biomass_loss(results, last_year, unit), out_table)
+    else:
+        # Create final output table with YEAR labels, biomass loss and emissions
+        create_table(tables.format_biomass_loss(results), out_table)
 
     # Delete all in_memory datasets
-    # Remove all raster functions
 
     # TODO: Remove raster function from biomass layer
     # I wasn't able to remove the biomass raster functions using this approach. Not sure why?! It works for the lossyear.
@@ -379,17 +796,72 @@ def biomass_loss(in_features, tcd_threshold, mosaic_workspace, out_table, pivot,
     # I add it directly during the creation of the mosaic dataset and keep it there.
     # This has the disadvantage that it always shows up. If the user replaces it or results form this tool will be wrong.
 
-    clean_up([lossyear_mosaic], messages)
+    clean_up(messages)
+
+    # Run finished, no need to resume
+    for run_checkpoint in checkpoints:
+        run_checkpoint.remove()
 
     return
 
+def tc_biomass_loss(in_features, tcd_thresholds, mosaic_workspace, out_table, pivot, merge_table, backend, workers,
+                    messages):
+    '''
+    Calculate tree cover loss, biomass loss and emissions for input features in one run.
+    With the numpy backends lossyear and TCD mosaic are read only once for all results
+    :param in_features: string
+    :param tcd_thresholds: list of integers
+    :param mosaic_workspace: string
+    :param out_table: string
+    :param pivot: boolean
+    :param merge_table: string or None
+    :param backend: string
+    :param workers: integer
+    :param messages: object
+    :return:
+    '''
+
+    # Define mosaic layers
+    lossyear_mosaic = os.path.join(mosaic_workspace, "lossyear")
+    area_mosaic = os.path.join(mosaic_workspace, "area")
+    biomass_mosaic = os.path.join(mosaic_workspace, "biomass")
+    tcd_mosaic = os.path.join(mosaic_workspace, "tcd")
+
+    # Area mosaic is optional for numpy backends
+    area = area_source(lossyear_mosaic, area_mosaic, backend, messages)
+
+    # Calculating annual loss and biomass loss for every input feature and threshold
+    (area, biomass), checkpoints = loss_stats(in_features, tcd_thresholds, lossyear_mosaic, tcd_mosaic,
+                                              [area, biomass_mosaic], merge_table, backend, workers, messages)
+    results = zonal.join_sums([area, biomass], ["AREA", "BIOMASS"])
+
+    if pivot:
+        # Flatten table.
+        # One line per feature, with seperate columns for each year and value
+        messages.AddMessage("Flatten table")
+        last_year = last_loss_year(lossyear_mosaic, results)
+        create_table(tables.pivot_combined_loss(results, last_year), out_table)
+    else:
+        # Create final output table with YEAR labels, loss, biomass loss and emissions
+        create_table(tables.format_combined_loss(results), out_table)
+
+    # Delete all in_memory datasets
+    clean_up(messages)
+
+    # Run finished, no need to resume
+    for run_checkpoint in checkpoints:
+        run_checkpoint.remove()
+
+    return
+
+
 if __name__ == "__main__":
     arcpy.CheckOutExtension("Spatial")
     arcpy.env.overwriteOutput = True
     m = util.messages()
 
     biomass_loss(r"C:\Users\Thomas.Maschler\Documents\Atlas\CMR\atlas_forestier.mdb\unites_administratives\departements",
-                 30,
+                 [30],
                  r"C:\Users\Thomas.Maschler\Desktop\gabon\analysis.gdb",
                  r"C:\Users\Thomas.Maschler\Desktop\gabon\analysis.gdb\dep",
-                 True, m)
+                 True, "Mg biomass", None, "arcpy", 1, m)
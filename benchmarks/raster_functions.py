@@ -0,0 +1,246 @@
+'''
+Benchmark updatePixels of the python raster functions against their previous implementation.
+Runs without arcpy, blocks are filled with random values in the range of the real data.
+Usage: python benchmarks/raster_functions.py
+'''
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import raster_io
+from BiomassConversion import BiomassConversion
+from LossYearMask import LossYearMask
+
+BLOCK_SIZES = [512, 4096]
+TCD_THRESHOLD = 30
+TCD_THRESHOLDS = [10, 15, 20, 25, 30, 50, 75]
+
+
+def legacy_lossyear_mask(tcd_threshold, props, **pixelBlocks):
+    """
+    LossYearMask.updatePixels before it was fused into a single output buffer
+    (np.asarray is the same as np.array(copy=False) of numpy 1.x)
+    """
+    lossyear = np.asarray(pixelBlocks['lossyear_pixels'], dtype='i1')
+    tcd = np.asarray(pixelBlocks['tcd_pixels'], dtype='i1')
+    np.place(lossyear, tcd <= tcd_threshold, [-1])
+    pixelBlocks['output_pixels'] = lossyear.astype(props['pixelType'], copy=False)
+    return pixelBlocks
+
+
+def lut_lossyear_mask(tcd_lut, props, **pixelBlocks):
+    """
+    Lossyear mask with TCD looked up in a 256 entry boolean table instead of compared with the threshold
+    """
+    lossyear = np.asarray(pixelBlocks['lossyear_pixels'])
+    mask = tcd_lut.take(pixelBlocks['tcd_pixels'], mode='clip')
+    output = np.add(lossyear, 1, dtype=props['pixelType'])
+    np.multiply(output, mask, out=output)
+    np.subtract(output, 1, out=output)
+    pixelBlocks['output_pixels'] = output
+    return pixelBlocks
+
+
+def combined_lut_lossyear_mask(code_lut, props, **pixelBlocks):
+    """
+    Lossyear mask looked up directly in a 256x256 table, flattened to lossyear * 256 + TCD
+    """
+    index = np.left_shift(pixelBlocks['lossyear_pixels'], 8, dtype='u2')
+    np.bitwise_or(index, pixelBlocks['tcd_pixels'], out=index)
+    pixelBlocks['output_pixels'] = code_lut.take(index, mode='clip').astype(props['pixelType'], copy=False)
+    return pixelBlocks
+
+
+def legacy_biomass_conversion(props, **pixelBlocks):
+    """
+    BiomassConversion.updatePixels with float temporaries
+    """
+    biomass = np.asarray(pixelBlocks['biomass_pixels'], dtype='f4')
+    area = np.asarray(pixelBlocks['area_pixels'], dtype='f4')
+    outBlock = biomass * area/10000
+    pixelBlocks['output_pixels'] = outBlock.astype(props['pixelType'], copy=False)
+    return pixelBlocks
+
+
+def lossyear_blocks(size):
+    """
+    Random lossyear (0-16) and tcd (0-100) blocks
+    :param size: integer
+    :return: dict
+    """
+    rng = np.random.RandomState(0)
+    return {'lossyear_pixels': rng.randint(0, 17, (1, size, size)).astype('u1'),
+            'tcd_pixels': rng.randint(0, 101, (1, size, size)).astype('u1')}
+
+
+def biomass_blocks(size):
+    """
+    Random biomass (0-500 Mg/ha) and pixel area (~700-900 m2) blocks
+    :param size: integer
+    :return: dict
+    """
+    rng = np.random.RandomState(0)
+    return {'biomass_pixels': (rng.rand(1, size, size) * 500).astype('f4'),
+            'area_pixels': (700 + rng.rand(1, size, size) * 200).astype('f4')}
+
+
+def best_time(function, repeat):
+    """
+    Best wall time of a function call in seconds
+    :param function: callable
+    :param repeat: integer
+    :return: float
+    """
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def report(name, size, legacy, current):
+    print("{:<34} {:>5}x{:<5} legacy {:8.2f} ms   current {:8.2f} ms   speedup {:5.2f}x".format(
+        name, size, size, legacy * 1000, current * 1000, legacy / current))
+
+
+def bench_lossyear_mask(size, repeat):
+    blocks = lossyear_blocks(size)
+    props = {'pixelType': 'i2'}
+
+    function = LossYearMask()
+    function.updateRasterInfo(tcd_threshold=TCD_THRESHOLD, output_info={})
+
+    # Both implementations must return the same pixels
+    expected = legacy_lossyear_mask(TCD_THRESHOLD, props, **dict((k, v.copy()) for k, v in blocks.items()))
+    result = function.updatePixels(None, None, props, **blocks)
+    assert np.array_equal(expected['output_pixels'], result['output_pixels'])
+
+    # Legacy version modifies its input in place, use fresh copies
+    legacy = best_time(lambda: legacy_lossyear_mask(TCD_THRESHOLD, props,
+                                                    **dict((k, v.copy()) for k, v in blocks.items())), repeat)
+    copies = best_time(lambda: dict((k, v.copy()) for k, v in blocks.items()), repeat)
+    current = best_time(lambda: function.updatePixels(None, None, props, **blocks), repeat)
+
+    report("LossYearMask", size, legacy - copies, current)
+
+
+def bench_lossyear_mask_bands(size, repeat):
+    """
+    One multi band function call compared to one single band function per threshold
+    """
+    blocks = lossyear_blocks(size)
+    props = {'pixelType': 'i2'}
+
+    single = list()
+    for threshold in TCD_THRESHOLDS:
+        function = LossYearMask()
+        function.updateRasterInfo(tcd_threshold=threshold, output_info={})
+        single.append(function)
+
+    multi = LossYearMask()
+    multi.updateRasterInfo(tcd_threshold=TCD_THRESHOLD, tcd_thresholds=",".join(map(str, TCD_THRESHOLDS)),
+                           output_info={})
+
+    bands = multi.updatePixels(None, None, props, **blocks)['output_pixels']
+    for band, function in zip(bands, single):
+        assert np.array_equal(band, function.updatePixels(None, None, props, **blocks)['output_pixels'][0])
+
+    legacy = best_time(lambda: [function.updatePixels(None, None, props, **blocks) for function in single], repeat)
+    current = best_time(lambda: multi.updatePixels(None, None, props, **blocks), repeat)
+
+    report("LossYearMask ({} bands)".format(len(TCD_THRESHOLDS)), size, legacy, current)
+
+
+def bench_lossyear_mask_lut(size, repeat):
+    """
+    Lookup tables built from the threshold compared to the comparison of LossYearMask
+    """
+    blocks = lossyear_blocks(size)
+    props = {'pixelType': 'i2'}
+
+    function = LossYearMask()
+    function.updateRasterInfo(tcd_threshold=TCD_THRESHOLD, output_info={})
+    current = best_time(lambda: function.updatePixels(None, None, props, **blocks), repeat)
+    expected = function.updatePixels(None, None, props, **blocks)['output_pixels'].copy()
+
+    # TCD is uint8, all possible values are known in advance
+    tcd_lut = np.arange(256) > TCD_THRESHOLD
+    code_lut = np.where(tcd_lut[np.newaxis, :], np.arange(256)[:, np.newaxis], -1).astype('i2').ravel()
+
+    for name, mask, lut in [("lut", lut_lossyear_mask, tcd_lut),
+                            ("combined lut", combined_lut_lossyear_mask, code_lut)]:
+        assert np.array_equal(mask(lut, props, **blocks)['output_pixels'], expected)
+        lookup = best_time(lambda: mask(lut, props, **blocks), repeat)
+        print("{:<34} {:>5}x{:<5} lookup {:8.2f} ms   compare {:8.2f} ms   lookup {:5.2f}x slower".format(
+            "LossYearMask ({})".format(name), size, size, lookup * 1000, current * 1000, lookup / current))
+
+
+def bench_biomass_conversion(size, repeat):
+    blocks = biomass_blocks(size)
+    props = {'pixelType': 'f4'}
+
+    function = BiomassConversion()
+    function.updateRasterInfo(output_info={})
+
+    expected = legacy_biomass_conversion(props, **blocks)['output_pixels']
+    result = function.updatePixels(None, None, props, **blocks)['output_pixels']
+    assert np.allclose(expected, result, rtol=1e-5)
+
+    legacy = best_time(lambda: legacy_biomass_conversion(props, **blocks), repeat)
+    current = best_time(lambda: function.updatePixels(None, None, props, **blocks), repeat)
+
+    report("BiomassConversion", size, legacy, current)
+
+
+def bench_biomass_conversion_computed_area(size, repeat):
+    """
+    Pixel area computed per row compared to the legacy version reading an area raster with the same values
+    """
+    blocks = biomass_blocks(size)
+    cell_size = 0.00025
+    tlc = (10.0, 5.0)
+    props = {'pixelType': 'f4', 'cellSize': (cell_size, cell_size)}
+
+    rows = raster_io.row_areas(tlc[1], cell_size, cell_size, size)
+    blocks['area_pixels'] = np.repeat(rows[:, np.newaxis], size, axis=1).astype('f4')[np.newaxis]
+    computed = {'biomass_pixels': blocks['biomass_pixels']}
+
+    function = BiomassConversion()
+    function.updateRasterInfo(output_info={})
+
+    expected = legacy_biomass_conversion(props, **blocks)['output_pixels']
+    result = function.updatePixels(tlc, None, props, **computed)['output_pixels']
+    assert np.allclose(expected, result, rtol=1e-5)
+
+    legacy = best_time(lambda: legacy_biomass_conversion(props, **blocks), repeat)
+    current = best_time(lambda: function.updatePixels(tlc, None, props, **computed), repeat)
+
+    report("BiomassConversion (computed area)", size, legacy, current)
+
+
+def biomass_precision(size):
+    """
+    Relative error of the total biomass of a block of f4 output pixels, summed up in f4 or f8.
+    Zonal sums (bincount) accumulate in f8, f4 output pixels are precise enough
+    """
+    blocks = biomass_blocks(size)
+    exact = (blocks['biomass_pixels'].astype('f8') * blocks['area_pixels'] / 10000).sum()
+
+    function = BiomassConversion()
+    function.updateRasterInfo(output_info={})
+    pixels = function.updatePixels(None, None, {'pixelType': 'f4'}, **blocks)['output_pixels']
+    for accumulator in ['f4', 'f8']:
+        total = np.cumsum(pixels.ravel(), dtype=accumulator)[-1]
+        print("{:<34} {:>5}x{:<5} relative error of total {:.2e}".format(
+            "BiomassConversion ({} sum)".format(accumulator), size, size, abs(total - exact) / exact))
+
+
+if __name__ == "__main__":
+    for block_size in BLOCK_SIZES:
+        bench_lossyear_mask(block_size, 20 if block_size <= 1024 else 3)
+        bench_lossyear_mask_bands(block_size, 20 if block_size <= 1024 else 3)
+        bench_lossyear_mask_lut(block_size, 20 if block_size <= 1024 else 3)
+        bench_biomass_conversion(block_size, 20 if block_size <= 1024 else 3)
+        bench_biomass_conversion_computed_area(block_size, 20 if block_size <= 1024 else 3)
+        biomass_precision(block_size)
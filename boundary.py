@@ -0,0 +1,161 @@
+import numpy as np
+
+# Number of cells of the coarse boundary grid along each axis
+GRID_SIZE = 512
+
+# Cell and feature states
+OUTSIDE = 0
+INSIDE = 1
+EDGE = 2
+
+
+def ring_edges(rings):
+    """
+    Start and end coordinates of all edges of a polygon
+    :param rings: list of numpy.ndarray (n, 2) with x/y coordinates, exterior and interior rings
+    :return: tuple of numpy.ndarray (x0, y0, x1, y1)
+    """
+    starts = np.concatenate(rings)
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    return starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1]
+
+
+class BoundaryIndex(object):
+    '''
+    Coarse grid over the bounding box of a boundary polygon (i.e. a mosaic footprint).
+    Every cell is inside, outside or on the edge of the polygon.
+    Features whose bounding box covers only inside cells are within the boundary,
+    features which cover only outside cells are not. Only the remaining features need an exact geometry test
+    '''
+
+    def __init__(self, rings, grid_size=GRID_SIZE):
+        rings = [ring for ring in rings if len(ring) > 2]
+        self.empty = len(rings) == 0
+        if self.empty:
+            return
+
+        coords = np.concatenate(rings)
+        self.x_min, self.y_min = coords.min(axis=0)
+        self.x_max, self.y_max = coords.max(axis=0)
+
+        self.cols = self.rows = grid_size
+        self.cell_width = max(self.x_max - self.x_min, 1e-9) / self.cols
+        self.cell_height = max(self.y_max - self.y_min, 1e-9) / self.rows
+
+        x0, y0, x1, y1 = ring_edges(rings)
+        edge = self._edge_cells(x0, y0, x1, y1)
+        inside = self._inside_cells(x0, y0, x1, y1) & ~edge
+
+        # Summed area tables, number of inside/outside cells of any cell range in constant time
+        self.inside = self._summed_area(inside)
+        self.outside = self._summed_area(~inside & ~edge)
+
+    def _col(self, x):
+        return np.clip(np.floor((x - self.x_min) / self.cell_width), 0, self.cols - 1).astype(np.int64)
+
+    def _row(self, y):
+        return np.clip(np.floor((self.y_max - y) / self.cell_height), 0, self.rows - 1).astype(np.int64)
+
+    def _edge_cells(self, x0, y0, x1, y1):
+        """
+        Cells crossed by polygon edges. Edges are split into pieces not longer than a cell,
+        every piece marks the (at most 2x2) cells of its bounding box
+        :return: numpy.ndarray (boolean)
+        """
+        pieces = np.maximum(np.ceil(np.maximum(np.abs(x1 - x0) / self.cell_width,
+                                               np.abs(y1 - y0) / self.cell_height)), 1).astype(np.int64)
+        edge = np.repeat(np.arange(len(x0)), pieces)
+        step = np.arange(len(edge)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        t0 = step / pieces[edge].astype('f8')
+        t1 = (step + 1) / pieces[edge].astype('f8')
+
+        dx = (x1 - x0)[edge]
+        dy = (y1 - y0)[edge]
+        px0 = x0[edge] + dx * t0
+        px1 = x0[edge] + dx * t1
+        py0 = y0[edge] + dy * t0
+        py1 = y0[edge] + dy * t1
+
+        col_lo = self._col(np.minimum(px0, px1))
+        col_hi = self._col(np.maximum(px0, px1))
+        row_lo = self._row(np.maximum(py0, py1))
+        row_hi = self._row(np.minimum(py0, py1))
+
+        cells = np.zeros((self.rows, self.cols), dtype=bool)
+        cells[row_lo, col_lo] = True
+        cells[row_lo, col_hi] = True
+        cells[row_hi, col_lo] = True
+        cells[row_hi, col_hi] = True
+        return cells
+
+    def _inside_cells(self, x0, y0, x1, y1):
+        """
+        Cells whose center is inside the polygon (even-odd rule)
+        :return: numpy.ndarray (boolean)
+        """
+        xs = self.x_min + (np.arange(self.cols) + 0.5) * self.cell_width
+
+        # Horizontal edges never cross a row of cell centers
+        sloped = y0 != y1
+        x0, y0, x1, y1 = x0[sloped], y0[sloped], x1[sloped], y1[sloped]
+
+        cells = np.zeros((self.rows, self.cols), dtype=bool)
+        for row in range(self.rows):
+            y = self.y_max - (row + 0.5) * self.cell_height
+            crosses = (y0 > y) != (y1 > y)
+            x_cross = np.sort(x0[crosses] + (y - y0[crosses]) * (x1[crosses] - x0[crosses]) /
+                              (y1[crosses] - y0[crosses]))
+            # Centers with an odd number of crossings to their left are inside
+            cells[row] = np.searchsorted(x_cross, xs) % 2 == 1
+        return cells
+
+    @staticmethod
+    def _summed_area(cells):
+        table = np.zeros((cells.shape[0] + 1, cells.shape[1] + 1), dtype=np.int64)
+        table[1:, 1:] = cells.cumsum(axis=0).cumsum(axis=1)
+        return table
+
+    def classify(self, bounds):
+        """
+        State of features with respect to the boundary, based on their bounding boxes only
+        :param bounds: numpy.ndarray (n, 4) with x_min, y_min, x_max, y_max
+        :return: numpy.ndarray, INSIDE, OUTSIDE or EDGE (exact test required)
+        """
+        bounds = np.asarray(bounds, dtype='f8').reshape(-1, 4)
+        x_min, y_min, x_max, y_max = bounds.T
+
+        if self.empty:
+            return np.zeros(len(bounds), dtype='i1') + OUTSIDE
+
+        # Features which reach beyond bounding box of boundary can't be within it
+        in_grid = (x_min >= self.x_min) & (x_max <= self.x_max) & (y_min >= self.y_min) & (y_max <= self.y_max)
+
+        col_lo = self._col(x_min)
+        col_hi = self._col(x_max) + 1
+        row_lo = self._row(y_max)
+        row_hi = self._row(y_min) + 1
+        cells = (col_hi - col_lo) * (row_hi - row_lo)
+
+        inside = (self.inside[row_hi, col_hi] - self.inside[row_lo, col_hi] -
+                  self.inside[row_hi, col_lo] + self.inside[row_lo, col_lo])
+        outside = (self.outside[row_hi, col_hi] - self.outside[row_lo, col_hi] -
+                   self.outside[row_hi, col_lo] + self.outside[row_lo, col_lo])
+
+        states = np.zeros(len(bounds), dtype='i1') + EDGE
+        states[inside == cells] = INSIDE
+        states[(outside == cells) | ~in_grid] = OUTSIDE
+        return states
+
+
+def classify(indexes, bounds):
+    """
+    States of features with respect to several boundaries
+    :param indexes: list of BoundaryIndex
+    :param bounds: numpy.ndarray (n, 4) with x_min, y_min, x_max, y_max
+    :return: numpy.ndarray (n, number of boundaries)
+    """
+    bounds = np.asarray(bounds, dtype='f8').reshape(-1, 4)
+    states = np.zeros((len(bounds), len(indexes)), dtype='i1')
+    for i, index in enumerate(indexes):
+        states[:, i] = index.classify(bounds)
+    return states
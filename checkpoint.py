@@ -0,0 +1,134 @@
+import hashlib
+import os
+import numpy as np
+
+import zonal
+
+HEADER = "gfw-analysis checkpoint"
+
+
+def checkpoint_key(*parts):
+    """
+    Create key which identifies a run by its inputs
+    :param parts: strings or numbers
+    :return: string
+    """
+    return hashlib.sha1("|".join([str(part) for part in parts]).encode("utf-8")).hexdigest()
+
+
+class Checkpoint(object):
+    '''
+    Append-only file which records completed features (or tiles) and their results.
+    Every write is a batch of result rows followed by the completed units and a commit line.
+    Batches without commit line (i.e. after a crash during a write) are ignored when the file is loaded
+    '''
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.features = set()
+        self.tiles = set()
+        self._records = list()
+
+        if os.path.exists(path) and self._load():
+            self.file = open(path, "ab")
+        else:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.file = open(path, "wb")
+            self.file.write("{} {}\n".format(HEADER, key).encode("ascii"))
+            self.file.flush()
+
+    def _load(self):
+        """
+        Read committed batches from existing checkpoint file
+        and cut off any uncommitted batch at the end of the file
+        :return: boolean, False if file belongs to a different run
+        """
+        with open(self.path, "rb") as f:
+            data = f.read().decode("ascii")
+
+        lines = data.split("\n")
+        if lines[0].strip() != "{} {}".format(HEADER, self.key):
+            return False
+
+        rows = list()
+        features = set()
+        tiles = set()
+        committed = len(lines[0]) + 1
+        position = committed
+        for line in lines[1:-1]:
+            position += len(line) + 1
+            fields = line.split()
+            if fields[0] == "R":
+                rows.append((int(fields[1]), int(fields[2]), float(fields[3])))
+            elif fields[0] == "F":
+                features.add(int(fields[1]))
+            elif fields[0] == "T":
+                tiles.add((int(fields[1]), int(fields[2])))
+            elif fields[0] == "C":
+                if len(rows) > 0:
+                    self._records.append(np.array(rows, dtype=zonal.RESULT_DTYPE))
+                self.features.update(features)
+                self.tiles.update(tiles)
+                rows = list()
+                features = set()
+                tiles = set()
+                committed = position
+
+        if committed < len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(committed)
+
+        return True
+
+    @property
+    def resumed(self):
+        return len(self.features) > 0 or len(self.tiles) > 0
+
+    def records(self):
+        """
+        All committed result rows
+        :return: numpy.ndarray (RESULT_DTYPE)
+        """
+        if len(self._records) == 0:
+            return np.empty(0, dtype=zonal.RESULT_DTYPE)
+        if len(self._records) > 1:
+            self._records = [np.concatenate(self._records)]
+        return self._records[0]
+
+    def write(self, records, features=(), tiles=()):
+        """
+        Append results and mark features and/or tiles as completed
+        :param records: numpy.ndarray (RESULT_DTYPE) or None
+        :param features: list of FIDs
+        :param tiles: list of tiles (col_off, row_off, cols, rows)
+        :return:
+        """
+        lines = list()
+        if records is not None and len(records) > 0:
+            lines.extend(["R {} {} {!r}\n".format(fid, value, total) for fid, value, total in records.tolist()])
+            self._records.append(records.copy())
+        for fid in features:
+            lines.append("F {}\n".format(fid))
+            self.features.add(fid)
+        for tile in tiles:
+            lines.append("T {} {}\n".format(tile[0], tile[1]))
+            self.tiles.add((tile[0], tile[1]))
+        lines.append("C\n")
+
+        self.file.write("".join(lines).encode("ascii"))
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def remove(self):
+        """
+        Delete checkpoint once a run finished successfully
+        :return:
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
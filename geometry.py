@@ -0,0 +1,401 @@
+import json
+import os
+import re
+import sqlite3
+import struct
+import numpy as np
+
+# Well known ID of WGS84 geographic coordinates, default coordinate system of GeoJSON
+WGS84 = 4326
+
+# Feature files which can be read without arcpy
+FILE_EXTENSIONS = (".geojson", ".json", ".shp", ".gpkg")
+
+# WKB geometry types
+WKB_POLYGON = 3
+WKB_MULTIPOLYGON = 6
+
+# Shapefile shape types of polygons (2D, Z and M)
+SHP_POLYGONS = (5, 15, 25)
+
+
+class GeometryStore(object):
+    '''
+    Polygons of all features in flat NumPy arrays.
+    Coordinates of all rings are stored in one (n, 2) array. Rings, parts and features are given by offsets:
+    ring i spans coords[ring_offsets[i]:ring_offsets[i + 1]], part j spans rings part_offsets[j]:part_offsets[j + 1]
+    and feature k spans parts feature_offsets[k]:feature_offsets[k + 1].
+    Behaves like a list of (fid, rings), slicing or indexing with an array returns a new store
+    '''
+
+    def __init__(self, fids, coords, ring_offsets, part_offsets, feature_offsets, crs=None):
+        self.fids = np.asarray(fids, dtype='i4')
+        self.coords = np.asarray(coords, dtype='f8').reshape(-1, 2)
+        self.ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+        self.part_offsets = np.asarray(part_offsets, dtype=np.int64)
+        self.feature_offsets = np.asarray(feature_offsets, dtype=np.int64)
+        self.crs = crs
+        self.bounds = self._bounds()
+
+    @classmethod
+    def from_features(cls, features, crs=None):
+        """
+        Create store from polygons given as lists of parts. Every part is a list of rings (exterior ring first)
+        :param features: list of (fid, list of list of numpy.ndarray (n, 2))
+        :param crs: integer (WKID), string (WKT) or None
+        :return: GeometryStore
+        """
+        parts = [part for fid, feature_parts in features for part in feature_parts]
+        rings = [ring for part in parts for ring in part]
+
+        coords = np.concatenate(rings) if len(rings) > 0 else np.empty((0, 2), dtype='f8')
+        return cls([fid for fid, feature_parts in features],
+                   coords,
+                   np.cumsum([0] + [len(ring) for ring in rings]),
+                   np.cumsum([0] + [len(part) for part in parts]),
+                   np.cumsum([0] + [len(feature_parts) for fid, feature_parts in features]),
+                   crs)
+
+    def _bounds(self):
+        """
+        Bounding boxes of all features
+        :return: numpy.ndarray (features, 4) with x_min, y_min, x_max, y_max
+        """
+        if len(self.fids) == 0:
+            return np.empty((0, 4), dtype='f8')
+
+        # Offset of first coordinate of every feature. Features must not be empty
+        starts = self.ring_offsets[self.part_offsets[self.feature_offsets[:-1]]]
+        x = self.coords[:, 0]
+        y = self.coords[:, 1]
+        return np.column_stack([np.minimum.reduceat(x, starts), np.minimum.reduceat(y, starts),
+                                np.maximum.reduceat(x, starts), np.maximum.reduceat(y, starts)])
+
+    def __len__(self):
+        return len(self.fids)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.subset(np.arange(len(self))[index])
+        if isinstance(index, np.ndarray) or isinstance(index, list):
+            return self.subset(index)
+        return int(self.fids[index]), self.rings(index)
+
+    def rings(self, i):
+        """
+        Coordinates of all rings of a feature (exterior and interior rings of all parts)
+        :param i: integer, index of feature
+        :return: list of numpy.ndarray (n, 2), views into coords
+        """
+        ring_start = self.part_offsets[self.feature_offsets[i]]
+        ring_end = self.part_offsets[self.feature_offsets[i + 1]]
+        return [self.coords[self.ring_offsets[j]:self.ring_offsets[j + 1]] for j in range(ring_start, ring_end)]
+
+    def geojson(self, i):
+        """
+        Feature geometry as GeoJSON MultiPolygon
+        :param i: integer, index of feature
+        :return: dict
+        """
+        parts = list()
+        for part in range(self.feature_offsets[i], self.feature_offsets[i + 1]):
+            parts.append([self.coords[self.ring_offsets[j]:self.ring_offsets[j + 1]].tolist()
+                          for j in range(self.part_offsets[part], self.part_offsets[part + 1])])
+        return {"type": "MultiPolygon", "coordinates": parts}
+
+    def subset(self, index):
+        """
+        Store with selected features
+        :param index: numpy.ndarray, feature indices or boolean mask
+        :return: GeometryStore
+        """
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        index = index.astype(np.int64)
+
+        # Parts, rings and coordinates of selected features
+        parts = _ranges(self.feature_offsets[index], self.feature_offsets[index + 1])
+        rings = _ranges(self.part_offsets[parts], self.part_offsets[parts + 1])
+        coords = _ranges(self.ring_offsets[rings], self.ring_offsets[rings + 1])
+
+        return GeometryStore(self.fids[index], self.coords[coords],
+                             _offsets(self.ring_offsets[rings + 1] - self.ring_offsets[rings]),
+                             _offsets(self.part_offsets[parts + 1] - self.part_offsets[parts]),
+                             _offsets(self.feature_offsets[index + 1] - self.feature_offsets[index]),
+                             self.crs)
+
+    def transform(self, transform, crs):
+        """
+        Store with coordinates transformed into another coordinate system
+        :param transform: function (x, y) -> (x, y), see projection.transformer
+        :param crs: integer (WKID) or string (WKT) of target coordinate system
+        :return: GeometryStore
+        """
+        x, y = transform(self.coords[:, 0], self.coords[:, 1])
+        return GeometryStore(self.fids, np.column_stack([x, y]), self.ring_offsets, self.part_offsets,
+                             self.feature_offsets, crs)
+
+
+def _ranges(starts, ends):
+    """
+    Concatenated ranges start..end
+    :param starts: numpy.ndarray
+    :param ends: numpy.ndarray
+    :return: numpy.ndarray
+    """
+    lengths = ends - starts
+    if lengths.sum() == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def _offsets(lengths):
+    return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+def can_read(path):
+    """
+    Check if features can be read without arcpy
+    :param path: string
+    :return: boolean
+    """
+    return os.path.isfile(path) and os.path.splitext(path)[1].lower() in FILE_EXTENSIONS
+
+
+def read_file(path):
+    """
+    Read polygons of a GeoJSON, shapefile or GeoPackage without arcpy
+    :param path: string
+    :return: tuple (list of (fid, list of parts, empty if feature has no geometry), crs)
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".geojson", ".json"):
+        return read_geojson(path)
+    if extension == ".shp":
+        return read_shapefile(path)
+    if extension == ".gpkg":
+        return read_geopackage(path)
+    raise Exception("Unsupported feature file {}".format(path))
+
+
+def read_geojson(path):
+    """
+    Read Polygon and MultiPolygon features of a GeoJSON file.
+    Features without numeric id are numbered in file order
+    :param path: string
+    :return: tuple (list of (fid, list of parts), crs)
+    """
+    with open(path) as f:
+        data = json.load(f)
+
+    features = data["features"] if data.get("type") == "FeatureCollection" else [data]
+
+    out = list()
+    for i, feature in enumerate(features):
+        fid = feature.get("id")
+        if not isinstance(fid, int):
+            fid = i
+        out.append((fid, geojson_parts(feature.get("geometry"))))
+
+    # Pre RFC 7946 files may name another coordinate system
+    crs = WGS84
+    name = data.get("crs", {}).get("properties", {}).get("name", "")
+    match = re.search(r"EPSG:+(\d+)$", name)
+    if match and int(match.group(1)) != 4326:
+        crs = int(match.group(1))
+    return out, crs
+
+
+def geojson_parts(geometry):
+    """
+    Parts of a GeoJSON Polygon or MultiPolygon
+    :param geometry: dict or None
+    :return: list of list of numpy.ndarray (n, 2)
+    """
+    if not geometry:
+        return []
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        return []
+    parts = [[np.array(ring, dtype='f8')[:, :2] for ring in polygon if len(ring) > 2] for polygon in polygons]
+    return [part for part in parts if len(part) > 0]
+
+
+def read_shapefile(path):
+    """
+    Read polygons of a shapefile. FIDs are record numbers starting at 0, as in ArcGIS.
+    Clockwise rings start a new part, counter clockwise rings are holes of the previous part
+    :param path: string
+    :return: tuple (list of (fid, list of parts), crs)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    out = list()
+    position = 100
+    while position + 8 <= len(data):
+        number, length = struct.unpack(">ii", data[position:position + 8])
+        content = position + 8
+        position = content + length * 2
+
+        shape_type = struct.unpack("<i", data[content:content + 4])[0]
+        if shape_type not in SHP_POLYGONS:
+            out.append((number - 1, []))
+            continue
+
+        num_parts, num_points = struct.unpack("<ii", data[content + 36:content + 44])
+        starts = np.frombuffer(data, dtype='<i4', count=num_parts, offset=content + 44)
+        points = np.frombuffer(data, dtype='<f8', count=num_points * 2,
+                               offset=content + 44 + num_parts * 4).reshape(-1, 2)
+
+        parts = list()
+        for start, end in zip(starts, np.append(starts[1:], num_points)):
+            ring = points[start:end]
+            if len(ring) < 3:
+                continue
+            if signed_area(ring) < 0 or len(parts) == 0:
+                parts.append([ring])
+            else:
+                parts[-1].append(ring)
+        out.append((number - 1, parts))
+
+    return out, prj_crs(os.path.splitext(path)[0] + ".prj")
+
+
+def signed_area(ring):
+    """
+    Signed area of a ring, positive if counter clockwise
+    :param ring: numpy.ndarray (n, 2)
+    :return: float
+    """
+    x = ring[:, 0]
+    y = ring[:, 1]
+    return (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2
+
+
+def prj_crs(path):
+    """
+    Coordinate system of a shapefile
+    :param path: string, .prj file
+    :return: integer (WKID) or string (WKT), None if there is no .prj file
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        wkt = f.read().strip()
+
+    if wkt.startswith('GEOGCS["GCS_WGS_1984"'):
+        return WGS84
+    if wkt.startswith('PROJCS["WGS_1984_Web_Mercator_Auxiliary_Sphere"'):
+        return 3857
+    return wkt
+
+
+def read_geopackage(path, layer=None):
+    """
+    Read polygons of a GeoPackage feature table
+    :param path: string
+    :param layer: string, name of feature table. First feature table if not given
+    :return: tuple (list of (fid, list of parts), crs)
+    """
+    connection = sqlite3.connect(path)
+    try:
+        query = "SELECT table_name, column_name, srs_id FROM gpkg_geometry_columns"
+        tables = connection.execute(query).fetchall()
+        if layer is not None:
+            tables = [table for table in tables if table[0] == layer]
+        if len(tables) == 0:
+            raise Exception("No feature table found in {}".format(path))
+        table, column, srs_id = tables[0]
+
+        # Primary key is the feature ID
+        columns = connection.execute('PRAGMA table_info("{}")'.format(table)).fetchall()
+        fid_column = [c[1] for c in columns if c[5]][0]
+
+        out = list()
+        for fid, blob in connection.execute('SELECT "{}", "{}" FROM "{}"'.format(fid_column, column, table)):
+            out.append((fid, gpkg_parts(blob)))
+
+        crs = connection.execute("SELECT organization, organization_coordsys_id, definition "
+                                 "FROM gpkg_spatial_ref_sys WHERE srs_id = ?", (srs_id,)).fetchone()
+    finally:
+        connection.close()
+
+    if crs is None:
+        return out, None
+    if crs[0].upper() == "EPSG":
+        return out, int(crs[1])
+    return out, crs[2]
+
+
+def gpkg_parts(blob):
+    """
+    Parts of a GeoPackage geometry blob
+    :param blob: bytes or None
+    :return: list of list of numpy.ndarray (n, 2)
+    """
+    if blob is None:
+        return []
+    blob = bytes(blob)
+
+    # Header: magic, version, flags, srs id and envelope
+    flags = bytearray(blob[3:4])[0]
+    if flags & 0x10:
+        return []
+    envelope = [0, 32, 48, 48, 64][(flags >> 1) & 0x07]
+    parts, offset = wkb_parts(blob, 8 + envelope)
+    return parts
+
+
+def wkb_parts(data, offset):
+    """
+    Parse a WKB Polygon or MultiPolygon (ISO or extended WKB with Z/M)
+    :param data: bytes
+    :param offset: integer
+    :return: tuple (list of parts, offset after geometry)
+    """
+    order = "<" if bytearray(data[offset:offset + 1])[0] == 1 else ">"
+    geometry_type = struct.unpack(order + "I", data[offset + 1:offset + 5])[0]
+    offset += 5
+
+    # Extended WKB flags
+    dimensions = 2 + bool(geometry_type & 0x80000000) + bool(geometry_type & 0x40000000)
+    if geometry_type & 0x20000000:
+        offset += 4
+    geometry_type &= 0x0fffffff
+
+    # ISO WKB, 1000 Z, 2000 M, 3000 ZM
+    dimensions += [0, 1, 1, 2][(geometry_type // 1000) % 4]
+    geometry_type %= 1000
+
+    if geometry_type == WKB_MULTIPOLYGON:
+        count = struct.unpack(order + "I", data[offset:offset + 4])[0]
+        offset += 4
+        parts = list()
+        for i in range(count):
+            polygon, offset = wkb_parts(data, offset)
+            parts.extend(polygon)
+        return parts, offset
+
+    if geometry_type != WKB_POLYGON:
+        raise Exception("Unsupported WKB geometry type {}".format(geometry_type))
+
+    count = struct.unpack(order + "I", data[offset:offset + 4])[0]
+    offset += 4
+    rings = list()
+    for i in range(count):
+        points = struct.unpack(order + "I", data[offset:offset + 4])[0]
+        offset += 4
+        ring = np.frombuffer(data, dtype=order + "f8", count=points * dimensions, offset=offset)
+        offset += points * dimensions * 8
+        if points > 2:
+            rings.append(ring.reshape(-1, dimensions)[:, :2].astype('f8'))
+    return [rings] if len(rings) > 0 else [], offset
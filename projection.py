@@ -0,0 +1,82 @@
+import math
+import numpy as np
+
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+# Well known IDs of WGS84 geographic coordinates and of Web Mercator
+WGS84 = 4326
+WEB_MERCATOR = (3857, 102100, 102113, 900913)
+
+# Radius of the Web Mercator sphere in meters
+WEB_MERCATOR_RADIUS = 6378137.0
+
+# Transformations by (source, target), None if there is no vectorized transformation
+_transformers = dict()
+
+
+def identity(x, y):
+    return x, y
+
+
+def web_mercator_to_wgs84(x, y):
+    """
+    Transform Web Mercator coordinates to WGS84 longitude/latitude
+    :param x: numpy.ndarray
+    :param y: numpy.ndarray
+    :return: tuple of numpy.ndarray
+    """
+    lon = np.degrees(x / WEB_MERCATOR_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / WEB_MERCATOR_RADIUS)) - math.pi / 2)
+    return lon, lat
+
+
+def wgs84_to_web_mercator(x, y):
+    """
+    Transform WGS84 longitude/latitude to Web Mercator coordinates
+    :param x: numpy.ndarray
+    :param y: numpy.ndarray
+    :return: tuple of numpy.ndarray
+    """
+    east = np.radians(x) * WEB_MERCATOR_RADIUS
+    north = np.log(np.tan(math.pi / 4 + np.radians(y) / 2)) * WEB_MERCATOR_RADIUS
+    return east, north
+
+
+def transformer(source, target):
+    """
+    Vectorized coordinate transformation between two coordinate systems. Transformations are cached.
+    Identity and Web Mercator to/from WGS84 are computed directly, other pairs need pyproj
+    :param source: integer (WKID) or string (WKT)
+    :param target: integer (WKID) or string (WKT)
+    :return: function (x, y) -> (x, y) or None if coordinates can't be transformed without arcpy
+    """
+    key = (source, target)
+    if key not in _transformers:
+        _transformers[key] = _create_transformer(source, target)
+    return _transformers[key]
+
+
+def _create_transformer(source, target):
+    if source == target:
+        return identity
+    if source in WEB_MERCATOR and target == WGS84:
+        return web_mercator_to_wgs84
+    if source == WGS84 and target in WEB_MERCATOR:
+        return wgs84_to_web_mercator
+
+    if pyproj is not None and hasattr(pyproj, "Transformer"):
+        try:
+            return pyproj.Transformer.from_crs(_crs(source), _crs(target), always_xy=True).transform
+        except Exception:
+            return None
+    return None
+
+
+def _crs(spatial_reference):
+    if isinstance(spatial_reference, int):
+        return "EPSG:{}".format(spatial_reference)
+    return spatial_reference
+
@@ -1,122 +1,265 @@
+import copy
+import hashlib
 import os
+import tempfile
 import arcpy
 from lxml import objectify
 
+# Directory of this module, python raster functions and templates are stored relative to it
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(MODULE_DIR, "templates")
+
+# Generated raster function templates, shared by all runs of the current user
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "gfw-analysis", "raster_functions")
+
+# Table in the mosaic workspace which records the raster function applied to each mosaic dataset
+RASTER_FUNCTION_TABLE = "raster_functions"
+
+# Parsed templates, {path: (modification time, tree)}
+_templates = dict()
+
 
 def mask_lossyear_mosaic(tcd_mosaic, tcd_threshold, messages):
     """
     Create a raster function template to mask forest loss mosaic with tree cover density threshold
     This function uses the template_tcd_mask raster function template and writes results to tcd_mask.
     Value within TCD threshold will stay as it. All values outside TCD threshold will be set to -1
+    If a list of thresholds is given, the function outputs one band per threshold
     :param tcd_mosaic: String
-    :param tcd_threshold: Integer
+    :param tcd_threshold: Integer or list of Integers
     :return: String
     """
 
-    # Define path to template XML file
-    abspath = os.path.abspath(__file__)
-    dir_name = os.path.dirname(abspath)
-    template = os.path.join(dir_name, r"templates\lossyear_mask_template.rft.xml")
+    # Multi band output, one band per threshold
+    tcd_thresholds = ""
+    if isinstance(tcd_threshold, (list, tuple)):
+        tcd_thresholds = ",".join([str(threshold) for threshold in tcd_threshold])
+        tcd_threshold = tcd_threshold[0]
 
-    # Define path and name of GDB and mosaic
-    tcd_gdb = os.path.dirname(tcd_mosaic)
-    tcd_gdb_name = os.path.dirname(tcd_gdb)
-    tcd_name = os.path.basename(tcd_mosaic)
+    return cached_template("lossyear_mask_template.rft.xml", "LossYearMask.py", tcd_mosaic,
+                           {"tcd_threshold": tcd_threshold, "tcd_thresholds": tcd_thresholds})
 
-    # Read XML template into object tree
-    with open(template) as f:
-        tree = objectify.parse(f)
 
-    root = tree.getroot()
-    values = root.Arguments.Values.getchildren()
-    for value in values:
-        try:
-            if value.Name == "tcd_threshold":
-                value.Value = tcd_threshold
+def convert_biomass_mosaic(area_mosaic, messages):
+    """
+    Create a raster function template to convert biomass data from biomass per hectare to biomass per pixel.
+    Multiplies biomass layer with area values devided by 10000
+    :param area_mosaic: string
+    :return: string
+    """
+    return cached_template("biomass_conversion_template.rft.xml", "BiomassConversion.py", area_mosaic, {})
 
-            elif value.Name == "Raster2":
 
-                value.Value.WorkspaceName.PathName = tcd_gdb
-                objectify.deannotate(value.Value.WorkspaceName.PathName, cleanup_namespaces=True)
+def cached_template(template_name, module_name, mosaic, variables):
+    """
+    Path of a raster function template generated from a template in the templates folder.
+    Generated templates are cached by template, mosaic and variables and only written if they do not exist yet.
+    Files are written atomically, concurrent runs never read a partially written template
+    :param template_name: string, file name of template
+    :param module_name: string, file name of python raster function
+    :param mosaic: string, mosaic dataset assigned to Raster2
+    :param variables: dict, values of raster function variables
+    :return: string
+    """
+    template = os.path.join(TEMPLATE_DIR, template_name)
 
-                value.Value.WorkspaceName.BrowseName = tcd_gdb_name
-                objectify.deannotate(value.Value.WorkspaceName.BrowseName, cleanup_namespaces=True)
+    # Key changes if template or raster function are edited
+    key = hashlib.sha1("|".join([template, str(os.path.getmtime(template)),
+                                 os.path.join(MODULE_DIR, module_name),
+                                 os.path.dirname(mosaic), os.path.basename(mosaic)] +
+                                ["{}={}".format(name, variables[name]) for name in sorted(variables)])
+                       .encode("utf-8")).hexdigest()
 
-                value.Value.WorkspaceName.ConnectionProperties.PropertyArray.PropertySetProperty.Value = tcd_gdb
-                objectify.deannotate(value.Value.WorkspaceName.ConnectionProperties.PropertyArray.PropertySetProperty.Value, cleanup_namespaces=True)
+    path = os.path.join(CACHE_DIR, "{}_{}.rft.xml".format(template_name.split("_template")[0], key))
+    if os.path.exists(path):
+        return path
 
-                value.Value.Name = tcd_name
-                objectify.deannotate(value.Value.Name, cleanup_namespaces=True)
-                objectify.xsiannotate(value.Value.Name)
+    tree = read_template(template)
+    update_template(tree, os.path.join(MODULE_DIR, module_name), mosaic, variables)
+    write_atomic(tree, path)
+    return path
 
-        except AttributeError:
-            pass
 
-    # Write update values to a new XML file (keep template untouched)
-    mask_path = os.path.join(dir_name, r"templates\lossyear_mask.rft.xml")
-    tree.write(mask_path)
-    return mask_path
+def read_template(template):
+    """
+    Parse template XML file into object tree. Parsed templates are kept in memory
+    :param template: string
+    :return: copy of object tree
+    """
+    mtime = os.path.getmtime(template)
+    if template not in _templates or _templates[template][0] != mtime:
+        with open(template) as f:
+            _templates[template] = (mtime, objectify.parse(f))
 
+    # Callers modify the tree, never hand out the cached one
+    return copy.deepcopy(_templates[template][1])
 
-def convert_biomass_mosaic(area_mosaic, messages):
+
+def update_template(tree, module, mosaic, variables):
     """
-    Create a raster function template to convert biomass data from biomass per hectare to biomass per pixel.
-    Multiplies biomass layer with area values devided by 10000
-    :param area_mosaic: string
-    :return: string
+    Set python module, mosaic dataset (Raster2) and variables of a raster function template
+    :param tree: object tree
+    :param module: string, absolute path to python raster function
+    :param mosaic: string
+    :param variables: dict
+    :return:
     """
-    # Define path to template XML file
-    abspath = os.path.abspath(__file__)
-    dir_name = os.path.dirname(abspath)
-    template = os.path.join(dir_name, r"templates\biomass_conversion_template.rft.xml")
 
     # Define path and name of GDB and mosaic
-    area_gdb = os.path.dirname(area_mosaic)
-    area_gdb_name = os.path.dirname(area_gdb)
-    area_name = os.path.basename(area_mosaic)
-
-    # Read XML template into object tree
-    with open(template) as f:
-        tree = objectify.parse(f)
+    gdb = os.path.dirname(mosaic)
+    gdb_name = os.path.dirname(gdb)
+    name = os.path.basename(mosaic)
 
     root = tree.getroot()
     values = root.Arguments.Values.getchildren()
     for value in values:
+        # Templates reference the python module relative to the templates folder.
+        # Generated templates live in the cache folder and need an absolute path
+        if value.text and value.text.endswith(".py"):
+            value._setText(module)
+            continue
+
         try:
-            if value.Name == "Raster2":
-                value.Value.WorkspaceName.PathName = area_gdb
+            if value.Name in variables:
+                value.Value = variables[value.Name]
+
+            elif value.Name == "Raster2":
+
+                value.Value.WorkspaceName.PathName = gdb
                 objectify.deannotate(value.Value.WorkspaceName.PathName, cleanup_namespaces=True)
 
-                value.Value.WorkspaceName.BrowseName = area_gdb_name
+                value.Value.WorkspaceName.BrowseName = gdb_name
                 objectify.deannotate(value.Value.WorkspaceName.BrowseName, cleanup_namespaces=True)
 
-                value.Value.WorkspaceName.ConnectionProperties.PropertyArray.PropertySetProperty.Value = area_gdb
+                value.Value.WorkspaceName.ConnectionProperties.PropertyArray.PropertySetProperty.Value = gdb
                 objectify.deannotate(value.Value.WorkspaceName.ConnectionProperties.PropertyArray.PropertySetProperty.Value, cleanup_namespaces=True)
 
-                value.Value.Name = area_name
+                value.Value.Name = name
                 objectify.deannotate(value.Value.Name, cleanup_namespaces=True)
                 objectify.xsiannotate(value.Value.Name)
 
         except AttributeError:
             pass
 
-    # Write update values to a new XML file (keep template untouched)
-    mask_path = os.path.join(dir_name, r"templates\biomass_conversion.rft.xml")
-    tree.write(mask_path)
-    return mask_path
 
+def write_atomic(tree, path):
+    """
+    Write object tree to a temporary file and move it in place
+    :param tree: object tree
+    :param path: string
+    :return:
+    """
+    if not os.path.exists(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # Created by a concurrent run
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    os.close(fd)
+    tree.write(temp_path)
+
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # On Windows rename fails if a concurrent run already wrote the same template
+        os.remove(temp_path)
+        if not os.path.exists(path):
+            raise
 
 
 def replace_raster_function(mosaic, raster_function, messages):
     '''
     Remove all raster functions from a raster function chain in a mosaic dataset
     Add new raster function to mosaic dataset
+    Mosaic dataset is not edited if it already carries the same raster function
     :param mosaic:
     :param raster_function:
     :return:
     '''
 
+    # Generated templates are named by their cache key
+    fingerprint = os.path.basename(raster_function)
+    if applied_raster_function(mosaic) == fingerprint:
+        messages.AddMessage("Raster function already applied to {}".format(os.path.basename(mosaic)))
+        return
+
     arcpy.EditRasterFunction_management(mosaic, "EDIT_MOSAIC_DATASET", "REMOVE")
     arcpy.EditRasterFunction_management(mosaic, "EDIT_MOSAIC_DATASET", "INSERT", raster_function)
+    record_raster_function(mosaic, fingerprint)
+
+    return
+
+
+def remove_raster_functions(mosaic, messages):
+    '''
+    Remove all raster functions from a raster function chain in a mosaic dataset
+    Mosaic dataset is not edited if it is known to have no raster functions
+    :param mosaic: string
+    :param messages: object
+    :return:
+    '''
+
+    if applied_raster_function(mosaic) == "":
+        return
+
+    arcpy.EditRasterFunction_management(mosaic, "EDIT_MOSAIC_DATASET", "REMOVE")
+    record_raster_function(mosaic, "")
 
     return
+
+
+def applied_raster_function(mosaic):
+    """
+    Fingerprint of the raster function last applied to a mosaic dataset by this tool.
+    Fingerprints are stored in the RASTER_FUNCTION_TABLE of the mosaic workspace
+    :param mosaic: string
+    :return: string, empty string if mosaic has no raster functions, None if unknown
+    """
+    table = os.path.join(os.path.dirname(mosaic), RASTER_FUNCTION_TABLE)
+    if not arcpy.Exists(table):
+        return None
+
+    with arcpy.da.SearchCursor(table, ["MOSAIC", "RASTER_FUNCTION"]) as cursor:
+        for name, fingerprint in cursor:
+            if name == os.path.basename(mosaic):
+                return fingerprint if fingerprint is not None else ""
+    return None
+
+
+def create_raster_function_table(workspace):
+    """
+    Create the RASTER_FUNCTION_TABLE of a mosaic workspace, if it does not exist yet.
+    Only called when mosaic datasets are created, analysis runs never create it
+    :param workspace: string
+    :return:
+    """
+    table = os.path.join(workspace, RASTER_FUNCTION_TABLE)
+    if not arcpy.Exists(table):
+        arcpy.CreateTable_management(workspace, RASTER_FUNCTION_TABLE)
+        arcpy.AddField_management(table, "MOSAIC", "TEXT", field_length=255)
+        arcpy.AddField_management(table, "RASTER_FUNCTION", "TEXT", field_length=255)
+
+
+def record_raster_function(mosaic, fingerprint):
+    """
+    Store fingerprint of the raster function applied to a mosaic dataset.
+    Without a RASTER_FUNCTION_TABLE nothing is recorded and the raster function of the mosaic stays unknown
+    :param mosaic: string
+    :param fingerprint: string, empty string if mosaic has no raster functions
+    :return:
+    """
+    table = os.path.join(os.path.dirname(mosaic), RASTER_FUNCTION_TABLE)
+    if not arcpy.Exists(table):
+        return
+
+    with arcpy.da.UpdateCursor(table, ["MOSAIC", "RASTER_FUNCTION"]) as cursor:
+        for row in cursor:
+            if row[0] == os.path.basename(mosaic):
+                cursor.updateRow([row[0], fingerprint])
+                return
+
+    with arcpy.da.InsertCursor(table, ["MOSAIC", "RASTER_FUNCTION"]) as cursor:
+        cursor.insertRow([os.path.basename(mosaic), fingerprint])
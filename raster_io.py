@@ -0,0 +1,524 @@
+import math
+import os
+import numpy as np
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+# Block size assumed for rasters which do not report their internal tiling (cols, rows)
+DEFAULT_BLOCK_SIZE = (128, 128)
+
+# Use in place of an area raster to compute pixel area (m2) from the grid of the zone raster
+PIXEL_AREA = "PIXEL_AREA"
+
+# WGS84 ellipsoid
+WGS84_SEMI_MAJOR_AXIS = 6378137.0
+WGS84_FLATTENING = 1 / 298.257223563
+
+# Maximum number of row ranges cached by PixelAreaReader
+AREA_CACHE_SIZE = 64
+
+# Footprint index of a mosaic dataset, one row per source raster
+FOOTPRINT_DTYPE = np.dtype([('PATH', 'U260'), ('X_MIN', 'f8'), ('Y_MAX', 'f8'), ('CELL_WIDTH', 'f8'),
+                            ('CELL_HEIGHT', 'f8'), ('WIDTH', 'i4'), ('HEIGHT', 'i4'), ('BLOCK_COLS', 'i4'),
+                            ('BLOCK_ROWS', 'i4'), ('DTYPE', 'U10'), ('NODATA', 'f8'), ('HAS_NODATA', 'i2')])
+
+
+class RasterInfo(object):
+    '''
+    Grid definition of a single band raster
+    Origin is the upper left corner of the upper left pixel
+    '''
+
+    def __init__(self, x_min, y_max, cell_width, cell_height, width, height, dtype, nodata=None):
+        self.x_min = float(x_min)
+        self.y_max = float(y_max)
+        self.cell_width = float(cell_width)
+        self.cell_height = float(cell_height)
+        self.width = int(width)
+        self.height = int(height)
+        self.dtype = np.dtype(dtype)
+        self.nodata = nodata
+
+    @property
+    def x_max(self):
+        return self.x_min + self.width * self.cell_width
+
+    @property
+    def y_min(self):
+        return self.y_max - self.height * self.cell_height
+
+    def window(self, x_min, y_min, x_max, y_max):
+        """
+        Pixel window covering a bounding box, clipped to the raster
+        Returns None if bounding box does not overlap with the raster
+        :param x_min: float
+        :param y_min: float
+        :param x_max: float
+        :param y_max: float
+        :return: tuple (col_off, row_off, cols, rows)
+        """
+        col_start = max(int(math.floor((x_min - self.x_min) / self.cell_width)), 0)
+        col_end = min(int(math.ceil((x_max - self.x_min) / self.cell_width)), self.width)
+        row_start = max(int(math.floor((self.y_max - y_max) / self.cell_height)), 0)
+        row_end = min(int(math.ceil((self.y_max - y_min) / self.cell_height)), self.height)
+
+        if col_end <= col_start or row_end <= row_start:
+            return None
+        return col_start, row_start, col_end - col_start, row_end - row_start
+
+    def window_bounds(self, col_off, row_off, cols, rows):
+        """
+        Bounding box of a pixel window
+        :param col_off: integer
+        :param row_off: integer
+        :param cols: integer
+        :param rows: integer
+        :return: tuple (x_min, y_min, x_max, y_max)
+        """
+        x_min = self.x_min + col_off * self.cell_width
+        y_max = self.y_max - row_off * self.cell_height
+        return x_min, y_max - rows * self.cell_height, x_min + cols * self.cell_width, y_max
+
+    def offset(self, other):
+        """
+        Pixel offset of the other raster's origin within this grid.
+        Both rasters must share cell size and snap
+        :param other: RasterInfo
+        :return: tuple (col_off, row_off)
+        """
+        tolerance = 1e-6
+
+        if abs(self.cell_width - other.cell_width) > tolerance * self.cell_width or \
+                abs(self.cell_height - other.cell_height) > tolerance * self.cell_height:
+            raise Exception("Rasters must have the same cell size")
+
+        col_off = (other.x_min - self.x_min) / self.cell_width
+        row_off = (self.y_max - other.y_max) / self.cell_height
+        if abs(col_off - round(col_off)) > 1e-3 or abs(row_off - round(row_off)) > 1e-3:
+            raise Exception("Rasters must snap to the same grid")
+
+        return int(round(col_off)), int(round(row_off))
+
+
+class GdalReader(object):
+    '''
+    Read windows of a raster file into NumPy arrays using GDAL
+    '''
+
+    def __init__(self, path):
+        if gdal is None:
+            raise Exception("GDAL is required to read {}".format(path))
+
+        self.path = path
+        self.dataset = gdal.Open(path)
+        if self.dataset is None:
+            raise Exception("Cannot open raster {}".format(path))
+        self.band = self.dataset.GetRasterBand(1)
+        self.block_size = tuple(self.band.GetBlockSize())
+
+        x_min, cell_width, _, y_max, _, cell_height = self.dataset.GetGeoTransform()
+        dtype = gdal.GetDataTypeName(self.band.DataType)
+        self.info = RasterInfo(x_min, y_max, cell_width, -cell_height,
+                               self.dataset.RasterXSize, self.dataset.RasterYSize,
+                               _GDAL_DTYPES.get(dtype, 'f8'), self.band.GetNoDataValue())
+
+    def read(self, col_off, row_off, cols, rows):
+        """
+        Read pixel window
+        :param col_off: integer
+        :param row_off: integer
+        :param cols: integer
+        :param rows: integer
+        :return: numpy.ndarray
+        """
+        return self.band.ReadAsArray(col_off, row_off, cols, rows)
+
+    def close(self):
+        self.band = None
+        self.dataset = None
+
+
+class ArcpyReader(object):
+    '''
+    Read windows of a raster or mosaic dataset into NumPy arrays using arcpy.
+    Raster functions on mosaic datasets are applied on read
+    '''
+
+    def __init__(self, path):
+        import arcpy
+
+        self.path = path
+        self.block_size = DEFAULT_BLOCK_SIZE
+        raster = arcpy.Raster(path)
+        self.info = RasterInfo(raster.extent.XMin, raster.extent.YMax,
+                               raster.meanCellWidth, raster.meanCellHeight,
+                               raster.width, raster.height,
+                               _ARCPY_DTYPES.get(raster.pixelType, 'f8'), raster.noDataValue)
+
+    def read(self, col_off, row_off, cols, rows):
+        """
+        Read pixel window
+        :param col_off: integer
+        :param row_off: integer
+        :param cols: integer
+        :param rows: integer
+        :return: numpy.ndarray
+        """
+        import arcpy
+
+        x_min, y_min, x_max, y_max = self.info.window_bounds(col_off, row_off, cols, rows)
+        if self.info.nodata is None:
+            return arcpy.RasterToNumPyArray(self.path, arcpy.Point(x_min, y_min), cols, rows)
+        return arcpy.RasterToNumPyArray(self.path, arcpy.Point(x_min, y_min), cols, rows, self.info.nodata)
+
+    def close(self):
+        pass
+
+
+class FootprintReader(object):
+    '''
+    Read windows of a mosaic dataset directly from its source rasters using the footprint index of the mosaic.
+    Only source rasters which intersect a window are read, each is opened on first use.
+    All source rasters must exist when the reader is created.
+    Source rasters must share cell size and snap to the same grid. Where sources overlap the last one wins
+    '''
+
+    def __init__(self, path, footprints):
+        if len(footprints) == 0:
+            raise Exception("Footprint index of {} is empty".format(path))
+
+        # Fail before any work is done if sources were moved or deleted, not on first read of a missing source
+        for source in footprints['PATH']:
+            if not raster_exists(source):
+                raise Exception("Source raster {} does not exist".format(source))
+
+        self.path = path
+        self.footprints = footprints
+        self.readers = dict()
+
+        first = footprints[0]
+        self.block_size = (int(first['BLOCK_COLS']), int(first['BLOCK_ROWS']))
+
+        x_min = footprints['X_MIN'].min()
+        y_max = footprints['Y_MAX'].max()
+        x_max = (footprints['X_MIN'] + footprints['WIDTH'] * footprints['CELL_WIDTH']).max()
+        y_min = (footprints['Y_MAX'] - footprints['HEIGHT'] * footprints['CELL_HEIGHT']).min()
+        cell_width = float(first['CELL_WIDTH'])
+        cell_height = float(first['CELL_HEIGHT'])
+
+        dtype = np.result_type(*[np.dtype(str(name)) for name in footprints['DTYPE']])
+        nodata = dtype.type(first['NODATA']) if first['HAS_NODATA'] else None
+        self.info = RasterInfo(x_min, y_max, cell_width, cell_height,
+                               int(round((x_max - x_min) / cell_width)), int(round((y_max - y_min) / cell_height)),
+                               dtype, nodata)
+
+        # Pixel window of every source raster in the mosaic grid
+        offsets = np.array([self.info.offset(footprint_info(footprint)) for footprint in footprints], dtype=np.int64)
+        self.col_offs = offsets[:, 0]
+        self.row_offs = offsets[:, 1]
+        self.widths = footprints['WIDTH'].astype(np.int64)
+        self.heights = footprints['HEIGHT'].astype(np.int64)
+
+    def __getstate__(self):
+        # Worker processes open their own source rasters
+        state = self.__dict__.copy()
+        state['readers'] = dict()
+        return state
+
+    def source(self, i):
+        """
+        Reader of a source raster
+        :param i: integer, row of footprint index
+        :return: GdalReader or ArcpyReader
+        """
+        if i not in self.readers:
+            self.readers[i] = open_raster(self.footprints['PATH'][i])
+        return self.readers[i]
+
+    def read(self, col_off, row_off, cols, rows):
+        """
+        Read pixel window
+        :param col_off: integer
+        :param row_off: integer
+        :param cols: integer
+        :param rows: integer
+        :return: numpy.ndarray
+        """
+        c0 = np.maximum(self.col_offs, col_off)
+        r0 = np.maximum(self.row_offs, row_off)
+        c1 = np.minimum(self.col_offs + self.widths, col_off + cols)
+        r1 = np.minimum(self.row_offs + self.heights, row_off + rows)
+        sources = np.nonzero((c1 > c0) & (r1 > r0))[0].tolist()
+
+        # Window within a single source raster
+        if len(sources) == 1:
+            i = sources[0]
+            if c1[i] - c0[i] == cols and r1[i] - r0[i] == rows:
+                data = self.source(i).read(col_off - self.col_offs[i], row_off - self.row_offs[i], cols, rows)
+                return data.astype(self.info.dtype, copy=False)
+
+        out = np.empty((rows, cols), dtype=self.info.dtype)
+        out.fill(self.info.nodata if self.info.nodata is not None else 0)
+
+        for i in sources:
+            data = self.source(i).read(c0[i] - self.col_offs[i], r0[i] - self.row_offs[i],
+                                       c1[i] - c0[i], r1[i] - r0[i])
+            target = out[r0[i] - row_off:r1[i] - row_off, c0[i] - col_off:c1[i] - col_off]
+            if self.footprints['HAS_NODATA'][i]:
+                np.copyto(target, data, casting='unsafe', where=data != self.footprints['NODATA'][i])
+            else:
+                np.copyto(target, data, casting='unsafe')
+        return out
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = dict()
+
+
+def footprint_info(footprint):
+    """
+    Grid of a source raster from its row in the footprint index
+    :param footprint: numpy.void (FOOTPRINT_DTYPE)
+    :return: RasterInfo
+    """
+    return RasterInfo(footprint['X_MIN'], footprint['Y_MAX'], footprint['CELL_WIDTH'], footprint['CELL_HEIGHT'],
+                      footprint['WIDTH'], footprint['HEIGHT'], str(footprint['DTYPE']),
+                      footprint['NODATA'] if footprint['HAS_NODATA'] else None)
+
+
+def footprint_records(paths):
+    """
+    Footprint, resolution, block size and NoData of source rasters.
+    Fails if any source raster cannot be read, a partial index would hide the missing source
+    :param paths: list of strings
+    :return: numpy.ndarray (FOOTPRINT_DTYPE)
+    """
+    records = np.zeros(len(paths), dtype=FOOTPRINT_DTYPE)
+    for i, path in enumerate(paths):
+        try:
+            raster = open_raster(path)
+        except Exception as e:
+            raise Exception("Cannot read footprint of {} ({})".format(path, e))
+        try:
+            info = raster.info
+            nodata = info.nodata
+            records[i] = (path, info.x_min, info.y_max, info.cell_width, info.cell_height, info.width, info.height,
+                          raster.block_size[0], raster.block_size[1], info.dtype.name,
+                          nodata if nodata is not None else 0, nodata is not None)
+        finally:
+            raster.close()
+    return records
+
+
+def row_areas(y_max, cell_width, cell_height, rows):
+    """
+    Area in m2 of the pixels of each row of a WGS84 geographic grid.
+    Area of a pixel only depends on its latitude (area between two parallels on the ellipsoid)
+    :param y_max: float, latitude of upper edge of first row
+    :param cell_width: float, degrees
+    :param cell_height: float, degrees
+    :param rows: integer
+    :return: numpy.ndarray (rows,)
+    """
+    a = WGS84_SEMI_MAJOR_AXIS
+    e2 = WGS84_FLATTENING * (2 - WGS84_FLATTENING)
+    e = math.sqrt(e2)
+
+    edges = np.radians(np.clip(y_max - np.arange(rows + 1) * cell_height, -90, 90))
+    sin = np.sin(edges)
+
+    # Authalic term q(lat) of the ellipsoid, area between equator and lat is a^2 (1 - e^2) / 2 * dlon * q
+    q = sin / (1 - e2 * sin ** 2) + np.log((1 + e * sin) / (1 - e * sin)) / (2 * e)
+    return a ** 2 * (1 - e2) / 2 * math.radians(cell_width) * (q[:-1] - q[1:])
+
+
+class PixelAreaReader(object):
+    '''
+    Pixel area in m2 of a WGS84 geographic grid, computed per row instead of read from an area raster.
+    Vectors are cached per row range, windows are broadcast over all columns without copying
+    '''
+
+    def __init__(self, info):
+        self.path = PIXEL_AREA
+        self.block_size = DEFAULT_BLOCK_SIZE
+        self.info = RasterInfo(info.x_min, info.y_max, info.cell_width, info.cell_height,
+                               info.width, info.height, 'f8', None)
+        self.cache = dict()
+
+    def read(self, col_off, row_off, cols, rows):
+        """
+        Read pixel window
+        :param col_off: integer
+        :param row_off: integer
+        :param cols: integer
+        :param rows: integer
+        :return: numpy.ndarray (read only)
+        """
+        key = (row_off, rows)
+        if key not in self.cache:
+            if len(self.cache) >= AREA_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[key] = row_areas(self.info.y_max - row_off * self.info.cell_height,
+                                        self.info.cell_width, self.info.cell_height, rows)
+        areas = self.cache[key]
+        return np.lib.stride_tricks.as_strided(areas, shape=(rows, cols), strides=(areas.strides[0], 0))
+
+    def close(self):
+        self.cache = dict()
+
+
+def raster_exists(path):
+    """
+    Check if a raster file or a raster dataset (i.e. in a geodatabase) exists
+    :param path: string
+    :return: boolean
+    """
+    if os.path.exists(path):
+        return True
+
+    import arcpy
+    return arcpy.Exists(path)
+
+
+def open_raster(path):
+    """
+    Open raster for reading. Raster files are read with GDAL if available,
+    everything else (e.g. mosaic datasets in a geodatabase) with arcpy
+    :param path: string
+    :return: GdalReader or ArcpyReader
+    """
+    if gdal is not None and os.path.isfile(path):
+        return GdalReader(path)
+    return ArcpyReader(path)
+
+
+def read_aligned(raster, info, col_off, row_off, cols, rows):
+    """
+    Read a window given in the grid of info from a raster which snaps to the same grid.
+    Pixels outside the raster are filled with NoData (or 0 if raster has no NoData value)
+    :param raster: GdalReader or ArcpyReader
+    :param info: RasterInfo
+    :param col_off: integer
+    :param row_off: integer
+    :param cols: integer
+    :param rows: integer
+    :return: numpy.ndarray
+    """
+    dcol, drow = info.offset(raster.info)
+    col_start = col_off - dcol
+    row_start = row_off - drow
+
+    if col_start >= 0 and row_start >= 0 and \
+            col_start + cols <= raster.info.width and row_start + rows <= raster.info.height:
+        return raster.read(col_start, row_start, cols, rows)
+
+    fill = raster.info.nodata if raster.info.nodata is not None else 0
+    out = np.empty((rows, cols), dtype=raster.info.dtype)
+    out.fill(fill)
+
+    c0 = max(col_start, 0)
+    r0 = max(row_start, 0)
+    c1 = min(col_start + cols, raster.info.width)
+    r1 = min(row_start + rows, raster.info.height)
+    if c1 > c0 and r1 > r0:
+        out[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = raster.read(c0, r0, c1 - c0, r1 - r0)
+    return out
+
+
+def tile_shape(reference, rasters, tile_size, max_bytes, working_bytes=0):
+    """
+    Largest tile shape which is not larger than tile_size, aligned to the block size of the reference raster
+    and for which the arrays of all rasters together with the working arrays do not exceed max_bytes.
+    Blocks larger than tile_size (i.e. strips of single rows) are clamped to tile_size
+    :param reference: GdalReader or ArcpyReader
+    :param rasters: list of readers
+    :param tile_size: integer
+    :param max_bytes: integer or None
+    :param working_bytes: integer, bytes per pixel of arrays computed from the raster arrays
+    :return: tuple (cols, rows)
+    """
+    block_cols, block_rows = [max(min(size, tile_size), 1) for size in reference.block_size]
+
+    # Pixel area is a view of one vector per row and takes no memory per pixel
+    bytes_per_pixel = working_bytes + sum([raster.info.dtype.itemsize for raster in rasters
+                                           if not isinstance(raster, PixelAreaReader)])
+
+    cols = max(tile_size // block_cols, 1) * block_cols
+    rows = max(tile_size // block_rows, 1) * block_rows
+
+    if max_bytes:
+        # Shrink larger side of tile by whole blocks until it fits into memory
+        while cols * rows * bytes_per_pixel > max_bytes and (cols > block_cols or rows > block_rows):
+            if rows >= cols and rows > block_rows or cols <= block_cols:
+                rows = max(rows // 2 // block_rows, 1) * block_rows
+            else:
+                cols = max(cols // 2 // block_cols, 1) * block_cols
+
+    return cols, rows
+
+
+def tile_windows(reference, rasters, window, tile_size, max_bytes, working_bytes=0):
+    """
+    Split a pixel window into block aligned tiles
+    :param reference: GdalReader or ArcpyReader
+    :param rasters: list of readers which will be read for every tile
+    :param window: tuple (col_off, row_off, cols, rows) or None for the whole reference raster
+    :param tile_size: integer
+    :param max_bytes: integer or None
+    :param working_bytes: integer, bytes per pixel of arrays computed from the raster arrays
+    :return: generator of tuple (col_off, row_off, cols, rows)
+    """
+    if window is None:
+        window = (0, 0, reference.info.width, reference.info.height)
+    col_off, row_off, cols, rows = window
+    tile_cols, tile_rows = tile_shape(reference, rasters, tile_size, max_bytes, working_bytes)
+
+    # Tiles snap to the tile grid of the raster, not to the window, so that reads stay block aligned
+    for row in range(row_off - row_off % tile_rows, row_off + rows, tile_rows):
+        r0 = max(row, row_off)
+        r1 = min(row + tile_rows, row_off + rows)
+        for col in range(col_off - col_off % tile_cols, col_off + cols, tile_cols):
+            c0 = max(col, col_off)
+            c1 = min(col + tile_cols, col_off + cols)
+            yield c0, r0, c1 - c0, r1 - r0
+
+
+def read_tile(rasters, info, tile):
+    """
+    Read the same window from all co-registered rasters
+    :param rasters: dict of readers
+    :param info: RasterInfo
+    :param tile: tuple (col_off, row_off, cols, rows)
+    :return: dict of numpy.ndarray
+    """
+    return dict((name, read_aligned(raster, info, *tile)) for name, raster in rasters.items())
+
+
+_GDAL_DTYPES = {
+    'Byte': 'u1',
+    'Int8': 'i1',
+    'UInt16': 'u2',
+    'Int16': 'i2',
+    'UInt32': 'u4',
+    'Int32': 'i4',
+    'Float32': 'f4',
+    'Float64': 'f8'
+}
+
+_ARCPY_DTYPES = {
+    'U1': 'u1',
+    'U2': 'u1',
+    'U4': 'u1',
+    'U8': 'u1',
+    'S8': 'i1',
+    'U16': 'u2',
+    'S16': 'i2',
+    'U32': 'u4',
+    'S32': 'i4',
+    'F32': 'f4',
+    'F64': 'f8'
+}
@@ -0,0 +1,249 @@
+import numpy as np
+
+# Fill rules
+EVEN_ODD = "even-odd"
+NONZERO = "nonzero"
+
+
+def polygon_edges(polygons):
+    """
+    Start and end coordinates of all edges of a list of polygons
+    :param polygons: list of list of numpy.ndarray (n, 2), rings of every polygon
+    :return: tuple of numpy.ndarray (polygon index, x0, y0, x1, y1)
+    """
+    rings = [ring for rings in polygons for ring in rings]
+    if len(rings) == 0:
+        empty = np.empty(0, dtype='f8')
+        return np.empty(0, dtype=np.int64), empty, empty, empty, empty
+
+    starts = np.concatenate(rings)
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    index = np.repeat(np.arange(len(polygons)), [sum([len(ring) for ring in rings]) for rings in polygons])
+    return index, starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1]
+
+
+def _expand(starts, counts):
+    """
+    Repeat every item by its count and number the repetitions
+    :param starts: numpy.ndarray, first number of every item
+    :param counts: numpy.ndarray
+    :return: tuple (item index, numbers)
+    """
+    item = np.repeat(np.arange(len(counts)), counts)
+    step = np.arange(len(item)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return item, starts[item] + step
+
+
+def center_spans(edges, info, col_off, row_off, cols, rows, rule):
+    """
+    Runs of pixels whose center is inside a polygon, found with a scanline over all pixel rows at once.
+    Edges are intersected with the center line of every row they cross, crossings are sorted per polygon and row
+    and pixels between crossings are inside depending on the fill rule
+    :param edges: tuple of numpy.ndarray (polygon index, x0, y0, x1, y1)
+    :param info: RasterInfo
+    :param col_off: integer
+    :param row_off: integer
+    :param cols: integer
+    :param rows: integer
+    :param rule: string, EVEN_ODD or NONZERO
+    :return: tuple of numpy.ndarray (polygon index, row, first col, end col) in window coordinates
+    """
+    index, x0, y0, x1, y1 = edges
+    x_min, y_min, x_max, y_max = info.window_bounds(col_off, row_off, cols, rows)
+
+    # Rows whose center line lies in [lower y, upper y) of an edge. Horizontal edges do not cross any row
+    first = np.floor((y_max - np.maximum(y0, y1)) / info.cell_height - 0.5).astype(np.int64) + 1
+    end = np.floor((y_max - np.minimum(y0, y1)) / info.cell_height - 0.5).astype(np.int64) + 1
+    first = np.clip(first, 0, rows)
+    end = np.clip(end, 0, rows)
+    edge, row = _expand(first, np.maximum(end - first, 0))
+
+    y = y_max - (row + 0.5) * info.cell_height
+    x = x0[edge] + (y - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+    polygon = index[edge]
+
+    # Sort crossings by polygon, row and x
+    order = np.lexsort((x, row, polygon))
+    x = x[order]
+    row = row[order]
+    polygon = polygon[order]
+    if rule == NONZERO:
+        direction = np.where(y1[edge] > y0[edge], 1, -1)[order]
+    else:
+        direction = np.ones(len(order), dtype=np.int64)
+
+    # Winding number (or crossing count) left of the next crossing, restarted for every polygon and row
+    group_start = np.ones(len(x), dtype=bool)
+    group_start[1:] = (polygon[1:] != polygon[:-1]) | (row[1:] != row[:-1])
+    winding = np.cumsum(direction)
+    winding -= np.repeat(winding[group_start] - direction[group_start],
+                         np.diff(np.append(np.flatnonzero(group_start), len(x))))
+
+    # Pixels between a crossing and the next crossing of the same row
+    same = ~group_start[1:]
+    if rule == NONZERO:
+        inside = same & (winding[:-1] != 0)
+    else:
+        inside = same & (winding[:-1] % 2 == 1)
+    start = np.flatnonzero(inside)
+
+    col_first = np.ceil((x[start] - x_min) / info.cell_width - 0.5)
+    col_end = np.ceil((x[start + 1] - x_min) / info.cell_width - 0.5)
+    col_first = np.clip(col_first, 0, cols).astype(np.int64)
+    col_end = np.clip(col_end, 0, cols).astype(np.int64)
+
+    keep = col_end > col_first
+    return polygon[start][keep], row[start][keep], col_first[keep], col_end[keep]
+
+
+def touched_pixels(edges, info, col_off, row_off, cols, rows):
+    """
+    Pixels crossed by polygon edges. Edges are cut into one piece per pixel column,
+    every piece touches all rows between its lowest and highest point
+    :param edges: tuple of numpy.ndarray (polygon index, x0, y0, x1, y1)
+    :param info: RasterInfo
+    :param col_off: integer
+    :param row_off: integer
+    :param cols: integer
+    :param rows: integer
+    :return: tuple of numpy.ndarray (polygon index, row, col) in window coordinates
+    """
+    index, x0, y0, x1, y1 = edges
+    x_min, y_min, x_max, y_max = info.window_bounds(col_off, row_off, cols, rows)
+
+    left = np.minimum(x0, x1)
+    right = np.maximum(x0, x1)
+    first = np.clip(np.floor((left - x_min) / info.cell_width), 0, cols).astype(np.int64)
+    end = np.clip(np.floor((right - x_min) / info.cell_width) + 1, 0, cols).astype(np.int64)
+    edge, col = _expand(first, np.maximum(end - first, 0))
+
+    # Part of the edge within the pixel column
+    strip_left = np.maximum(x_min + col * info.cell_width, left[edge])
+    strip_right = np.minimum(x_min + (col + 1) * info.cell_width, right[edge])
+    dx = x1[edge] - x0[edge]
+    vertical = dx == 0
+    slope = (y1[edge] - y0[edge]) / np.where(vertical, 1, dx)
+    ya = np.where(vertical, y0[edge], y0[edge] + (strip_left - x0[edge]) * slope)
+    yb = np.where(vertical, y1[edge], y0[edge] + (strip_right - x0[edge]) * slope)
+
+    row_first = np.clip(np.floor((y_max - np.maximum(ya, yb)) / info.cell_height), 0, rows).astype(np.int64)
+    row_end = np.clip(np.floor((y_max - np.minimum(ya, yb)) / info.cell_height) + 1, 0, rows).astype(np.int64)
+    piece, row = _expand(row_first, np.maximum(row_end - row_first, 0))
+
+    return index[edge][piece], row, col[piece]
+
+
+def polygon_spans(polygons, info, col_off, row_off, cols, rows, rule=EVEN_ODD, all_touched=False):
+    """
+    Runs of pixels covered by each polygon within a pixel window.
+    A pixel is covered if its center is inside the polygon, with all_touched also if the polygon touches it
+    :param polygons: list of list of numpy.ndarray (n, 2), exterior and interior rings of all parts of every polygon
+    :param info: RasterInfo
+    :param col_off: integer
+    :param row_off: integer
+    :param cols: integer
+    :param rows: integer
+    :param rule: string, EVEN_ODD or NONZERO
+    :param all_touched: boolean
+    :return: tuple of numpy.ndarray (polygon index, row, first col, end col) in window coordinates
+    """
+    edges = polygon_edges(polygons)
+    polygon, row, col_first, col_end = center_spans(edges, info, col_off, row_off, cols, rows, rule)
+    if not all_touched:
+        return polygon, row, col_first, col_end
+
+    # Touched pixels which are not yet part of a run of the same polygon become runs of one pixel
+    touched_polygon, touched_row, touched_col = touched_pixels(edges, info, col_off, row_off, cols, rows)
+    width = cols + 1
+    line = polygon * rows + row
+    touched = np.unique((touched_polygon * rows + touched_row) * width + touched_col)
+    touched_line = touched // width
+    touched_col = touched % width
+
+    # Runs of a polygon row do not overlap, the run left of a pixel is the only one which can cover it
+    order = np.argsort(line * width + col_first)
+    keys = (line * width + col_first)[order]
+    run = np.searchsorted(keys, touched, side='right') - 1
+    covered = np.zeros(len(touched), dtype=bool)
+    found = run >= 0
+    run = order[run[found]]
+    covered[found] = (line[run] == touched_line[found]) & (col_end[run] > touched_col[found])
+
+    extra = ~covered
+    return (np.concatenate([polygon, touched_line[extra] // rows]),
+            np.concatenate([row, touched_line[extra] % rows]),
+            np.concatenate([col_first, touched_col[extra]]),
+            np.concatenate([col_end, touched_col[extra] + 1]))
+
+
+def burn_spans(rows, cols, row, col_first, col_end, weights=None):
+    """
+    Sum of weights of all runs covering each pixel.
+    Runs are burned into a difference array of the window, which is summed up in place along every row
+    :param rows: integer
+    :param cols: integer
+    :param row: numpy.ndarray
+    :param col_first: numpy.ndarray
+    :param col_end: numpy.ndarray
+    :param weights: numpy.ndarray (integer) or None (count runs)
+    :return: numpy.ndarray (rows, cols), int32
+    """
+    if weights is None:
+        weights = np.ones(len(row), dtype='i4')
+    keys = np.concatenate([row * (cols + 1) + col_first, row * (cols + 1) + col_end])
+    changes = np.concatenate([weights, -weights])
+
+    # Runs of different polygons can start or end at the same pixel
+    unique, inverse = np.unique(keys, return_inverse=True)
+    diff = np.zeros((rows, cols + 1), dtype='i4')
+    diff.ravel()[unique] = np.bincount(inverse.ravel(), changes)
+    np.cumsum(diff, axis=1, out=diff)
+    return diff[:, :cols]
+
+
+def rasterize_polygon(rings, info, col_off, row_off, cols, rows, rule=EVEN_ODD, all_touched=False):
+    """
+    Create a boolean mask for a polygon on a pixel window.
+    A pixel is inside if its center is inside the polygon (even-odd rule, holes are excluded)
+    or, with all_touched, if the polygon touches the pixel
+    :param rings: list of numpy.ndarray (n, 2) with x/y coordinates, exterior and interior rings
+    :param info: RasterInfo
+    :param col_off: integer
+    :param row_off: integer
+    :param cols: integer
+    :param rows: integer
+    :param rule: string, EVEN_ODD or NONZERO
+    :param all_touched: boolean
+    :return: numpy.ndarray
+    """
+    polygon, row, col_first, col_end = polygon_spans([rings], info, col_off, row_off, cols, rows, rule, all_touched)
+    return burn_spans(rows, cols, row, col_first, col_end) > 0
+
+
+def rasterize_labels(polygons, info, col_off, row_off, cols, rows, rule=EVEN_ODD, all_touched=False):
+    """
+    Burn the index of every polygon into a label raster in one pass.
+    Polygons which share a pixel with another polygon are not burned,
+    they are returned as overlapping and must be burned separately
+    :param polygons: list of list of numpy.ndarray (n, 2), rings of every polygon
+    :param info: RasterInfo
+    :param col_off: integer
+    :param row_off: integer
+    :param cols: integer
+    :param rows: integer
+    :param rule: string, EVEN_ODD or NONZERO
+    :param all_touched: boolean
+    :return: tuple of numpy.ndarray (labels (-1 outside of all burned polygons), overlapping polygons (boolean))
+    """
+    polygon, row, col_first, col_end = polygon_spans(polygons, info, col_off, row_off, cols, rows, rule, all_touched)
+    overlapping = np.zeros(len(polygons), dtype=bool)
+
+    # Runs which cover a pixel covered by more than one run, counted with a cumulative sum along every row
+    shared = np.zeros((rows, cols + 1), dtype='i4')
+    np.cumsum(burn_spans(rows, cols, row, col_first, col_end) > 1, axis=1, out=shared[:, 1:])
+    overlapping[polygon[shared[row, col_end] > shared[row, col_first]]] = True
+
+    single = ~overlapping[polygon]
+    labels = burn_spans(rows, cols, row[single], col_first[single], col_end[single], polygon[single] + 1)
+    labels -= 1
+    return labels, overlapping
@@ -0,0 +1,235 @@
+import numpy as np
+
+# Carbon content of biomass and conversion factor from carbon to CO2
+CARBON_FRACTION = 0.5
+CO2_PER_CARBON = 3.67
+
+LOSS_DTYPE = np.dtype([('FID', 'i4'), ('YEAR', 'U30'), ('TCD', 'i4'), ('LOSS_HA', 'f8')])
+BIOMASS_LOSS_DTYPE = np.dtype([('FID', 'i4'), ('YEAR', 'U30'), ('TCD', 'i4'),
+                               ('BIOMASS_LOSS_MG', 'f8'), ('EMISSIONS_MT_CO2', 'f8')])
+COMBINED_LOSS_DTYPE = np.dtype([('FID', 'i4'), ('YEAR', 'U30'), ('TCD', 'i4'), ('LOSS_HA', 'f8'),
+                                ('BIOMASS_LOSS_MG', 'f8'), ('EMISSIONS_MT_CO2', 'f8')])
+
+# Conversion factors from zonal sums (area in m2, biomass in Mg) to output units
+HA_PER_M2 = 1.0 / 10000
+MT_CO2_PER_MG_BIOMASS = CARBON_FRACTION * CO2_PER_CARBON / 1000000
+
+
+class ResultSink(object):
+    '''
+    Collect result rows in a preallocated structured array which grows by doubling its capacity.
+    Rows are handed to the writer in large batches
+    '''
+
+    def __init__(self, dtype, capacity, batch_size, writer):
+        self.dtype = np.dtype(dtype)
+        self.batch_size = batch_size
+        self.writer = writer
+        self._array = np.empty(capacity, dtype=self.dtype)
+        self.size = 0
+        self.flushed = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, records):
+        """
+        Append rows and flush if batch is full
+        :param records: numpy.ndarray
+        :return:
+        """
+        if records is None or len(records) == 0:
+            return
+
+        required = self.size + len(records)
+        if required > len(self._array):
+            capacity = max(len(self._array), 1)
+            while capacity < required:
+                capacity *= 2
+            array = np.empty(capacity, dtype=self.dtype)
+            array[:self.size] = self._array[:self.size]
+            self._array = array
+
+        for name in self.dtype.names:
+            self._array[name][self.size:required] = records[name]
+        self.size = required
+
+        if self.writer is not None and self.size - self.flushed >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand all rows which were not yet written to the writer
+        :return:
+        """
+        if self.writer is not None and self.size > self.flushed:
+            self.writer(self._array[self.flushed:self.size])
+            self.flushed = self.size
+
+    def records(self):
+        """
+        All rows collected so far
+        :return: numpy.ndarray
+        """
+        return self._array[:self.size]
+
+
+def label_lookup(outside_label, no_loss_label, last_year):
+    """
+    YEAR labels for all lossyear values -1..last_year, indexed by value + 1
+    -1 = outside threshold, 0 = no loss, 1..n = Year 2001..2000+n
+    :param outside_label: string
+    :param no_loss_label: string
+    :param last_year: integer
+    :return: numpy.ndarray (string)
+    """
+    return np.array([outside_label, no_loss_label] +
+                    ["Year {}".format(2000 + year) for year in range(1, last_year + 1)], dtype='U30')
+
+
+def year_labels(values, outside_label, no_loss_label):
+    """
+    Map lossyear values to YEAR labels using a lookup table over all values
+    :param values: numpy.ndarray (integer)
+    :param outside_label: string
+    :param no_loss_label: string
+    :return: numpy.ndarray (string)
+    """
+    if len(values) == 0:
+        return np.empty(0, dtype='U30')
+
+    lookup = label_lookup(outside_label, no_loss_label, max(int(values.max()), 0))
+    return lookup[values + 1]
+
+
+def sort_records(records):
+    """
+    Sort zonal statistics by FID (descending), TCD and VALUE
+    :param records: numpy.ndarray
+    :return: numpy.ndarray
+    """
+    return records[np.lexsort((records['VALUE'], records['TCD'], -records['FID'].astype(np.int64)))]
+
+
+def format_loss(records):
+    """
+    Create tree cover loss output rows from zonal statistics of the area mosaic
+    :param records: numpy.ndarray (FID, TCD, VALUE, SUM) with area in m2
+    :return: numpy.ndarray (LOSS_DTYPE)
+    """
+    records = sort_records(records)
+
+    out = np.empty(len(records), dtype=LOSS_DTYPE)
+    out['FID'] = records['FID']
+    out['YEAR'] = year_labels(records['VALUE'], "area outside threshold", "no loss")
+    out['TCD'] = records['TCD']
+    out['LOSS_HA'] = records['SUM'] * HA_PER_M2
+    return out
+
+
+def format_biomass_loss(records):
+    """
+    Create biomass loss output rows from zonal statistics of the biomass mosaic
+    :param records: numpy.ndarray (FID, TCD, VALUE, SUM) with biomass in Mg
+    :return: numpy.ndarray (BIOMASS_LOSS_DTYPE)
+    """
+    records = sort_records(records)
+
+    out = np.empty(len(records), dtype=BIOMASS_LOSS_DTYPE)
+    out['FID'] = records['FID']
+    out['YEAR'] = year_labels(records['VALUE'], "biomass outside threshold", "no biomass loss")
+    out['TCD'] = records['TCD']
+    out['BIOMASS_LOSS_MG'] = records['SUM']
+    out['EMISSIONS_MT_CO2'] = records['SUM'] * MT_CO2_PER_MG_BIOMASS
+    return out
+
+
+def format_combined_loss(records):
+    """
+    Create combined tree cover loss, biomass loss and emissions output rows
+    :param records: numpy.ndarray (FID, TCD, VALUE, AREA, BIOMASS) with area in m2 and biomass in Mg
+    :return: numpy.ndarray (COMBINED_LOSS_DTYPE)
+    """
+    records = sort_records(records)
+
+    out = np.empty(len(records), dtype=COMBINED_LOSS_DTYPE)
+    out['FID'] = records['FID']
+    out['YEAR'] = year_labels(records['VALUE'], "area outside threshold", "no loss")
+    out['TCD'] = records['TCD']
+    out['LOSS_HA'] = records['AREA'] * HA_PER_M2
+    out['BIOMASS_LOSS_MG'] = records['BIOMASS']
+    out['EMISSIONS_MT_CO2'] = records['BIOMASS'] * MT_CO2_PER_MG_BIOMASS
+    return out
+
+
+def pivot(records, labels, columns):
+    """
+    Flatten zonal statistics into one row per feature and TCD threshold with one column per lossyear value.
+    Every label gets a column, also if there was no loss in that year for any feature
+    :param records: numpy.ndarray (FID, TCD, VALUE and sum fields)
+    :param labels: numpy.ndarray (string), column labels for values -1..n
+    :param columns: list of (field prefix, sum field, unit conversion factor)
+    :return: numpy.ndarray (FID, TCD, one field per prefix and label)
+    """
+    fields = [str(label.replace(" ", "_")) for label in labels]
+
+    # One row per (FID, TCD) combination
+    keys = records[['FID', 'TCD']].astype([('FID', 'i4'), ('TCD', 'i4')])
+    unique, rows = np.unique(keys, return_inverse=True)
+
+    # Values larger than last label are ignored
+    year_columns = records['VALUE'].astype(np.int64) + 1
+    valid = (year_columns >= 0) & (year_columns < len(labels))
+
+    out = np.zeros(len(unique), dtype=[('FID', 'i4'), ('TCD', 'i4')] +
+                                     [(prefix + field, 'f8') for prefix, name, factor in columns for field in fields])
+    out['FID'] = unique['FID']
+    out['TCD'] = unique['TCD']
+
+    for prefix, name, factor in columns:
+        # Sum into row x year matrix
+        matrix = np.zeros((len(unique), len(labels)), dtype='f8')
+        np.add.at(matrix, (rows[valid], year_columns[valid]), records[name][valid] * factor)
+        for i, field in enumerate(fields):
+            out[prefix + field] = matrix[:, i]
+
+    return out
+
+
+def pivot_loss(records, last_year):
+    """
+    Tree cover loss in ha, one row per feature and threshold with one column per year
+    :param records: numpy.ndarray (FID, TCD, VALUE, SUM) with area in m2
+    :param last_year: integer, last lossyear value
+    :return: numpy.ndarray
+    """
+    labels = label_lookup("area outside threshold", "no loss", last_year)
+    return pivot(records, labels, [("", "SUM", HA_PER_M2)])
+
+
+def pivot_biomass_loss(records, last_year, unit):
+    """
+    Biomass loss in Mg or emissions in Mt CO2, one row per feature and threshold with one column per year
+    :param records: numpy.ndarray (FID, TCD, VALUE, SUM) with biomass in Mg
+    :param last_year: integer, last lossyear value
+    :param unit: string ("Mg biomass" or "MT CO2")
+    :return: numpy.ndarray
+    """
+    labels = label_lookup("biomass outside threshold", "no biomass loss", last_year)
+    if unit == "Mg biomass":
+        return pivot(records, labels, [("", "SUM", 1.0)])
+    return pivot(records, labels, [("", "SUM", MT_CO2_PER_MG_BIOMASS)])
+
+
+def pivot_combined_loss(records, last_year):
+    """
+    Tree cover loss in ha, biomass loss in Mg and emissions in Mt CO2,
+    one row per feature and threshold with one column per value and year
+    :param records: numpy.ndarray (FID, TCD, VALUE, AREA, BIOMASS) with area in m2 and biomass in Mg
+    :param last_year: integer, last lossyear value
+    :return: numpy.ndarray
+    """
+    labels = label_lookup("outside threshold", "no loss", last_year)
+    return pivot(records, labels, [("HA_", "AREA", HA_PER_M2),
+                                   ("MG_", "BIOMASS", 1.0),
+                                   ("MT_CO2_", "BIOMASS", MT_CO2_PER_MG_BIOMASS)])
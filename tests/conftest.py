@@ -0,0 +1,141 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# Modules of the toolbox live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import raster_io
+
+# Grid of all test rasters, WGS84 degrees
+X_MIN = 10.0
+Y_MAX = -2.0
+CELL_SIZE = 0.00025
+WIDTH = 120
+HEIGHT = 100
+
+
+class ArrayReader(object):
+    '''
+    Reader of an in memory array, same interface as raster_io.GdalReader
+    '''
+
+    def __init__(self, array, nodata=None, block_size=(16, 16), x_min=X_MIN, y_max=Y_MAX):
+        self.array = array
+        self.block_size = block_size
+        self.info = raster_io.RasterInfo(x_min, y_max, CELL_SIZE, CELL_SIZE, array.shape[1], array.shape[0],
+                                         array.dtype, nodata)
+
+    def read(self, col_off, row_off, cols, rows):
+        return self.array[row_off:row_off + rows, col_off:col_off + cols].copy()
+
+    def close(self):
+        pass
+
+
+class Messages(object):
+    '''
+    Collect messages instead of sending them to arcpy
+    '''
+
+    def __init__(self):
+        self.messages = list()
+
+    def AddMessage(self, message):
+        self.messages.append(message)
+
+
+def pixel_box(col_off, row_off, cols, rows):
+    """
+    Ring of a rectangle which covers exactly a pixel window of the test grid
+    :return: numpy.ndarray (5, 2)
+    """
+    x0 = X_MIN + col_off * CELL_SIZE
+    y0 = Y_MAX - row_off * CELL_SIZE
+    x1 = x0 + cols * CELL_SIZE
+    y1 = y0 - rows * CELL_SIZE
+    return np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]])
+
+
+@pytest.fixture
+def rasters():
+    """
+    Lossyear (0-16, NoData 255), TCD (0-100) and biomass (NoData -1) rasters on the same grid
+    """
+    rng = np.random.RandomState(0)
+    lossyear = rng.randint(0, 17, (HEIGHT, WIDTH)).astype('u1')
+    lossyear[:5, :5] = 255
+    tcd = rng.randint(0, 101, (HEIGHT, WIDTH)).astype('u1')
+    biomass = (rng.rand(HEIGHT, WIDTH) * 500).astype('f4')
+    biomass[-5:, -5:] = -1
+    return {"lossyear": ArrayReader(lossyear, 255), "tcd": ArrayReader(tcd), "biomass": ArrayReader(biomass, -1)}
+
+
+@pytest.fixture
+def features():
+    """
+    Pixel aligned boxes (one with a hole, two overlapping, two adjacent) and a triangle
+    """
+    hole = pixel_box(20, 20, 10, 10)[::-1]
+    # Vertices off the pixel grid, no pixel center lies exactly on an edge
+    triangle = np.array([[X_MIN + 0.01013, Y_MAX - 0.00107], [X_MIN + 0.02491, Y_MAX - 0.00433],
+                         [X_MIN + 0.01217, Y_MAX - 0.01979], [X_MIN + 0.01013, Y_MAX - 0.00107]])
+    return [(1, [pixel_box(0, 0, 40, 30)]),
+            (2, [pixel_box(10, 10, 30, 30), hole]),
+            (3, [pixel_box(30, 25, 30, 40)]),
+            (4, [pixel_box(60, 25, 20, 40)]),
+            (5, [triangle]),
+            (6, [pixel_box(90, 70, 30, 30)])]
+
+
+def reference_mask(rings):
+    """
+    Pixels of the test grid whose center is inside a polygon (even-odd rule), tested pixel by pixel
+    :param rings: list of numpy.ndarray (n, 2), closed rings
+    :return: numpy.ndarray (HEIGHT, WIDTH)
+    """
+    x, y = np.meshgrid(X_MIN + (np.arange(WIDTH) + 0.5) * CELL_SIZE, Y_MAX - (np.arange(HEIGHT) + 0.5) * CELL_SIZE)
+    inside = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    for ring in rings:
+        for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:]):
+            if y0 == y1:
+                continue
+            crosses = (y0 > y) != (y1 > y)
+            inside ^= crosses & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+    return inside
+
+
+def reference_stats(features, rasters, value, threshold=None):
+    """
+    Sum of value raster per feature and lossyear, computed with a python loop over the reference masks.
+    With a threshold, lossyear of pixels with TCD <= threshold is -1
+    :return: dict {(FID, VALUE): SUM}
+    """
+    lossyear = rasters["lossyear"].array
+    values = rasters[value].array
+    valid = (lossyear != rasters["lossyear"].info.nodata) & (values != rasters[value].info.nodata)
+    years = lossyear.astype('i4')
+    if threshold is not None:
+        years = np.where(rasters["tcd"].array > threshold, years, -1)
+
+    stats = dict()
+    for fid, rings in features:
+        mask = reference_mask(rings) & valid
+        for year in np.unique(years[mask]).tolist():
+            stats[(fid, year)] = values[mask & (years == year)].astype('f8').sum()
+    return stats
+
+
+def as_dict(records):
+    """
+    Results as dict {(FID, VALUE): SUM} or {(FID, TCD, VALUE): SUM}
+    """
+    keys = [name for name in records.dtype.names if name != 'SUM']
+    return dict((tuple(int(record[key]) for key in keys), float(record['SUM'])) for record in records)
+
+
+def assert_same_stats(actual, expected):
+    assert sorted(actual) == sorted(expected)
+    for key in expected:
+        assert abs(actual[key] - expected[key]) <= 1e-6 * max(abs(expected[key]), 1), key
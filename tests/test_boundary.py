@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+import boundary
+
+# Footprint with a notch in its upper edge, a sloped right edge and a hole
+EXTERIOR = np.array([[0, 0], [0, 100], [40, 100], [40, 60], [60, 60], [60, 100], [80, 100], [100, 0], [0, 0]],
+                    dtype='f8')
+HOLE = np.array([[20, 20], [40, 20], [40, 40], [20, 40], [20, 20]], dtype='f8')
+FOOTPRINT = [EXTERIOR, HOLE]
+
+
+def point_inside(rings, x, y):
+    """
+    Even-odd test of a single point
+    """
+    inside = False
+    for ring in rings:
+        for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:]):
+            if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+                inside = not inside
+    return inside
+
+
+def segment_hits_box(x0, y0, x1, y1, box):
+    """
+    Exact test if a segment intersects a closed box (Liang-Barsky clipping)
+    """
+    x_min, y_min, x_max, y_max = box
+    t0, t1 = 0.0, 1.0
+    for p, q in [(x0 - x1, x0 - x_min), (x1 - x0, x_max - x0), (y0 - y1, y0 - y_min), (y1 - y0, y_max - y0)]:
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        t = q / float(p)
+        if p < 0:
+            t0 = max(t0, t)
+        else:
+            t1 = min(t1, t)
+    return t0 <= t1
+
+
+def within(rings, box):
+    """
+    Exact test if a box is within a polygon: no edge of the polygon touches the box and the box center is inside
+    """
+    for ring in rings:
+        for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:]):
+            if segment_hits_box(x0, y0, x1, y1, box):
+                return False
+    return point_inside(rings, (box[0] + box[2]) / 2.0, (box[1] + box[3]) / 2.0)
+
+
+@pytest.mark.parametrize("box, state", [
+    ((5, 5, 15, 15), boundary.INSIDE),          # inside
+    ((85, 30, 95, 40), boundary.EDGE),          # straddles the sloped edge
+    ((45, 70, 55, 90), boundary.OUTSIDE),       # in the notch, within the bounding box of the footprint
+    ((25, 25, 35, 35), boundary.OUTSIDE),       # in the hole
+    ((90, 80, 110, 90), boundary.OUTSIDE),      # reaches beyond the bounding box of the footprint
+])
+def test_classify(box, state):
+    index = boundary.BoundaryIndex(FOOTPRINT, grid_size=64)
+    assert index.classify([box]).tolist() == [state]
+    assert within(FOOTPRINT, box) == (state == boundary.INSIDE)
+
+
+@pytest.mark.parametrize("grid_size", [8, 64, boundary.GRID_SIZE])
+def test_classify_random_boxes(grid_size):
+    # Inside and outside are only decided without exact test if they are certain
+    rng = np.random.RandomState(0)
+    corners = rng.uniform(-10, 110, (2000, 2))
+    sizes = rng.exponential(5, (2000, 2))
+    bounds = np.column_stack([corners, corners + sizes])
+
+    states = boundary.BoundaryIndex(FOOTPRINT, grid_size).classify(bounds)
+    exact = np.array([within(FOOTPRINT, box) for box in bounds.tolist()])
+
+    assert exact[states == boundary.INSIDE].all()
+    assert not exact[states == boundary.OUTSIDE].any()
+    # Only boxes close to an edge need an exact test
+    if grid_size == boundary.GRID_SIZE:
+        assert (states == boundary.EDGE).mean() < 0.25
+
+
+def test_classify_several_boundaries():
+    indexes = [boundary.BoundaryIndex(FOOTPRINT, 64), boundary.BoundaryIndex([HOLE], 64), boundary.BoundaryIndex([])]
+    states = boundary.classify(indexes, [(25, 25, 35, 35), (5, 5, 15, 15)])
+
+    assert states.tolist() == [[boundary.OUTSIDE, boundary.INSIDE, boundary.OUTSIDE],
+                               [boundary.INSIDE, boundary.OUTSIDE, boundary.OUTSIDE]]
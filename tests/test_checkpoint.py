@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+import checkpoint
+import zonal
+from conftest import Messages
+
+THRESHOLDS = [10, 30]
+
+
+def run(function, features, rasters, run_checkpoint):
+    return function(features, rasters["lossyear"], rasters["biomass"], rasters["tcd"], THRESHOLDS, 32, None, 1,
+                    run_checkpoint, Messages())
+
+
+def test_uncommitted_batch_is_truncated(tmp_path):
+    path = str(tmp_path / "run.txt")
+    records = np.array([(1, 5, 1.5), (1, 6, 2.5)], dtype=zonal.RESULT_DTYPE)
+
+    run_checkpoint = checkpoint.Checkpoint(path, "key")
+    run_checkpoint.write(records, [1])
+    run_checkpoint.close()
+    size = len(open(path, "rb").read())
+
+    # Crash in the middle of the next batch
+    with open(path, "ab") as f:
+        f.write(b"R 2 5 3.0\nF 2\n")
+
+    resumed = checkpoint.Checkpoint(path, "key")
+    resumed.close()
+    assert resumed.resumed
+    assert resumed.features == {1}
+    assert np.array_equal(resumed.records(), records)
+    assert len(open(path, "rb").read()) == size
+
+
+def test_other_run_starts_over(tmp_path):
+    path = str(tmp_path / "run.txt")
+    run_checkpoint = checkpoint.Checkpoint(path, "key")
+    run_checkpoint.write(np.array([(1, 5, 1.5)], dtype=zonal.RESULT_DTYPE), [1])
+    run_checkpoint.close()
+
+    other = checkpoint.Checkpoint(path, checkpoint.checkpoint_key("other"))
+    other.close()
+    assert not other.resumed
+    assert len(other.records()) == 0
+
+
+@pytest.mark.parametrize("function", [zonal.zonal_stats, zonal.labelled_zonal_stats])
+def test_resume(tmp_path, function, features, rasters):
+    path = str(tmp_path / "run.txt")
+    expected = zonal.merge_records(run(function, features, rasters, None))
+
+    # First run is interrupted after the first features or tiles
+    first = checkpoint.Checkpoint(path, "key")
+    messages = Messages()
+
+    def interrupt(message):
+        if len(messages.messages) == 3:
+            raise KeyboardInterrupt()
+        messages.messages.append(message)
+
+    messages.AddMessage = interrupt
+    with pytest.raises(KeyboardInterrupt):
+        function(features, rasters["lossyear"], rasters["biomass"], rasters["tcd"], THRESHOLDS, 32, None, 1,
+                 first, messages)
+    first.close()
+
+    resumed = checkpoint.Checkpoint(path, "key")
+    assert resumed.resumed
+    previous = resumed.records()
+    completed = set(resumed.features)
+    records = run(function, features, rasters, resumed)
+    resumed.close()
+
+    # Completed features are not computed again, completed tiles would be counted twice
+    assert not set(records['FID'].tolist()) & completed
+
+    results = zonal.merge_records(np.concatenate([previous, records]))
+    assert np.array_equal(results[['FID', 'VALUE']], expected[['FID', 'VALUE']])
+    assert np.allclose(results['SUM'], expected['SUM'], rtol=1e-9)
@@ -0,0 +1,313 @@
+import json
+import sqlite3
+import struct
+import numpy as np
+import pytest
+
+import geometry
+from conftest import Messages
+
+# Shapefile orientation: exterior rings clockwise, holes counter clockwise
+SQUARE = np.array([[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]], dtype='f8')
+HOLE = np.array([[2, 2], [4, 2], [4, 4], [2, 4], [2, 2]], dtype='f8')
+SECOND = np.array([[20, 0], [20, 5], [25, 5], [25, 0], [20, 0]], dtype='f8')
+
+# Multipart polygon with a hole in the first part
+MULTIPART = [[SQUARE, HOLE], [SECOND]]
+
+WGS84_PRJ = ('GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],'
+             'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]')
+
+
+def assert_same_parts(actual, expected):
+    assert len(actual) == len(expected)
+    for actual_part, expected_part in zip(actual, expected):
+        assert len(actual_part) == len(expected_part)
+        for actual_ring, expected_ring in zip(actual_part, expected_part):
+            assert actual_ring.shape == expected_ring.shape
+            assert np.array_equal(actual_ring, expected_ring)
+
+
+def wkb_polygon(rings, order="<", geometry_type=geometry.WKB_POLYGON, dimensions=2, srid=None):
+    """
+    WKB of a polygon, extra dimensions are filled with -1
+    """
+    data = struct.pack(order + "BI", 1 if order == "<" else 0, geometry_type)
+    if srid is not None:
+        data += struct.pack(order + "I", srid)
+    data += struct.pack(order + "I", len(rings))
+    for ring in rings:
+        points = np.hstack([ring, -np.ones((len(ring), dimensions - 2))])
+        data += struct.pack(order + "I", len(ring)) + points.astype(order + "f8").tobytes()
+    return data
+
+
+def wkb_multipolygon(parts, order="<", geometry_type=geometry.WKB_MULTIPOLYGON, part_type=geometry.WKB_POLYGON,
+                     dimensions=2):
+    data = struct.pack(order + "BII", 1 if order == "<" else 0, geometry_type, len(parts))
+    return data + b"".join([wkb_polygon(part, order, part_type, dimensions) for part in parts])
+
+
+def write_shapefile(path, shapes, shape_type=5, prj=None):
+    """
+    Write a polygon shapefile with .shx and .dbf (ID field)
+    :param shapes: list of list of rings, None for null shapes
+    """
+    records = list()
+    for rings in shapes:
+        if rings is None:
+            records.append(struct.pack("<i", 0))
+            continue
+        points = np.concatenate(rings)
+        starts = np.cumsum([0] + [len(ring) for ring in rings[:-1]])
+        content = struct.pack("<i4d2i", shape_type, points[:, 0].min(), points[:, 1].min(), points[:, 0].max(),
+                              points[:, 1].max(), len(rings), len(points))
+        content += starts.astype('<i4').tobytes() + points.astype('<f8').tobytes()
+        if shape_type == 15:
+            # Z range and values, M range and values
+            content += struct.pack("<2d", 0, 0) + np.zeros(len(points), '<f8').tobytes()
+            content += struct.pack("<2d", 0, 0) + np.zeros(len(points), '<f8').tobytes()
+        records.append(content)
+
+    def header(length):
+        return (struct.pack(">7i", 9994, 0, 0, 0, 0, 0, length // 2) + struct.pack("<2i", 1000, shape_type) +
+                struct.pack("<8d", 0, 0, 30, 10, 0, 0, 0, 0))
+
+    shp = b""
+    shx = b""
+    offset = 100
+    for number, content in enumerate(records):
+        shx += struct.pack(">2i", offset // 2, len(content) // 2)
+        shp += struct.pack(">2i", number + 1, len(content) // 2) + content
+        offset += 8 + len(content)
+
+    with open(path, "wb") as f:
+        f.write(header(100 + len(shp)) + shp)
+    with open(path[:-4] + ".shx", "wb") as f:
+        f.write(header(100 + len(shx)) + shx)
+    with open(path[:-4] + ".dbf", "wb") as f:
+        f.write(struct.pack("<B3BIHH20x", 3, 120, 1, 1, len(records), 65, 11))
+        f.write(struct.pack("<11sc4xBB14x", b"ID", b"N", 10, 0) + b"\r")
+        f.write(b"".join([b" " + str(i).rjust(10).encode("ascii") for i in range(len(records))]) + b"\x1a")
+    if prj is not None:
+        with open(path[:-4] + ".prj", "w") as f:
+            f.write(prj)
+
+
+def gpkg_blob(wkb, envelope=0, empty=False):
+    """
+    GeoPackage geometry blob, little endian header with envelope of given type (0: none, 1: xy, 2: xyz, 4: xyzm)
+    """
+    flags = 1 | (envelope << 1) | (0x10 if empty else 0)
+    size = {0: 0, 1: 4, 2: 6, 4: 8}[envelope]
+    return b"GP" + struct.pack("<BBi", 0, flags, 4326) + np.zeros(size, '<f8').tobytes() + wkb
+
+
+def write_geopackage(path, layers):
+    """
+    :param layers: list of (table name, srs (id, organization, organization id, definition), list of (fid, blob))
+    """
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT, srs_id INTEGER PRIMARY KEY, "
+                       "organization TEXT, organization_coordsys_id INTEGER, definition TEXT)")
+    connection.execute("CREATE TABLE gpkg_geometry_columns (table_name TEXT, column_name TEXT, "
+                       "geometry_type_name TEXT, srs_id INTEGER, z INTEGER, m INTEGER)")
+    for table, srs, rows in layers:
+        connection.execute("INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES ('', ?, ?, ?, ?)", srs)
+        connection.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'MULTIPOLYGON', ?, 0, 0)",
+                           (table, srs[0]))
+        connection.execute('CREATE TABLE "{}" (name TEXT, fid INTEGER PRIMARY KEY, geom BLOB)'.format(table))
+        connection.executemany('INSERT INTO "{}" (fid, geom) VALUES (?, ?)'.format(table), rows)
+    connection.commit()
+    connection.close()
+
+
+@pytest.mark.parametrize("order", ["<", ">"])
+@pytest.mark.parametrize("geometry_type, dimensions", [(3, 2), (1003, 3), (2003, 3), (3003, 4),
+                                                       (0x80000003, 3), (0x40000003, 3), (0xC0000003, 4)])
+def test_wkb_polygon(order, geometry_type, dimensions):
+    data = b"prefix" + wkb_polygon([SQUARE, HOLE], order, geometry_type, dimensions) + b"suffix"
+    parts, offset = geometry.wkb_parts(data, 6)
+
+    assert_same_parts(parts, [[SQUARE, HOLE]])
+    assert data[offset:] == b"suffix"
+
+
+def test_wkb_srid():
+    data = wkb_polygon([SQUARE], geometry_type=0x20000003, srid=4326)
+    parts, offset = geometry.wkb_parts(data, 0)
+
+    assert_same_parts(parts, [[SQUARE]])
+    assert offset == len(data)
+
+
+@pytest.mark.parametrize("geometry_type, part_type, dimensions", [(6, 3, 2), (1006, 1003, 3), (3006, 3003, 4)])
+def test_wkb_multipolygon(geometry_type, part_type, dimensions):
+    data = wkb_multipolygon(MULTIPART, ">", geometry_type, part_type, dimensions)
+    parts, offset = geometry.wkb_parts(data, 0)
+
+    assert_same_parts(parts, MULTIPART)
+    assert offset == len(data)
+
+
+def test_wkb_empty_and_degenerate_rings():
+    # Polygon without rings, empty MultiPolygon and ring with two points are no parts
+    assert geometry.wkb_parts(wkb_polygon([]), 0)[0] == []
+    assert geometry.wkb_parts(wkb_multipolygon([]), 0)[0] == []
+    assert_same_parts(geometry.wkb_parts(wkb_polygon([SQUARE, HOLE[:2]]), 0)[0], [[SQUARE]])
+
+
+def test_wkb_unsupported_type():
+    with pytest.raises(Exception):
+        geometry.wkb_parts(struct.pack("<BI2d", 1, 1, 0.0, 0.0), 0)
+
+
+def test_signed_area():
+    assert geometry.signed_area(SQUARE) == -100
+    assert geometry.signed_area(SQUARE[::-1]) == 100
+    assert geometry.signed_area(HOLE) == 4
+
+
+@pytest.mark.parametrize("shape_type", [5, 15])
+def test_read_shapefile(tmp_path, shape_type):
+    path = str(tmp_path / "features.shp")
+    write_shapefile(path, [[SQUARE, HOLE, SECOND],
+                           None,
+                           [SQUARE[::-1]],
+                           [SQUARE[::-1], SECOND, HOLE[:2]]], shape_type, WGS84_PRJ)
+
+    features, crs = geometry.read_shapefile(path)
+
+    assert crs == geometry.WGS84
+    assert [fid for fid, parts in features] == [0, 1, 2, 3]
+    # Clockwise rings start a part, counter clockwise rings are holes
+    assert_same_parts(features[0][1], MULTIPART)
+    # Null shape
+    assert features[1][1] == []
+    # First ring always starts a part, also with wrong orientation. Rings with less than 3 points are dropped
+    assert_same_parts(features[2][1], [[SQUARE[::-1]]])
+    assert_same_parts(features[3][1], [[SQUARE[::-1]], [SECOND]])
+
+
+def test_prj_crs(tmp_path):
+    mercator = ('PROJCS["WGS_1984_Web_Mercator_Auxiliary_Sphere",GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",'
+                'SPHEROID["WGS_1984",6378137.0,298.257223563]]]]')
+    utm = 'PROJCS["WGS_1984_UTM_Zone_33N",GEOGCS["GCS_WGS_1984"]]'
+
+    assert geometry.prj_crs(str(tmp_path / "missing.prj")) is None
+    for wkt, expected in [(WGS84_PRJ, geometry.WGS84), (mercator, 3857), (utm, utm)]:
+        path = str(tmp_path / "features.prj")
+        with open(path, "w") as f:
+            f.write(wkt + "\n")
+        assert geometry.prj_crs(path) == expected
+
+
+def test_read_geopackage(tmp_path):
+    path = str(tmp_path / "features.gpkg")
+    wkb = wkb_multipolygon(MULTIPART)
+    write_geopackage(path, [
+        ("first", (4326, "EPSG", 4326, ""), [(7, gpkg_blob(wkb)),
+                                               (8, gpkg_blob(wkb_polygon([SQUARE], ">", 1003, 3), 1)),
+                                               (9, gpkg_blob(wkb_polygon([SECOND], "<", 3003, 4), 2)),
+                                               (10, gpkg_blob(wkb, 4)),
+                                               (11, gpkg_blob(wkb_polygon([]), empty=True)),
+                                               (12, None)]),
+        ("second", (1, "NONE", 1, "LOCAL_CS"), [(1, gpkg_blob(wkb_polygon([SECOND])))])])
+
+    features, crs = geometry.read_geopackage(path)
+    assert crs == 4326
+    assert [fid for fid, parts in features] == [7, 8, 9, 10, 11, 12]
+    assert_same_parts(features[0][1], MULTIPART)
+    assert_same_parts(features[1][1], [[SQUARE]])
+    assert_same_parts(features[2][1], [[SECOND]])
+    assert_same_parts(features[3][1], MULTIPART)
+    assert features[4][1] == []
+    assert features[5][1] == []
+
+    features, crs = geometry.read_geopackage(path, "second")
+    assert crs == "LOCAL_CS"
+    assert_same_parts(features[0][1], [[SECOND]])
+
+    with pytest.raises(Exception):
+        geometry.read_geopackage(path, "missing")
+
+
+def test_read_geojson(tmp_path):
+    path = str(tmp_path / "features.geojson")
+    data = {"type": "FeatureCollection",
+            "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG::3857"}},
+            "features": [
+                {"type": "Feature", "id": 5, "geometry": {"type": "MultiPolygon", "coordinates": [
+                    [SQUARE.tolist(), HOLE.tolist()], [SECOND.tolist()]]}},
+                {"type": "Feature", "id": "a", "geometry": {"type": "Polygon", "coordinates": [
+                    [[x, y, 1.0] for x, y in SQUARE.tolist()], HOLE[:2].tolist()]}},
+                {"type": "Feature", "geometry": None},
+                {"type": "Feature", "geometry": {"type": "Point", "coordinates": [1, 2]}}]}
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+    features, crs = geometry.read_geojson(path)
+
+    assert crs == 3857
+    # Features without numeric id are numbered in file order
+    assert [fid for fid, parts in features] == [5, 1, 2, 3]
+    assert_same_parts(features[0][1], MULTIPART)
+    assert_same_parts(features[1][1], [[SQUARE]])
+    assert features[2][1] == []
+    assert features[3][1] == []
+
+
+def test_geojson_default_crs(tmp_path):
+    path = str(tmp_path / "feature.json")
+    with open(path, "w") as f:
+        json.dump({"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [SQUARE.tolist()]}}, f)
+
+    features, crs = geometry.read_file(path)
+    assert crs == geometry.WGS84
+    assert_same_parts(features[0][1], [[SQUARE]])
+
+
+def test_geometry_store():
+    store = geometry.GeometryStore.from_features([(3, MULTIPART), (4, [[SECOND]])], geometry.WGS84)
+
+    assert store.fids.tolist() == [3, 4]
+    assert np.array_equal(store.bounds, [[0, 0, 25, 10], [20, 0, 25, 5]])
+    assert_same_parts([store.rings(0)], [[SQUARE, HOLE, SECOND]])
+    assert store.geojson(0)["coordinates"] == [[SQUARE.tolist(), HOLE.tolist()], [SECOND.tolist()]]
+
+    subset = store.subset(np.array([False, True]))
+    assert subset.fids.tolist() == [4]
+    assert_same_parts([subset.rings(0)], [[SECOND]])
+    assert subset.crs == geometry.WGS84
+
+
+def test_can_read(tmp_path):
+    for name in ["a.shp", "b.SHP", "c.gpkg", "d.geojson", "e.json"]:
+        (tmp_path / name).write_bytes(b"")
+        assert geometry.can_read(str(tmp_path / name))
+
+    # Geodatabase feature classes, other formats and missing files are read with arcpy
+    (tmp_path / "f.kml").write_bytes(b"")
+    (tmp_path / "g.gdb").mkdir()
+    for path in ["f.kml", "g.gdb", "g.gdb/features", "missing.shp"]:
+        assert not geometry.can_read(str(tmp_path / path))
+
+
+def test_read_features_arcpy_fallback(tmp_path):
+    arcpy = pytest.importorskip("arcpy")
+    import analysis
+    import util
+
+    path = str(tmp_path / "features.shp")
+    write_shapefile(path, [[SQUARE, HOLE, SECOND], [SECOND]], prj=WGS84_PRJ)
+    spatial_reference = arcpy.SpatialReference(geometry.WGS84)
+
+    # Files are read without arcpy unless arcpy geometries are needed
+    direct, geometries = analysis.read_features(path, spatial_reference, False, util.FeatureTracker(2), Messages())
+    assert geometries is None
+    fallback, geometries = analysis.read_features(path, spatial_reference, True, util.FeatureTracker(2), Messages())
+    assert len(geometries) == 2
+
+    assert fallback.fids.tolist() == direct.fids.tolist()
+    assert np.array_equal(fallback.part_offsets, direct.part_offsets)
+    assert np.allclose(fallback.coords, direct.coords)
@@ -0,0 +1,116 @@
+import pickle
+import numpy as np
+import pytest
+
+import raster_io
+from conftest import CELL_SIZE, X_MIN, Y_MAX, ArrayReader
+
+
+@pytest.fixture
+def sources(monkeypatch):
+    """
+    Source rasters of a mosaic by path. Source b overlaps the lower right of source a and has a NoData pixel,
+    source c is separated by a gap. Opened sources are counted
+    """
+    a = np.arange(100, dtype='u1').reshape(10, 10)
+    b = np.full((10, 10), 200, dtype='u1')
+    b[0, 0] = 255
+    c = np.full((5, 5), 100, dtype='u1')
+    readers = {"a.tif": ArrayReader(a, 255),
+               "b.tif": ArrayReader(b, 255, x_min=X_MIN + 5 * CELL_SIZE, y_max=Y_MAX - 5 * CELL_SIZE),
+               "c.tif": ArrayReader(c, 255, x_min=X_MIN + 20 * CELL_SIZE, y_max=Y_MAX)}
+
+    opened = list()
+
+    def open_raster(path):
+        if path not in readers:
+            raise Exception("Cannot open raster {}".format(path))
+        opened.append(path)
+        return readers[path]
+
+    monkeypatch.setattr(raster_io, "open_raster", open_raster)
+    monkeypatch.setattr(raster_io, "raster_exists", lambda path: path in readers)
+    return readers, opened
+
+
+def mosaic(readers):
+    """
+    Expected mosaic of the sources, the last source wins where sources overlap
+    """
+    out = np.full((15, 25), 255, dtype='u1')
+    for path in sorted(readers):
+        reader = readers[path]
+        col_off, row_off = raster_io.RasterInfo(X_MIN, Y_MAX, CELL_SIZE, CELL_SIZE, 25, 15, 'u1').offset(reader.info)
+        rows, cols = reader.array.shape
+        target = out[row_off:row_off + rows, col_off:col_off + cols]
+        np.copyto(target, reader.array, where=reader.array != 255)
+    return out
+
+
+def test_footprint_records(sources):
+    readers, opened = sources
+    footprints = raster_io.footprint_records(["a.tif", "b.tif"])
+
+    assert footprints['PATH'].tolist() == ["a.tif", "b.tif"]
+    assert np.allclose(footprints['X_MIN'], [X_MIN, X_MIN + 5 * CELL_SIZE])
+    assert footprints[['WIDTH', 'HEIGHT', 'BLOCK_COLS', 'BLOCK_ROWS']].tolist() == [(10, 10, 16, 16)] * 2
+    assert footprints['DTYPE'].tolist() == ['uint8'] * 2
+    assert footprints[['NODATA', 'HAS_NODATA']].tolist() == [(255, 1)] * 2
+
+    # Error names the source which cannot be read
+    with pytest.raises(Exception) as error:
+        raster_io.footprint_records(["a.tif", "missing.tif"])
+    assert "missing.tif" in str(error.value)
+
+
+def test_footprint_reader(sources):
+    readers, opened = sources
+    reader = raster_io.FootprintReader("mosaic", raster_io.footprint_records(["a.tif", "b.tif", "c.tif"]))
+    del opened[:]
+
+    assert (reader.info.width, reader.info.height) == (25, 15)
+    assert reader.info.nodata == 255
+    expected = mosaic(readers)
+
+    # Windows within a single source, across sources and gaps, and only sources intersecting a window are opened
+    assert np.array_equal(reader.read(0, 0, 4, 4), expected[:4, :4])
+    assert opened == ["a.tif"]
+    for window in [(3, 2, 12, 10), (0, 0, 25, 15), (8, 0, 15, 5), (5, 10, 10, 5)]:
+        col_off, row_off, cols, rows = window
+        assert np.array_equal(reader.read(*window), expected[row_off:row_off + rows, col_off:col_off + cols])
+    assert sorted(reader.readers) == [0, 1, 2]
+
+    # Overlap: last source wins, except where it has NoData
+    assert reader.read(6, 6, 1, 1)[0, 0] == 200
+    assert reader.read(5, 5, 1, 1)[0, 0] == 55
+
+
+def test_footprint_reader_pickle(sources):
+    readers, opened = sources
+    reader = raster_io.FootprintReader("mosaic", raster_io.footprint_records(["a.tif", "b.tif"]))
+    expected = reader.read(0, 0, 15, 15)
+
+    # Worker processes get the footprint index without open source rasters
+    copy = pickle.loads(pickle.dumps(reader))
+    assert copy.readers == {}
+    assert len(reader.readers) == 2
+    assert np.array_equal(copy.read(0, 0, 15, 15), expected)
+
+    reader.close()
+    assert reader.readers == {}
+
+
+def test_footprint_reader_checks_sources(sources):
+    readers, opened = sources
+    footprints = raster_io.footprint_records(["a.tif", "b.tif"])
+    footprints['PATH'][1] = "moved.tif"
+    del opened[:]
+
+    # Fails when created, not on first read of the missing source
+    with pytest.raises(Exception) as error:
+        raster_io.FootprintReader("mosaic", footprints)
+    assert "moved.tif" in str(error.value)
+    assert opened == []
+
+    with pytest.raises(Exception):
+        raster_io.FootprintReader("mosaic", footprints[:0])
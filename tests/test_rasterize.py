@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+import raster_io
+import rasterize
+import zonal
+from conftest import CELL_SIZE, HEIGHT, WIDTH, X_MIN, Y_MAX, reference_mask
+
+INFO = raster_io.RasterInfo(X_MIN, Y_MAX, CELL_SIZE, CELL_SIZE, WIDTH, HEIGHT, 'u1')
+
+WINDOWS = [(0, 0, WIDTH, HEIGHT), (13, 7, 50, 41), (0, 60, 7, 40), (100, 0, 20, 1)]
+
+
+def star(rng, col, row, vertices):
+    """
+    Random closed star shaped ring around a pixel position of the test grid
+    """
+    center = np.array([X_MIN + (col + rng.uniform(-5, 5)) * CELL_SIZE, Y_MAX - (row + rng.uniform(-5, 5)) * CELL_SIZE])
+    angles = np.sort(rng.uniform(0, 2 * np.pi, vertices))
+    radius = rng.uniform(3, 22, vertices) * CELL_SIZE
+    ring = center + np.c_[radius * np.cos(angles), radius * np.sin(angles)]
+    return np.vstack([ring, ring[:1]])
+
+
+@pytest.fixture
+def polygons():
+    """
+    Random star polygons on a 4 x 3 layout, every second one with a hole. Neighbours may overlap
+    """
+    rng = np.random.RandomState(1)
+    polygons = list()
+    for i in range(12):
+        exterior = star(rng, 15 + 30 * (i % 4), 17 + 33 * (i // 4), rng.randint(3, 40))
+        rings = [exterior]
+        if i % 2:
+            center = exterior[:-1].mean(axis=0)
+            rings.append(center + (exterior - center) * 0.3)
+        polygons.append(rings)
+    return polygons
+
+
+def test_masks_match_reference(polygons):
+    for rings in polygons:
+        expected = reference_mask(rings)
+        for col_off, row_off, cols, rows in WINDOWS:
+            mask = rasterize.rasterize_polygon(rings, INFO, col_off, row_off, cols, rows)
+            assert np.array_equal(mask, expected[row_off:row_off + rows, col_off:col_off + cols])
+
+
+def test_nonzero_is_union_of_rings(polygons):
+    rings = [polygons[0][0], polygons[2][0], polygons[4][0]]
+    expected = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    for ring in rings:
+        expected |= reference_mask([ring])
+
+    # Same orientation for all rings, overlaps have a winding number of 2
+    mask = rasterize.rasterize_polygon(rings, INFO, 0, 0, WIDTH, HEIGHT, rule=rasterize.NONZERO)
+    assert np.array_equal(mask, expected)
+
+
+def test_all_touched_covers_supersampled_mask(polygons):
+    for rings in polygons:
+        centers = rasterize.rasterize_polygon(rings, INFO, 0, 0, WIDTH, HEIGHT)
+        touched = rasterize.rasterize_polygon(rings, INFO, 0, 0, WIDTH, HEIGHT, all_touched=True)
+
+        # Every pixel which contains a point of the polygon is touched
+        fine = raster_io.RasterInfo(X_MIN, Y_MAX, CELL_SIZE / 8, CELL_SIZE / 8, WIDTH * 8, HEIGHT * 8, 'u1')
+        samples = rasterize.rasterize_polygon(rings, fine, 0, 0, WIDTH * 8, HEIGHT * 8)
+        sampled = samples.reshape(HEIGHT, 8, WIDTH, 8).any(axis=(1, 3))
+
+        assert not (centers & ~touched).any()
+        assert not (sampled & ~touched).any()
+
+
+def test_labels_match_masks(polygons):
+    masks = [reference_mask(rings) for rings in polygons]
+    counts = np.sum(masks, axis=0)
+
+    labels, overlapping = rasterize.rasterize_labels(polygons, INFO, 0, 0, WIDTH, HEIGHT)
+
+    for i, mask in enumerate(masks):
+        # Polygons are only left out of the label raster if they share a pixel with another polygon
+        assert overlapping[i] == (counts[mask] > 1).any()
+        if not overlapping[i]:
+            assert np.array_equal(labels == i, mask)
+    assert not ((labels >= 0) & (counts > 1)).any()
+
+
+def test_label_tile_layers_match_masks(polygons):
+    features = [(i, rings) for i, rings in enumerate(polygons)]
+    bounds = zonal.feature_arrays(features)[0]
+
+    for col_off, row_off, cols, rows in WINDOWS:
+        layers = zonal.label_tile(features, bounds, INFO, col_off, row_off, cols, rows)
+        for i, rings in enumerate(polygons):
+            expected = reference_mask(rings)[row_off:row_off + rows, col_off:col_off + cols]
+            burned = np.zeros((rows, cols), dtype='i4')
+            for layer in layers:
+                burned += layer == i
+            assert np.array_equal(burned, expected)
@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+
+import tables
+import zonal
+
+COMBINED_DTYPE = np.dtype([('FID', 'i4'), ('TCD', 'i4'), ('VALUE', 'i4'), ('AREA', 'f8'), ('BIOMASS', 'f8')])
+
+
+def loss_records():
+    # Area in m2 (10000 m2 = 1 ha) or biomass in Mg
+    return np.array([(1, 30, 2, 20000.0), (2, 30, -1, 5000.0), (2, 10, 0, 10000.0), (1, 10, 3, 30000.0),
+                     (2, 30, 1, 40000.0)], dtype=zonal.THRESHOLD_RESULT_DTYPE)
+
+
+def test_format_loss():
+    out = tables.format_loss(loss_records())
+
+    assert out.dtype.names == ('FID', 'YEAR', 'TCD', 'LOSS_HA')
+    # FID descending, then TCD and lossyear ascending
+    assert out['FID'].tolist() == [2, 2, 2, 1, 1]
+    assert out['TCD'].tolist() == [10, 30, 30, 10, 30]
+    assert out['YEAR'].tolist() == ["no loss", "area outside threshold", "Year 2001", "Year 2003", "Year 2002"]
+    assert np.allclose(out['LOSS_HA'], [1.0, 0.5, 4.0, 3.0, 2.0])
+
+
+def test_format_biomass_loss():
+    out = tables.format_biomass_loss(loss_records())
+
+    assert out.dtype.names == ('FID', 'YEAR', 'TCD', 'BIOMASS_LOSS_MG', 'EMISSIONS_MT_CO2')
+    assert out['YEAR'].tolist() == ["no biomass loss", "biomass outside threshold", "Year 2001", "Year 2003",
+                                    "Year 2002"]
+    assert np.allclose(out['BIOMASS_LOSS_MG'], [10000.0, 5000.0, 40000.0, 30000.0, 20000.0])
+    # 1 Mg biomass = 0.5 Mg carbon = 1.835 Mg CO2
+    assert np.allclose(out['EMISSIONS_MT_CO2'], [0.01835, 0.009175, 0.0734, 0.05505, 0.0367])
+
+
+def test_format_combined_loss():
+    records = np.array([(1, 30, 5, 20000.0, 1000000.0), (3, 30, 0, 10000.0, 2000000.0)], dtype=COMBINED_DTYPE)
+    out = tables.format_combined_loss(records)
+
+    assert out.dtype.names == ('FID', 'YEAR', 'TCD', 'LOSS_HA', 'BIOMASS_LOSS_MG', 'EMISSIONS_MT_CO2')
+    assert out['FID'].tolist() == [3, 1]
+    assert out['YEAR'].tolist() == ["no loss", "Year 2005"]
+    assert np.allclose(out['LOSS_HA'], [1.0, 2.0])
+    assert np.allclose(out['BIOMASS_LOSS_MG'], [2000000.0, 1000000.0])
+    assert np.allclose(out['EMISSIONS_MT_CO2'], [3.67, 1.835])
+
+
+def test_format_empty():
+    out = tables.format_loss(np.empty(0, dtype=zonal.THRESHOLD_RESULT_DTYPE))
+    assert len(out) == 0
+    assert out.dtype == tables.LOSS_DTYPE
+
+
+def test_sort_records():
+    records = tables.sort_records(loss_records())
+    assert records[['FID', 'TCD', 'VALUE']].tolist() == [(2, 10, 0), (2, 30, -1), (2, 30, 1), (1, 10, 3),
+                                                         (1, 30, 2)]
+
+
+def test_pivot_loss():
+    # Lossyear beyond the last year is ignored, rows with the same lossyear are summed up
+    records = np.concatenate([loss_records(), np.array([(2, 30, 9, 10000.0), (2, 30, 1, 10000.0)],
+                                                       dtype=zonal.THRESHOLD_RESULT_DTYPE)])
+    out = tables.pivot_loss(records, 4)
+
+    # Every year has a column, also without loss in any feature
+    assert out.dtype.names == ('FID', 'TCD', 'area_outside_threshold', 'no_loss',
+                               'Year_2001', 'Year_2002', 'Year_2003', 'Year_2004')
+    assert out[['FID', 'TCD']].tolist() == [(1, 10), (1, 30), (2, 10), (2, 30)]
+    assert np.allclose(out['area_outside_threshold'], [0, 0, 0, 0.5])
+    assert np.allclose(out['no_loss'], [0, 0, 1.0, 0])
+    assert np.allclose(out['Year_2001'], [0, 0, 0, 5.0])
+    assert np.allclose(out['Year_2002'], [0, 2.0, 0, 0])
+    assert np.allclose(out['Year_2003'], [3.0, 0, 0, 0])
+    assert np.allclose(out['Year_2004'], [0, 0, 0, 0])
+
+
+def test_pivot_biomass_loss():
+    biomass = tables.pivot_biomass_loss(loss_records(), 3, "Mg biomass")
+    emissions = tables.pivot_biomass_loss(loss_records(), 3, "MT CO2")
+
+    for out in [biomass, emissions]:
+        assert out.dtype.names == ('FID', 'TCD', 'biomass_outside_threshold', 'no_biomass_loss',
+                                   'Year_2001', 'Year_2002', 'Year_2003')
+    assert np.allclose(biomass['Year_2003'], [30000.0, 0, 0, 0])
+    assert np.allclose(emissions['Year_2003'], [0.05505, 0, 0, 0])
+
+
+def test_pivot_combined_loss():
+    records = np.array([(1, 30, 2, 20000.0, 1000000.0), (1, 30, -1, 10000.0, 2000000.0)], dtype=COMBINED_DTYPE)
+    out = tables.pivot_combined_loss(records, 2)
+
+    assert out.dtype.names == ('FID', 'TCD',
+                               'HA_outside_threshold', 'HA_no_loss', 'HA_Year_2001', 'HA_Year_2002',
+                               'MG_outside_threshold', 'MG_no_loss', 'MG_Year_2001', 'MG_Year_2002',
+                               'MT_CO2_outside_threshold', 'MT_CO2_no_loss', 'MT_CO2_Year_2001',
+                               'MT_CO2_Year_2002')
+    row = out[0]
+    assert [row[name] for name in out.dtype.names] == pytest.approx([1, 30, 1.0, 0, 0, 2.0, 2000000.0, 0, 0,
+                                                                     1000000.0, 3.67, 0, 0, 1.835])
+
+
+def test_result_sink_grows_and_flushes_batches():
+    batches = list()
+    sink = tables.ResultSink(zonal.RESULT_DTYPE, 2, 3, lambda records: batches.append(records.copy()))
+    rows = np.array([(i, i % 3, i * 1.5) for i in range(6)], dtype=zonal.RESULT_DTYPE)
+
+    sink.append(rows[:2])
+    sink.append(None)
+    sink.append(rows[:0])
+    assert len(sink) == 2
+    assert batches == []
+
+    # Grows past capacity, batch is full
+    sink.append(rows[2:5])
+    assert len(sink) == 5
+    assert [batch.tolist() for batch in batches] == [rows[:5].tolist()]
+
+    sink.append(rows[5:])
+    assert len(batches) == 1
+    sink.flush()
+    sink.flush()
+    assert [batch.tolist() for batch in batches] == [rows[:5].tolist(), rows[5:].tolist()]
+    assert sink.records().tolist() == rows.tolist()
+
+
+def test_result_sink_without_writer():
+    sink = tables.ResultSink(zonal.RESULT_DTYPE, 0, 1, None)
+    records = np.array([(1, 2, 3.0), (4, 5, 6.0)], dtype=[('FID', 'i8'), ('VALUE', 'i8'), ('SUM', 'f4')])
+    for i in range(3):
+        sink.append(records)
+    sink.flush()
+
+    assert sink.records().dtype == zonal.RESULT_DTYPE
+    assert sink.records().tolist() == records.tolist() * 3
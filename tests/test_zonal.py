@@ -0,0 +1,156 @@
+import numpy as np
+import pytest
+
+import raster_io
+import zonal
+from conftest import ArrayReader, Messages, as_dict, assert_same_stats, reference_stats
+
+THRESHOLDS = [10, 30, 50]
+
+
+def run(function, features, rasters, value, thresholds=None, tile_size=4096, workers=1, checkpoint=None):
+    tcd = rasters["tcd"] if thresholds is not None else None
+    values = [rasters[name] if name != raster_io.PIXEL_AREA else name for name in zonal.value_list(value)]
+    records = function(features, rasters["lossyear"], values if isinstance(value, list) else values[0], tcd,
+                       thresholds, tile_size, None, workers, checkpoint, Messages())
+    return zonal.merge_records(records)
+
+
+@pytest.mark.parametrize("function", [zonal.zonal_stats, zonal.labelled_zonal_stats])
+def test_sums_match_reference(function, features, rasters):
+    results = run(function, features, rasters, "biomass", tile_size=32)
+    assert_same_stats(as_dict(results), reference_stats(features, rasters, "biomass"))
+
+
+def test_labelled_matches_per_feature(features, rasters):
+    values = [raster_io.PIXEL_AREA, "biomass"]
+    per_feature = run(zonal.zonal_stats, features, rasters, values, THRESHOLDS, tile_size=32)
+    labelled = run(zonal.labelled_zonal_stats, features, rasters, values, THRESHOLDS, tile_size=32)
+
+    assert np.array_equal(per_feature[['FID', 'VALUE']], labelled[['FID', 'VALUE']])
+    assert np.allclose(per_feature['SUM'], labelled['SUM'], rtol=1e-9)
+
+
+@pytest.mark.parametrize("function", [zonal.zonal_stats, zonal.labelled_zonal_stats])
+def test_tile_size_does_not_change_results(function, features, rasters):
+    small = run(function, features, rasters, "biomass", THRESHOLDS, tile_size=16)
+    large = run(function, features, rasters, "biomass", THRESHOLDS, tile_size=4096)
+
+    assert np.array_equal(small[['FID', 'VALUE']], large[['FID', 'VALUE']])
+    assert np.allclose(small['SUM'], large['SUM'], rtol=1e-9)
+
+
+@pytest.mark.parametrize("function", [zonal.zonal_stats, zonal.labelled_zonal_stats])
+def test_workers_match_single_process(function, features, rasters):
+    single = run(function, features, rasters, "biomass", THRESHOLDS, tile_size=32)
+    parallel = run(function, features, rasters, "biomass", THRESHOLDS, tile_size=32, workers=2)
+
+    assert np.array_equal(single[['FID', 'VALUE']], parallel[['FID', 'VALUE']])
+    assert np.allclose(single['SUM'], parallel['SUM'], rtol=1e-9)
+
+
+@pytest.mark.parametrize("function", [zonal.zonal_stats, zonal.labelled_zonal_stats])
+def test_split_thresholds(function, features, rasters):
+    records = run(function, features, rasters, "biomass", THRESHOLDS)
+    split = as_dict(zonal.split_thresholds(records, THRESHOLDS))
+
+    for threshold in THRESHOLDS:
+        expected = reference_stats(features, rasters, "biomass", threshold)
+        assert_same_stats(dict(((fid, value), total) for (fid, tcd, value), total in split.items()
+                               if tcd == threshold), expected)
+
+
+def test_split_thresholds_codes():
+    # TCD bucket 0 (TCD <= 10), 1 (10 < TCD <= 30) and 2 (TCD > 30) of lossyear 5, and bucket 2 of lossyear 0
+    records = np.array([(1, 5, 1.0), (1, zonal.YEAR_CODES + 5, 2.0), (1, 2 * zonal.YEAR_CODES + 5, 4.0),
+                        (1, 2 * zonal.YEAR_CODES, 8.0)], dtype=zonal.RESULT_DTYPE)
+    split = as_dict(zonal.split_thresholds(records, [10, 30]))
+
+    assert split == {(1, 10, -1): 1.0, (1, 10, 0): 8.0, (1, 10, 5): 6.0,
+                     (1, 30, -1): 3.0, (1, 30, 0): 8.0, (1, 30, 5): 4.0}
+
+
+def test_split_values(features, rasters):
+    combined = run(zonal.zonal_stats, features, rasters, [raster_io.PIXEL_AREA, "biomass"], THRESHOLDS)
+    area, biomass = zonal.split_values(combined, 2)
+
+    for records, value in [(area, raster_io.PIXEL_AREA), (biomass, "biomass")]:
+        single = run(zonal.zonal_stats, features, rasters, value, THRESHOLDS)
+        assert np.array_equal(records[['FID', 'VALUE']], single[['FID', 'VALUE']])
+        assert np.allclose(records['SUM'], single['SUM'], rtol=1e-9)
+
+
+def reference_areas(latitudes, cell_width, cell_height):
+    """
+    Area in m2 of small WGS84 cells centered at latitudes: cell length along the meridian (radius of curvature M)
+    times cell length along the parallel (radius of curvature N times cos(lat))
+    """
+    a = 6378137.0
+    e2 = (2 - 1 / 298.257223563) / 298.257223563
+    lat = np.radians(latitudes)
+    w = 1 - e2 * np.sin(lat) ** 2
+    meridian = a * (1 - e2) / w ** 1.5 * np.radians(cell_height)
+    parallel = a / np.sqrt(w) * np.cos(lat) * np.radians(cell_width)
+    return meridian * parallel
+
+
+@pytest.mark.parametrize("latitude", [0, 45, 60, -60])
+def test_pixel_area_matches_ellipsoid(latitude):
+    cell_size = 0.00025
+    y_max = latitude + 5 * cell_size
+    reader = raster_io.PixelAreaReader(raster_io.RasterInfo(0.0, y_max, cell_size, cell_size, 20, 10, 'u1'))
+    expected = reference_areas(y_max - (np.arange(10) + 0.5) * cell_size, cell_size, cell_size)
+
+    assert np.allclose(reader.read(3, 0, 7, 10), expected[:, np.newaxis], rtol=1e-8)
+    assert np.allclose(reader.read(0, 4, 20, 3), expected[4:7, np.newaxis], rtol=1e-8)
+
+
+def test_pixel_area_matches_area_raster(features, rasters):
+    info = rasters["lossyear"].info
+    areas = reference_areas(info.y_max - (np.arange(info.height) + 0.5) * info.cell_height, info.cell_width,
+                            info.cell_height)
+    rasters["area"] = ArrayReader(np.repeat(areas[:, np.newaxis], info.width, axis=1))
+
+    computed = run(zonal.zonal_stats, features, rasters, raster_io.PIXEL_AREA)
+    read = run(zonal.zonal_stats, features, rasters, "area")
+
+    assert np.array_equal(computed[['FID', 'VALUE']], read[['FID', 'VALUE']])
+    assert np.allclose(computed['SUM'], read['SUM'], rtol=1e-8)
+
+
+def test_combined_zonal_sum_sparse_labels():
+    # Labels and zone codes far apart must not allocate the full label x zone range
+    labels = np.array([[0, 80000], [80000, -1]])
+    zones = np.array([[3, 3], [zonal.VALUE_CODES + 7, 3]])
+    values = np.array([[1.0, 2.0], [4.0, 8.0]])
+
+    index, zone_classes, sums = zonal.combined_zonal_sum(labels, zones, values)
+
+    assert sorted(zip(index.tolist(), zone_classes.tolist(), sums.tolist())) == \
+        [(0, 3, 1.0), (80000, 3, 2.0), (80000, zonal.VALUE_CODES + 7, 4.0)]
+
+
+def test_geotiff(tmp_path, features, rasters):
+    gdal = pytest.importorskip("osgeo.gdal")
+
+    paths = dict()
+    for name, raster in rasters.items():
+        info = raster.info
+        path = str(tmp_path / "{}.tif".format(name))
+        gdal_type = {'u1': gdal.GDT_Byte, 'f4': gdal.GDT_Float32}[info.dtype.str[1:]]
+        dataset = gdal.GetDriverByName("GTiff").Create(path, info.width, info.height, 1, gdal_type,
+                                                       ["TILED=YES", "BLOCKXSIZE=16", "BLOCKYSIZE=16"])
+        dataset.SetGeoTransform((info.x_min, info.cell_width, 0, info.y_max, 0, -info.cell_height))
+        band = dataset.GetRasterBand(1)
+        if info.nodata is not None:
+            band.SetNoDataValue(float(info.nodata))
+        band.WriteArray(raster.array)
+        dataset = None
+        paths[name] = path
+
+    for function in [zonal.zonal_stats, zonal.labelled_zonal_stats]:
+        records = function(features, paths["lossyear"], paths["biomass"], paths["tcd"], THRESHOLDS, 32, None, 1,
+                           None, Messages())
+        expected = run(function, features, rasters, "biomass", THRESHOLDS, tile_size=32)
+        assert np.array_equal(zonal.merge_records(records)[['FID', 'VALUE']], expected[['FID', 'VALUE']])
+        assert np.allclose(zonal.merge_records(records)['SUM'], expected['SUM'], rtol=1e-9)
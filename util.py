@@ -1,5 +1,10 @@
 import arcpy
 import os
+import raster_function
+import raster_io
+
+# Maximum number of skipped feature IDs listed per reason in the summary of a run
+REPORT_IDS = 20
 
 class messages(object):
     '''
@@ -66,4 +71,111 @@ def create_mosaic_dataset(workspace, name, datasets, datatype, messages):
     arcpy.AddRastersToMosaicDataset_management(os.path.join(workspace,name),
                                                "Raster Dataset",
                                                datasets,
-                                               duplicate_items_action="OVERWRITE_DUPLICATES")
\ No newline at end of file
+                                               duplicate_items_action="OVERWRITE_DUPLICATES")
+
+    # New mosaic has no raster functions, forget any function recorded for a previous mosaic with the same name
+    raster_function.create_raster_function_table(workspace)
+    raster_function.record_raster_function(os.path.join(workspace, name), "")
+
+    messages.AddMessage("Create footprint index")
+    write_footprints(os.path.join(workspace, name), datasets, messages)
+
+def footprint_table(mosaic):
+    """
+    Table with footprint index of a mosaic dataset
+    :param mosaic: string
+    :return: string
+    """
+    return "{}_footprints".format(mosaic)
+
+def write_footprints(mosaic, datasets, messages):
+    """
+    Store footprint, resolution, block size and NoData of the source rasters of a mosaic dataset.
+    If a footprint cannot be read the mosaic gets no footprint index and is read as mosaic dataset
+    :param mosaic: string
+    :param datasets: list of strings
+    :param messages: object
+    :return:
+    """
+    table = footprint_table(mosaic)
+    if arcpy.Exists(table):
+        arcpy.Delete_management(table)
+
+    try:
+        records = raster_io.footprint_records([str(dataset) for dataset in datasets])
+    except Exception as e:
+        messages.AddMessage("Warning: {} - Read {} without footprint index".format(e, os.path.basename(mosaic)))
+        return
+    arcpy.da.NumPyArrayToTable(records, table)
+
+def read_footprints(mosaic):
+    """
+    Footprint index of a mosaic dataset
+    :param mosaic: string
+    :return: numpy.ndarray (raster_io.FOOTPRINT_DTYPE) or None if mosaic has no footprint index
+    """
+    table = footprint_table(mosaic)
+    if not arcpy.Exists(table):
+        return None
+    records = arcpy.da.TableToNumPyArray(table, list(raster_io.FOOTPRINT_DTYPE.names))
+    return records.astype(raster_io.FOOTPRINT_DTYPE)
+
+class FeatureTracker(object):
+    '''
+    Keep track of processed features and of the reasons why features were skipped
+    Membership checks are O(1)
+    '''
+
+    NO_GEOMETRY = "no valid geometry"
+    OUT_OF_BOUNDS = "out of bounds"
+    EMPTY = "no data"
+    FAILED = "errors"
+
+    REASONS = [NO_GEOMETRY, OUT_OF_BOUNDS, EMPTY, FAILED]
+
+    def __init__(self, total):
+        self.total = total
+        self.done = set()
+        self.skipped = dict((reason, list()) for reason in self.REASONS)
+        self.count = 0
+
+    def __contains__(self, oid):
+        return oid in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def processed(self, oid):
+        """
+        Mark feature as processed
+        :param oid: integer
+        :return:
+        """
+        if oid not in self.done:
+            self.done.add(oid)
+            self.count += 1
+
+    def skip(self, oid, reason):
+        """
+        Mark feature as done without results
+        :param oid: integer
+        :param reason: string
+        :return:
+        """
+        if oid not in self.done:
+            self.done.add(oid)
+            self.skipped[reason].append(oid)
+
+    def report(self, messages):
+        """
+        Write summary into messages
+        :param messages: object
+        :return:
+        """
+        messages.AddMessage("Processed {} out of {} features".format(self.count, self.total))
+        for reason in self.REASONS:
+            if len(self.skipped[reason]) > 0:
+                oids = self.skipped[reason]
+                more = ", ..." if len(oids) > REPORT_IDS else ""
+                messages.AddMessage("Skipped {} features with {} (IDs {}{})".format(
+                    len(oids), reason, ", ".join([str(oid) for oid in oids[:REPORT_IDS]]), more))
@@ -0,0 +1,723 @@
+import multiprocessing
+import numpy as np
+
+import geometry
+import raster_io
+import rasterize
+
+# Same columns as the tables written by ZonalStatisticsAsTable (plus FID)
+RESULT_DTYPE = np.dtype([('FID', 'i4'), ('VALUE', 'i4'), ('SUM', 'f8')])
+
+# Results split by TCD threshold
+THRESHOLD_RESULT_DTYPE = np.dtype([('FID', 'i4'), ('TCD', 'i4'), ('VALUE', 'i4'), ('SUM', 'f8')])
+
+# Number of lossyear values per TCD bucket in combined zone codes
+YEAR_CODES = 256
+
+# Bytes per pixel of the arrays computed for a tile (zone codes, valid pixels, feature masks or labels
+# and the zone codes, values and keys of the pixels within features), in addition to the raster arrays
+TILE_WORKING_BYTES = 64
+
+# Bytes per pixel of the valid pixels of every value raster
+LAYER_WORKING_BYTES = 1
+
+# Offset between zone codes of different value rasters. Zone values must be within +/- VALUE_CODES / 2
+VALUE_CODES = 2 ** 16
+
+
+def valid_pixels(array, nodata):
+    """
+    Boolean array of all pixels which are not NoData
+    :param array: numpy.ndarray
+    :param nodata: number or None
+    :return: numpy.ndarray
+    """
+    if array.dtype.kind == 'f':
+        valid = ~np.isnan(array)
+        if nodata is not None and not np.isnan(nodata):
+            valid &= array != nodata
+        return valid
+
+    if nodata is None:
+        return np.ones(array.shape, dtype=bool)
+    return array != nodata
+
+
+def zonal_sum(zones, values):
+    """
+    Sum values for every zone class using a single bincount
+    Only classes which are present in zones are returned
+    :param zones: numpy.ndarray (integer)
+    :param values: numpy.ndarray
+    :return: tuple of numpy.ndarray (zone classes, sums)
+    """
+    if zones.size == 0:
+        return np.empty(0, dtype='i4'), np.empty(0, dtype='f8')
+
+    zones = zones.astype(np.int64)
+    offset = zones.min()
+    zones -= offset
+
+    counts = np.bincount(zones)
+    sums = np.bincount(zones, weights=values)
+    present = np.flatnonzero(counts)
+
+    return (present + offset).astype('i4'), sums[present]
+
+
+def compact(values):
+    """
+    Number distinct values consecutively, using a bincount over the value range instead of sorting
+    :param values: numpy.ndarray (int64)
+    :return: tuple of numpy.ndarray (distinct values, index of every value within them)
+    """
+    offset = values.min()
+    present = np.bincount(values - offset) > 0
+    index = np.cumsum(present) - 1
+    return np.flatnonzero(present) + offset, index[values - offset]
+
+
+def combined_zonal_sum(labels, zones, values):
+    """
+    Sum values for every (label, zone class) combination using a single bincount over a combined key
+    Labels and zone classes are numbered consecutively first, so the key only spans the labels and classes
+    which are present. If the key is still larger than the number of pixels, it is compacted by sorting
+    Pixels with a negative label are ignored
+    :param labels: numpy.ndarray (integer)
+    :param zones: numpy.ndarray (integer)
+    :param values: numpy.ndarray
+    :return: tuple of numpy.ndarray (labels, zone classes, sums)
+    """
+    inside = labels >= 0
+    labels = labels[inside].astype(np.int64)
+    zones = zones[inside].astype(np.int64)
+    values = values[inside]
+
+    if zones.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype='i4'), np.empty(0, dtype='f8')
+
+    label_classes, label_index = compact(labels)
+    zone_classes, zone_index = compact(zones)
+    n_classes = len(zone_classes)
+    key = label_index * n_classes + zone_index
+
+    if len(label_classes) * n_classes > key.size:
+        present, key = np.unique(key, return_inverse=True)
+        sums = np.bincount(key.ravel(), weights=values)
+    else:
+        present = np.flatnonzero(np.bincount(key))
+        sums = np.bincount(key, weights=values)[present]
+
+    return label_classes[present // n_classes], zone_classes[present % n_classes].astype('i4'), sums
+
+
+def zone_codes(lossyear, tcd, thresholds):
+    """
+    Combine lossyear and TCD bucket into one zone code (bucket * YEAR_CODES + lossyear)
+    The bucket of a pixel is the number of thresholds below its TCD,
+    i.e. a pixel is within threshold i if its bucket is larger than i.
+    Codes are int16, 8 bit TCD is mapped to codes with a lookup table
+    :param lossyear: numpy.ndarray
+    :param tcd: numpy.ndarray
+    :param thresholds: list of integers (sorted)
+    :return: numpy.ndarray
+    """
+    thresholds = np.asarray(thresholds)
+    if tcd.dtype == np.uint8:
+        codes = (np.searchsorted(thresholds, np.arange(256), side='left') * YEAR_CODES).astype('i2')[tcd]
+    else:
+        codes = (np.searchsorted(thresholds, tcd, side='left') * YEAR_CODES).astype('i2')
+    codes += lossyear
+    return codes
+
+
+def split_thresholds(records, thresholds):
+    """
+    Convert results with combined zone codes into results per TCD threshold.
+    Loss within a threshold keeps its lossyear, all other values are summed up as -1 (outside threshold)
+    :param records: numpy.ndarray (RESULT_DTYPE) with zone codes as VALUE
+    :param thresholds: list of integers (sorted)
+    :return: numpy.ndarray (THRESHOLD_RESULT_DTYPE)
+    """
+    buckets = records['VALUE'] // YEAR_CODES
+    years = records['VALUE'] % YEAR_CODES
+
+    results = list()
+    for i, threshold in enumerate(thresholds):
+        split = np.empty(len(records), dtype=THRESHOLD_RESULT_DTYPE)
+        split['FID'] = records['FID']
+        split['TCD'] = threshold
+        split['VALUE'] = np.where(buckets > i, years, -1)
+        split['SUM'] = records['SUM']
+        results.append(split)
+
+    if len(results) == 0:
+        return np.empty(0, dtype=THRESHOLD_RESULT_DTYPE)
+    return merge_records(np.concatenate(results))
+
+
+def add_threshold(records, threshold):
+    """
+    Add TCD threshold to results of a lossyear mosaic which was already masked
+    :param records: numpy.ndarray (RESULT_DTYPE)
+    :param threshold: integer
+    :return: numpy.ndarray (THRESHOLD_RESULT_DTYPE)
+    """
+    out = np.empty(len(records), dtype=THRESHOLD_RESULT_DTYPE)
+    out['FID'] = records['FID']
+    out['TCD'] = threshold
+    out['VALUE'] = records['VALUE']
+    out['SUM'] = records['SUM']
+    return out
+
+
+def value_list(value_raster):
+    """
+    Value rasters as list
+    :param value_raster: string, reader or list of them
+    :return: list
+    """
+    if isinstance(value_raster, (list, tuple)):
+        return list(value_raster)
+    return [value_raster]
+
+
+def zone_rasters(zone_raster, value_raster, tcd_raster):
+    """
+    Open rasters which are read for every tile
+    Value raster raster_io.PIXEL_AREA is computed from the grid of the zone raster
+    :param zone_raster: string or reader
+    :param value_raster: string, reader or list of them
+    :param tcd_raster: string, reader or None
+    :return: dict of readers
+    """
+    rasters = {"zones": open_reader(zone_raster)}
+    for i, raster in enumerate(value_list(value_raster)):
+        if raster == raster_io.PIXEL_AREA:
+            rasters[("values", i)] = raster_io.PixelAreaReader(rasters["zones"].info)
+        else:
+            rasters[("values", i)] = open_reader(raster)
+    if tcd_raster is not None:
+        rasters["tcd"] = open_reader(tcd_raster)
+    return rasters
+
+
+def read_zones(rasters, thresholds, tile):
+    """
+    Read zone and value arrays of a tile, one layer per value raster.
+    If a TCD raster is given, zones are combined lossyear/TCD bucket codes.
+    Value layers are kept as they are read, i.e. pixel area stays a view of one vector per row
+    :param rasters: dict of readers
+    :param thresholds: list of integers (sorted) or None
+    :param tile: tuple (col_off, row_off, cols, rows)
+    :return: tuple (zones, list of (values, valid pixels), one per value raster)
+    """
+    arrays = raster_io.read_tile(rasters, rasters["zones"].info, tile)
+    zones = arrays["zones"]
+    valid = valid_pixels(zones, rasters["zones"].info.nodata)
+
+    if "tcd" in rasters:
+        valid &= valid_pixels(arrays["tcd"], rasters["tcd"].info.nodata)
+        zones = zone_codes(zones, arrays["tcd"], thresholds)
+
+    layers = list()
+    for key in sorted([key for key in rasters if key[0] == "values"]):
+        if isinstance(rasters[key], raster_io.PixelAreaReader):
+            # Pixel area has no NoData
+            layers.append((arrays[key], valid))
+        else:
+            layers.append((arrays[key], valid & valid_pixels(arrays[key], rasters[key].info.nodata)))
+
+    return zones, layers
+
+
+def working_bytes(rasters):
+    """
+    Bytes per pixel of the arrays computed for a tile, in addition to the raster arrays
+    :param rasters: dict of readers
+    :return: integer
+    """
+    return TILE_WORKING_BYTES + LAYER_WORKING_BYTES * len([key for key in rasters if key[0] == "values"])
+
+
+def split_values(records, count):
+    """
+    Split results of several value rasters into results per value raster.
+    Zone classes of the n-th value raster are offset by n * VALUE_CODES
+    :param records: numpy.ndarray (RESULT_DTYPE)
+    :param count: integer, number of value rasters
+    :return: list of numpy.ndarray (RESULT_DTYPE)
+    """
+    layers = (records['VALUE'].astype(np.int64) + VALUE_CODES // 2) // VALUE_CODES
+
+    results = list()
+    for i in range(count):
+        split = records[layers == i]
+        split['VALUE'] -= i * VALUE_CODES
+        results.append(split)
+    return results
+
+
+def join_sums(results, fields):
+    """
+    Join results of different value rasters into one row per FID, TCD and VALUE with one sum field per raster
+    Missing combinations are set to 0
+    :param results: list of numpy.ndarray (THRESHOLD_RESULT_DTYPE)
+    :param fields: list of field names, one per result
+    :return: numpy.ndarray
+    """
+    key_dtype = [('FID', 'i4'), ('TCD', 'i4'), ('VALUE', 'i4')]
+    keys = [result[['FID', 'TCD', 'VALUE']].astype(key_dtype) for result in results]
+    unique, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+
+    out = np.zeros(len(unique), dtype=key_dtype + [(field, 'f8') for field in fields])
+    for name, dtype in key_dtype:
+        out[name] = unique[name]
+
+    start = 0
+    for result, field in zip(results, fields):
+        out[field][inverse[start:start + len(result)]] = result['SUM']
+        start += len(result)
+    return out
+
+
+def feature_bounds(rings):
+    """
+    Bounding box of a polygon
+    :param rings: list of numpy.ndarray (n, 2)
+    :return: tuple (x_min, y_min, x_max, y_max)
+    """
+    coords = np.concatenate(rings)
+    x_min, y_min = coords.min(axis=0)
+    x_max, y_max = coords.max(axis=0)
+    return x_min, y_min, x_max, y_max
+
+
+def feature_arrays(features):
+    """
+    Bounding boxes and FIDs of all features
+    :param features: list of (fid, rings) or geometry.GeometryStore
+    :return: tuple (numpy.ndarray (n, 4), numpy.ndarray)
+    """
+    if isinstance(features, geometry.GeometryStore):
+        return features.bounds, features.fids
+    return (np.array([feature_bounds(rings) for fid, rings in features], dtype='f8').reshape(-1, 4),
+            np.array([fid for fid, rings in features], dtype='i4'))
+
+
+def select_features(features, keep):
+    """
+    Features for which keep is set
+    :param features: list of (fid, rings) or geometry.GeometryStore
+    :param keep: numpy.ndarray (boolean)
+    :return: same type as features
+    """
+    if isinstance(features, geometry.GeometryStore):
+        return features.subset(keep)
+    return [feature for feature, selected in zip(features, keep) if selected]
+
+
+def merge_zonal_sums(zone_classes, sums):
+    """
+    Sum up partial results of the same zone classes (i.e. from different tiles)
+    :param zone_classes: list of numpy.ndarray
+    :param sums: list of numpy.ndarray
+    :return: tuple of numpy.ndarray (zone classes, sums)
+    """
+    if len(zone_classes) == 1:
+        return zone_classes[0], sums[0]
+
+    unique, inverse = np.unique(np.concatenate(zone_classes), return_inverse=True)
+    return unique.astype('i4'), np.bincount(inverse, weights=np.concatenate(sums))
+
+
+def feature_stats(rings, rasters, thresholds, tile_size, max_bytes):
+    """
+    Calculate zonal sum of value raster for every class of zone raster within a polygon
+    Zone, value and TCD raster must snap to the same grid.
+    Cells where one of the rasters is NoData are ignored.
+    Large polygons are processed tile by tile to keep memory usage flat
+    :param rings: list of numpy.ndarray (n, 2)
+    :param rasters: dict of readers (zones, one or more values and optional tcd)
+    :param thresholds: list of integers (sorted) or None
+    :param tile_size: integer
+    :param max_bytes: integer or None
+    :return: tuple of numpy.ndarray (zone classes, sums) or None if polygon does not cover any cell
+    """
+    info = rasters["zones"].info
+    window = info.window(*feature_bounds(rings))
+    if window is None:
+        return None
+
+    zone_classes = list()
+    sums = list()
+
+    for tile in raster_io.tile_windows(rasters["zones"], list(rasters.values()), window, tile_size, max_bytes,
+                                       working_bytes(rasters)):
+        mask = rasterize.rasterize_polygon(rings, info, *tile)
+        if not mask.any():
+            continue
+
+        zones, layers = read_zones(rasters, thresholds, tile)
+        for i, (values, valid) in enumerate(layers):
+            layer_mask = valid & mask
+            tile_classes, tile_sums = zonal_sum(zones[layer_mask], values[layer_mask])
+            zone_classes.append(tile_classes + i * VALUE_CODES)
+            sums.append(tile_sums)
+
+    if len(zone_classes) == 0:
+        return None
+    return merge_zonal_sums(zone_classes, sums)
+
+
+def open_reader(raster):
+    """
+    Open raster if raster is given as path
+    :param raster: string or reader
+    :return: reader
+    """
+    if hasattr(raster, "read"):
+        return raster
+    return raster_io.open_raster(raster)
+
+
+def to_records(fid, zone_classes, sums):
+    """
+    Convert feature statistics into (FID, VALUE, SUM) rows
+    :param fid: integer
+    :param zone_classes: numpy.ndarray
+    :param sums: numpy.ndarray
+    :return: numpy.ndarray (RESULT_DTYPE)
+    """
+    records = np.empty(len(zone_classes), dtype=RESULT_DTYPE)
+    records['FID'] = fid
+    records['VALUE'] = zone_classes
+    records['SUM'] = sums
+    return records
+
+
+def label_tile(features, bounds, info, col_off, row_off, cols, rows):
+    """
+    Burn feature index of all features into label rasters for a pixel window.
+    Overlapping features cannot share a label raster and are burned into additional layers.
+    Features which do not overlap any other feature are all burned in one pass into the first layer
+    :param features: list of (fid, rings) or geometry.GeometryStore
+    :param bounds: numpy.ndarray (n, 4) bounding boxes of features
+    :param info: RasterInfo
+    :param col_off: integer
+    :param row_off: integer
+    :param cols: integer
+    :param rows: integer
+    :return: list of numpy.ndarray
+    """
+    x_min, y_min, x_max, y_max = info.window_bounds(col_off, row_off, cols, rows)
+    candidates = np.flatnonzero((bounds[:, 0] < x_max) & (bounds[:, 2] > x_min) &
+                                (bounds[:, 1] < y_max) & (bounds[:, 3] > y_min))
+    if len(candidates) == 0:
+        return []
+
+    # Burn all features in one pass, only features which overlap other features are burned one by one
+    labels, overlapping = rasterize.rasterize_labels([features[i][1] for i in candidates], info,
+                                                     col_off, row_off, cols, rows)
+    layers = list()
+    if (labels >= 0).any():
+        layers.append(np.where(labels >= 0, candidates[labels], -1).astype('i4'))
+
+    for i in candidates[overlapping]:
+        window = info.window(*bounds[i])
+        if window is None:
+            continue
+
+        # Clip feature window to tile
+        c0 = max(window[0], col_off)
+        r0 = max(window[1], row_off)
+        c1 = min(window[0] + window[2], col_off + cols)
+        r1 = min(window[1] + window[3], row_off + rows)
+        if c1 <= c0 or r1 <= r0:
+            continue
+
+        mask = rasterize.rasterize_polygon(features[i][1], info, c0, r0, c1 - c0, r1 - r0)
+        if not mask.any():
+            continue
+
+        # Use first layer in which feature does not overlap with any other feature
+        for labels in layers:
+            view = labels[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off]
+            if not (view[mask] >= 0).any():
+                break
+        else:
+            labels = np.empty((rows, cols), dtype='i4')
+            labels.fill(-1)
+            layers.append(labels)
+            view = labels[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off]
+
+        view[mask] = i
+
+    return layers
+
+
+def tile_stats(features, bounds, fids, rasters, thresholds, tile):
+    """
+    Calculate zonal sum for all features which intersect a tile
+    :param features: list of (fid, rings) or geometry.GeometryStore
+    :param bounds: numpy.ndarray (n, 4) bounding boxes of features
+    :param fids: numpy.ndarray FIDs of features
+    :param rasters: dict of readers (zones, one or more values and optional tcd)
+    :param thresholds: list of integers (sorted) or None
+    :param tile: tuple (col_off, row_off, cols, rows)
+    :return: numpy.ndarray (RESULT_DTYPE) or None if tile does not intersect any feature
+    """
+    layers = label_tile(features, bounds, rasters["zones"].info, *tile)
+    if len(layers) == 0:
+        return None
+
+    zones, value_layers = read_zones(rasters, thresholds, tile)
+
+    # Zone classes of every value raster are summed separately and offset afterwards (see split_values)
+    results = list()
+    for labels in layers:
+        for i, (values, valid) in enumerate(value_layers):
+            index, zone_classes, sums = combined_zonal_sum(np.where(valid, labels, -1), zones, values)
+            records = to_records(0, zone_classes + i * VALUE_CODES, sums)
+            records['FID'] = fids[index]
+            results.append(records)
+
+    return np.concatenate(results)
+
+
+def zonal_stats(features, zone_raster, value_raster, tcd_raster, thresholds, tile_size, max_bytes, workers,
+                checkpoint, messages):
+    """
+    Calculate zonal sum for all features, one feature at a time.
+    If a TCD raster is given, zone raster is the unmasked lossyear and zones are combined lossyear/TCD bucket codes
+    (see split_thresholds).
+    If a list of value rasters is given, all of them are summed in the same pass (see split_values).
+    If workers > 1 features are distributed to a pool of worker processes.
+    Each worker opens its own raster handles and returns result arrays.
+    Features completed in the checkpoint are skipped, new results are written to the checkpoint
+    :param features: list of (fid, rings) or geometry.GeometryStore
+    :param zone_raster: string or reader
+    :param value_raster: string, reader or list of them
+    :param tcd_raster: string, reader or None
+    :param thresholds: list of integers (sorted) or None
+    :param tile_size: integer
+    :param max_bytes: integer or None
+    :param workers: integer
+    :param checkpoint: Checkpoint or None
+    :param messages: object
+    :return: numpy.ndarray (RESULT_DTYPE) results of features which were not yet in the checkpoint
+    """
+    results = list()
+
+    if checkpoint is not None:
+        fids = feature_arrays(features)[1]
+        features = select_features(features, np.array([fid not in checkpoint.features for fid in fids.tolist()],
+                                                       dtype=bool))
+
+    if workers > 1:
+        chunk_size = max(1, min(100, len(features) // (workers * 4)))
+        chunks = [(features[i:i + chunk_size], tile_size, max_bytes) for i in range(0, len(features), chunk_size)]
+
+        pool = worker_pool(workers, zone_raster, value_raster, tcd_raster, thresholds, None)
+        try:
+            processed = 0
+            for fids, records in pool.imap_unordered(_worker_zonal_stats, chunks):
+                processed += len(fids)
+                results.append(records)
+                if checkpoint is not None:
+                    checkpoint.write(records, fids)
+                messages.AddMessage("Processed {} out of {} features".format(processed, len(features)))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    else:
+        rasters = zone_rasters(zone_raster, value_raster, tcd_raster)
+        for i, (fid, rings) in enumerate(features):
+            messages.AddMessage("Process feature {} out of {} (ID {})".format(i + 1, len(features), fid))
+            stats = feature_stats(rings, rasters, thresholds, tile_size, max_bytes)
+            records = None
+            if stats is not None:
+                records = to_records(fid, *stats)
+                results.append(records)
+            if checkpoint is not None:
+                checkpoint.write(records, [fid])
+
+    if len(results) == 0:
+        return np.empty(0, dtype=RESULT_DTYPE)
+    return np.concatenate(results)
+
+
+def labelled_zonal_stats(features, zone_raster, value_raster, tcd_raster, thresholds, tile_size, max_bytes, workers,
+                         checkpoint, messages):
+    """
+    Calculate zonal sum for all features in a single pass over the zone and value raster.
+    Feature indices are burned into one label raster per tile and
+    all (feature, zone class) sums of a tile are computed with one bincount.
+    If a TCD raster is given, zones are combined lossyear/TCD bucket codes (see zonal_stats)
+    If workers > 1 tiles are distributed to a pool of worker processes.
+    Tiles completed in the checkpoint are skipped, new results are written to the checkpoint
+    :param features: list of (fid, rings) or geometry.GeometryStore
+    :param zone_raster: string or reader
+    :param value_raster: string, reader or list of them
+    :param tcd_raster: string, reader or None
+    :param thresholds: list of integers (sorted) or None
+    :param tile_size: integer
+    :param max_bytes: integer or None
+    :param workers: integer
+    :param checkpoint: Checkpoint or None
+    :param messages: object
+    :return: numpy.ndarray (RESULT_DTYPE) results of tiles which were not yet in the checkpoint
+    """
+    if len(features) == 0:
+        return np.empty(0, dtype=RESULT_DTYPE)
+
+    rasters = zone_rasters(zone_raster, value_raster, tcd_raster)
+
+    info = rasters["zones"].info
+    bounds, fids = feature_arrays(features)
+
+    extent = info.window(bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max())
+    if extent is None:
+        return np.empty(0, dtype=RESULT_DTYPE)
+
+    tiles = list(raster_io.tile_windows(rasters["zones"], list(rasters.values()), extent, tile_size, max_bytes,
+                                        working_bytes(rasters)))
+    if checkpoint is not None:
+        tiles = [tile for tile in tiles if tile[:2] not in checkpoint.tiles]
+
+    results = list()
+    if workers > 1:
+        pool = worker_pool(workers, zone_raster, value_raster, tcd_raster, thresholds, features)
+        try:
+            for i, (tile, records) in enumerate(pool.imap_unordered(_worker_tile_stats, tiles)):
+                messages.AddMessage("Processed {} out of {} tiles".format(i + 1, len(tiles)))
+                if records is not None:
+                    results.append(records)
+                if checkpoint is not None:
+                    checkpoint.write(records, tiles=[tile])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    else:
+        for i, tile in enumerate(tiles):
+            records = tile_stats(features, bounds, fids, rasters, thresholds, tile)
+            if records is not None:
+                messages.AddMessage("Processed tile {} out of {}".format(i + 1, len(tiles)))
+                results.append(records)
+            if checkpoint is not None:
+                checkpoint.write(records, tiles=[tile])
+
+    if len(results) == 0:
+        return np.empty(0, dtype=RESULT_DTYPE)
+
+    return merge_records(np.concatenate(results))
+
+
+def merge_records(records):
+    """
+    Sum up rows with the same FID and VALUE (and TCD), i.e. features which span multiple tiles
+    :param records: numpy.ndarray (RESULT_DTYPE or THRESHOLD_RESULT_DTYPE)
+    :return: numpy.ndarray
+    """
+    if len(records) == 0:
+        return records
+
+    keys = [name for name in records.dtype.names if name != 'SUM']
+    order = np.lexsort([records[key] for key in reversed(keys)])
+    records = records[order]
+
+    start = np.zeros(len(records), dtype=bool)
+    start[0] = True
+    for key in keys:
+        start[1:] |= records[key][1:] != records[key][:-1]
+    first = np.flatnonzero(start)
+
+    merged = records[first]
+    merged['SUM'] = np.add.reduceat(records['SUM'], first)
+    return merged
+
+
+# Rasters and features of a worker process. Set by _init_worker
+_worker = dict()
+
+
+def _init_worker(zone_path, value_paths, tcd_path, thresholds, features):
+    """
+    Open raster handles of a worker process
+    :param zone_path: string or raster_io.FootprintReader
+    :param value_paths: list of strings or raster_io.FootprintReader
+    :param tcd_path: string, raster_io.FootprintReader or None
+    :param thresholds: list of integers or None
+    :param features: list of (fid, rings), geometry.GeometryStore or None
+    :return:
+    """
+    _worker["rasters"] = zone_rasters(zone_path, value_paths, tcd_path)
+    _worker["thresholds"] = thresholds
+
+    if features is not None:
+        _worker["features"] = features
+        _worker["bounds"], _worker["fids"] = feature_arrays(features)
+
+
+def _worker_zonal_stats(task):
+    """
+    Calculate zonal sum for a chunk of features in a worker process
+    :param task: tuple (features, tile_size, max_bytes)
+    :return: tuple (list of FIDs, numpy.ndarray (RESULT_DTYPE))
+    """
+    features, tile_size, max_bytes = task
+
+    results = [np.empty(0, dtype=RESULT_DTYPE)]
+    for fid, rings in features:
+        stats = feature_stats(rings, _worker["rasters"], _worker["thresholds"], tile_size, max_bytes)
+        if stats is not None:
+            results.append(to_records(fid, *stats))
+
+    return [fid for fid, rings in features], np.concatenate(results)
+
+
+def _worker_tile_stats(tile):
+    """
+    Calculate zonal sum of all features within a tile in a worker process
+    :param tile: tuple (col_off, row_off, cols, rows)
+    :return: tuple (tile, numpy.ndarray (RESULT_DTYPE) or None)
+    """
+    return tile, tile_stats(_worker["features"], _worker["bounds"], _worker["fids"],
+                            _worker["rasters"], _worker["thresholds"], tile)
+
+
+def worker_pool(workers, zone_raster, value_raster, tcd_raster, thresholds, features):
+    """
+    Create a pool of worker processes. Every worker opens its own raster handles.
+    Readers are reopened by path, footprint readers are copied and open their source rasters on first read
+    :param workers: integer
+    :param zone_raster: string or reader
+    :param value_raster: string, reader or list of them
+    :param tcd_raster: string, reader or None
+    :param thresholds: list of integers or None
+    :param features: list of (fid, rings), geometry.GeometryStore or None
+    :return: multiprocessing.Pool
+    """
+    zone_path = worker_raster(zone_raster)
+    value_paths = [worker_raster(raster) for raster in value_list(value_raster)]
+    tcd_path = worker_raster(tcd_raster)
+    return multiprocessing.Pool(workers, _init_worker, (zone_path, value_paths, tcd_path, thresholds, features))
+
+
+def worker_raster(raster):
+    """
+    Raster as it is handed to worker processes
+    :param raster: string, reader or None
+    :return: string, raster_io.FootprintReader or None
+    """
+    if isinstance(raster, raster_io.FootprintReader):
+        return raster
+    return getattr(raster, "path", raster)